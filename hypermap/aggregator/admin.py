@@ -4,8 +4,8 @@ from django_celery_results.models import TaskResult
 
 from django.core.urlresolvers import reverse
 
-from models import (Service, Layer, Check, SpatialReferenceSystem, EndpointList,
-                    Endpoint, LayerDate, LayerWM, Catalog, IssueType, Issue)
+from models import (Service, Layer, Check, CheckStats, SpatialReferenceSystem, EndpointList,
+                    Endpoint, CSWHarvestJob, LayerDate, LayerWM, Catalog, IssueType, Issue)
 
 
 class ServiceAdmin(admin.ModelAdmin):
@@ -56,9 +56,18 @@ class CheckAdmin(admin.ModelAdmin):
     date_hierarchy = 'checked_datetime'
 
 
+class CheckStatsAdmin(admin.ModelAdmin):
+    model = CheckStats
+    list_display = ('id', 'content_type', 'content_object', 'checks_count', 'reliability', 'last_check_datetime',
+                    'last_status', )
+    search_fields = ['=object_id']
+    list_filter = ('last_status', 'content_type')
+    readonly_fields = ('first_check', 'last_check', )
+
+
 class EndpointListAdmin(admin.ModelAdmin):
     model = EndpointList
-    list_display = ('id', 'upload', 'endpoints_admin_url', 'catalog', 'greedy')
+    list_display = ('id', 'upload', 'endpoints_admin_url', 'catalog', 'greedy', 'progress', 'processed_datetime')
 
 
 class EndpointAdmin(admin.ModelAdmin):
@@ -68,6 +77,12 @@ class EndpointAdmin(admin.ModelAdmin):
     search_fields = ['url', ]
 
 
+class CSWHarvestJobAdmin(admin.ModelAdmin):
+    model = CSWHarvestJob
+    list_display = ('url', 'catalog', 'progress', 'services_count', 'updated', 'finished_datetime')
+    search_fields = ['url', ]
+
+
 class CatalogAdmin(admin.ModelAdmin):
     model = Catalog
     list_display = ('name', 'slug', 'url', 'get_search_url')
@@ -96,12 +111,14 @@ class IssueAdmin(admin.ModelAdmin):
 
 admin.site.register(Service, ServiceAdmin)
 admin.site.register(Check, CheckAdmin)
+admin.site.register(CheckStats, CheckStatsAdmin)
 admin.site.register(SpatialReferenceSystem, SpatialReferenceSystemAdmin)
 admin.site.register(Layer, LayerAdmin)
 admin.site.register(LayerWM, LayerWMAdmin)
 admin.site.register(LayerDate, LayerDateAdmin)
 admin.site.register(EndpointList, EndpointListAdmin)
 admin.site.register(Endpoint, EndpointAdmin)
+admin.site.register(CSWHarvestJob, CSWHarvestJobAdmin)
 admin.site.register(Catalog, CatalogAdmin)
 admin.site.register(IssueType, IssueTypeAdmin)
 admin.site.register(Issue, IssueAdmin)
@@ -0,0 +1,354 @@
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+import requests
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from owslib.map.wms111 import WMSCapabilitiesReader
+from owslib.tms import TileMapService
+from owslib.wms import WebMapService
+from owslib.wmts import WebMapTileService, WMTSCapabilitiesReader
+
+from hypermap.aggregator.lrucache import LRUCache
+from hypermap.aggregator.detection import sniff_root, get_service_type
+
+
+LOGGER = logging.getLogger(__name__)
+
+# seconds a capabilities document downloaded by the detection of a new service is kept for its first harvest
+REGISTRY_DETECTED_CAPABILITIES_TIMEOUT = getattr(settings, 'REGISTRY_DETECTED_CAPABILITIES_TIMEOUT', 600)
+
+REGISTRY_CAPABILITIES_CACHE_TTL = getattr(settings, 'REGISTRY_CAPABILITIES_CACHE_TTL', 300)
+REGISTRY_CAPABILITIES_CACHE_SIZE = getattr(settings, 'REGISTRY_CAPABILITIES_CACHE_SIZE', 32)
+# name of a cache of CACHES sharing the capabilities documents between processes, for example a file or Redis cache
+REGISTRY_CAPABILITIES_CACHE = getattr(settings, 'REGISTRY_CAPABILITIES_CACHE', None)
+
+# (OWSLib object, download time) of the capabilities documents by (url, service type, version)
+ows_cache = LRUCache(REGISTRY_CAPABILITIES_CACHE_SIZE, REGISTRY_CAPABILITIES_CACHE_TTL)
+
+
+class Capabilities(object):
+    """
+    A downloaded capabilities document, with the OWSLib object parsed from it and its validators.
+    """
+
+    def __init__(self, ows, content, etag=None, last_modified=None):
+        self.ows = ows
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.hash = hashlib.sha1(content).hexdigest()
+
+
+class CapabilitiesFile(object):
+    """
+    A capabilities document downloaded to a temporary file, to be parsed with
+    hypermap.aggregator.capabilities_parser, with its validators.
+    """
+
+    def __init__(self, file, hash, etag=None, last_modified=None):
+        self.file = file
+        self.hash = hash
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def close(self):
+        self.file.close()
+
+
+def get_harvest_hash(*values):
+    """
+    Hash of the harvested values of a layer.
+    """
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=unicode)).hexdigest()
+
+
+def get_shared_cache():
+    if REGISTRY_CAPABILITIES_CACHE:
+        return caches[REGISTRY_CAPABILITIES_CACHE]
+    return None
+
+
+def get_capabilities_key(url, service_type, version):
+    return 'capabilities:%s' % hashlib.sha1(
+        ('%s|%s|%s' % (url, service_type, version)).encode('utf-8')
+    ).hexdigest()
+
+
+def get_capabilities_url(url, service_type, version=None):
+    if service_type == 'OGC:WMS':
+        return WMSCapabilitiesReader(version).capabilities_url(url)
+    if service_type == 'OGC:WMTS':
+        return WMTSCapabilitiesReader().capabilities_url(url)
+    return url
+
+
+def parse_capabilities(url, service_type, version, content, timeout=10):
+    """
+    The OWSLib object of a WMS, WMTS or TMS capabilities document.
+    """
+    if service_type == 'OGC:WMS':
+        return WebMapService(url, version=version, xml=content, timeout=timeout)
+    if service_type == 'OGC:WMTS':
+        return WebMapTileService(url, xml=content)
+    if service_type == 'OSGeo:TMS':
+        return TileMapService(url, xml=content, timeout=timeout)
+    raise ValueError('Capabilities of %s services are not cached' % service_type)
+
+
+def cache_ows(url, service_type, version, ows, content, negotiated=False, fetched=None):
+    """
+    Keep a parsed capabilities document in the in-process cache, and its content in the shared cache.
+    :param negotiated: version is the result of the version negotiation of a WMS.
+    """
+    fetched = fetched or time.time()
+    ows_cache.set((url, service_type, version), (ows, fetched))
+    if negotiated:
+        ows_cache.set((url, service_type, None), (ows, fetched))
+    shared_cache = get_shared_cache()
+    if shared_cache is not None and content is not None:
+        shared_cache.set(
+            get_capabilities_key(url, service_type, version), (content, fetched), REGISTRY_CAPABILITIES_CACHE_TTL
+        )
+
+
+def get_ows(url, service_type, version=None, timeout=10, max_age=None):
+    """
+    The OWSLib object of a WMS, WMTS or TMS service, shared by all the callers in the process,
+    so that a service check and the checks of its layers download and parse the capabilities once.
+    Documents are kept REGISTRY_CAPABILITIES_CACHE_TTL seconds, in a REGISTRY_CAPABILITIES_CACHE_SIZE
+    LRU cache in the process, and in the REGISTRY_CAPABILITIES_CACHE Django cache if any.
+    WMS versions are negotiated when version is None, 1.3.0 first.
+    :param max_age: download the document again if it is older than max_age seconds.
+    """
+    cached = ows_cache.get((url, service_type, version))
+    if cached is not None and (max_age is None or time.time() - cached[1] <= max_age):
+        return cached[0]
+
+    if service_type == 'OGC:WMS' and version is None:
+        for version in ('1.3.0', '1.1.1'):
+            LOGGER.debug('Trying a WMS %s GetCapabilities request' % version)
+            try:
+                ows = get_ows(url, service_type, version, timeout, max_age)
+                ows_cache.set((url, service_type, None), ows_cache.get((url, service_type, version)))
+                return ows
+            except Exception as err:
+                if version == '1.1.1':
+                    raise
+                LOGGER.warning('WMS 1.3.0 support not found: %s', err)
+
+    shared_cache = get_shared_cache()
+    if shared_cache is not None:
+        cached = shared_cache.get(get_capabilities_key(url, service_type, version))
+        if cached is not None and (max_age is None or time.time() - cached[1] <= max_age):
+            content, fetched = cached
+            ows = parse_capabilities(url, service_type, version, content, timeout)
+            ows_cache.set((url, service_type, version), (ows, fetched))
+            return ows
+
+    capabilities_url = get_capabilities_url(url, service_type, version)
+    LOGGER.debug('Downloading the capabilities %s' % capabilities_url)
+    response = requests.get(capabilities_url, timeout=timeout)
+    response.raise_for_status()
+    ows = parse_capabilities(url, service_type, version, response.content, timeout)
+    cache_ows(url, service_type, version, ows, response.content)
+    return ows
+
+
+def invalidate_ows(url):
+    """
+    Drop the capabilities of a service from the in-process cache.
+    """
+    for service_type, versions in (('OGC:WMS', (None, '1.3.0', '1.1.1')), ('OGC:WMTS', (None,)),
+                                   ('OSGeo:TMS', (None,))):
+        for version in versions:
+            ows_cache.delete((url, service_type, version))
+
+
+def get_detected_capabilities_key(url):
+    return 'detected_capabilities:%s' % hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def store_detected_capabilities(url, detection):
+    """
+    Keep the capabilities document of a detected service (see hypermap.aggregator.detection),
+    so that the first harvest of the service does not download it again.
+    Documents larger than REGISTRY_DETECTED_CAPABILITIES_MAX_SIZE are not kept by the detection.
+    """
+    if detection.content is None:
+        return
+    cache.set(get_detected_capabilities_key(url), {
+        'service_type': detection.service_type,
+        'version': detection.version,
+        'content': detection.content,
+        'etag': detection.etag,
+        'last_modified': detection.last_modified,
+    }, REGISTRY_DETECTED_CAPABILITIES_TIMEOUT)
+
+
+def pop_detected_capabilities(service):
+    """
+    The capabilities document kept by store_detected_capabilities for the url and type of a service, or None.
+    """
+    key = get_detected_capabilities_key(service.url)
+    detected = cache.get(key)
+    if detected is None:
+        return None
+    cache.delete(key)
+    if detected['service_type'] != service.type:
+        return None
+    LOGGER.debug('Using the capabilities downloaded by the detection of %s' % service.url)
+    return detected
+
+
+def get_conditional_headers(service):
+    headers = {}
+    if service.capabilities_etag:
+        headers['If-None-Match'] = service.capabilities_etag
+    if service.capabilities_last_modified:
+        headers['If-Modified-Since'] = service.capabilities_last_modified
+    return headers
+
+
+def fetch_capabilities(service, url, timeout=10):
+    """
+    Download a capabilities document with a conditional request, using the ETag and Last-Modified
+    of the last harvest of the service.
+    :return: the response, or None if the document did not change since the last harvest.
+    """
+    response = requests.get(url, headers=get_conditional_headers(service), timeout=timeout)
+    if response.status_code == 304:
+        LOGGER.debug('Capabilities not modified: %s' % url)
+        return None
+    response.raise_for_status()
+    if service.capabilities_hash and hashlib.sha1(response.content).hexdigest() == service.capabilities_hash:
+        LOGGER.debug('Capabilities did not change: %s' % url)
+        return None
+    return response
+
+
+def get_wms_capabilities(service, timeout=10):
+    """
+    Version negotiation as in hypermap.aggregator.utils.get_wms_version_negotiate, with conditional requests.
+    :return: Capabilities, or None if the document did not change since the last harvest.
+    """
+    detected = pop_detected_capabilities(service)
+    if detected is not None:
+        ows = parse_capabilities(service.url, 'OGC:WMS', detected['version'], detected['content'], timeout)
+        cache_ows(service.url, 'OGC:WMS', detected['version'], ows, detected['content'], negotiated=True)
+        return Capabilities(ows, detected['content'], detected['etag'], detected['last_modified'])
+    for version in ('1.3.0', '1.1.1'):
+        url = get_capabilities_url(service.url, 'OGC:WMS', version)
+        LOGGER.debug('Trying a WMS %s GetCapabilities request' % version)
+        try:
+            response = fetch_capabilities(service, url, timeout)
+            if response is None:
+                return None
+            ows = parse_capabilities(service.url, 'OGC:WMS', version, response.content, timeout)
+            # the checks of the service and of its layers use the harvested document
+            cache_ows(service.url, 'OGC:WMS', version, ows, response.content, negotiated=True)
+            return Capabilities(
+                ows, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified')
+            )
+        except Exception as err:
+            if version == '1.1.1':
+                raise
+            LOGGER.warning('WMS 1.3.0 support not found: %s', err)
+
+
+def get_wmts_capabilities(service, timeout=10):
+    """
+    WMTS capabilities, with a conditional request.
+    :return: Capabilities, or None if the document did not change since the last harvest.
+    """
+    detected = pop_detected_capabilities(service)
+    if detected is not None:
+        ows = parse_capabilities(service.url, 'OGC:WMTS', None, detected['content'])
+        cache_ows(service.url, 'OGC:WMTS', None, ows, detected['content'])
+        return Capabilities(ows, detected['content'], detected['etag'], detected['last_modified'])
+    url = get_capabilities_url(service.url, 'OGC:WMTS')
+    response = fetch_capabilities(service, url, timeout)
+    if response is None:
+        return None
+    ows = parse_capabilities(service.url, 'OGC:WMTS', None, response.content)
+    # the checks of the service and of its layers use the harvested document
+    cache_ows(service.url, 'OGC:WMTS', None, ows, response.content)
+    return Capabilities(ows, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+
+def fetch_capabilities_file(service, url, timeout=10, chunk_size=65536):
+    """
+    Download a capabilities document to a temporary file, a chunk at a time, with a conditional request.
+    :return: CapabilitiesFile, or None if the document did not change since the last harvest.
+    """
+    response = requests.get(url, headers=get_conditional_headers(service), timeout=timeout, stream=True)
+    try:
+        if response.status_code == 304:
+            LOGGER.debug('Capabilities not modified: %s' % url)
+            return None
+        response.raise_for_status()
+        f = tempfile.TemporaryFile()
+        sha1 = hashlib.sha1()
+        for chunk in response.iter_content(chunk_size):
+            sha1.update(chunk)
+            f.write(chunk)
+    finally:
+        response.close()
+    if service.capabilities_hash and sha1.hexdigest() == service.capabilities_hash:
+        LOGGER.debug('Capabilities did not change: %s' % url)
+        f.close()
+        return None
+    f.seek(0)
+    return CapabilitiesFile(f, sha1.hexdigest(), response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+
+def get_capabilities_file(service, timeout=10):
+    """
+    The capabilities document of a WMS or WMTS service in a temporary file, with conditional requests.
+    For WMS the 1.1.1 document is requested if the 1.3.0 request does not return a WMS capabilities document.
+    :return: CapabilitiesFile, or None if the document did not change since the last harvest.
+    """
+    detected = pop_detected_capabilities(service)
+    if detected is not None:
+        f = tempfile.TemporaryFile()
+        f.write(detected['content'])
+        f.seek(0)
+        return CapabilitiesFile(
+            f, hashlib.sha1(detected['content']).hexdigest(), detected['etag'], detected['last_modified']
+        )
+    if service.type == 'OGC:WMTS':
+        return fetch_capabilities_file(service, get_capabilities_url(service.url, 'OGC:WMTS'), timeout)
+    for version in ('1.3.0', '1.1.1'):
+        LOGGER.debug('Trying a WMS %s GetCapabilities request' % version)
+        capabilities = fetch_capabilities_file(service, get_capabilities_url(service.url, 'OGC:WMS', version), timeout)
+        if capabilities is None:
+            return None
+        service_type, detected_version = get_service_type(sniff_root([capabilities.file.read(4096)]))
+        capabilities.file.seek(0)
+        if service_type == 'OGC:WMS':
+            return capabilities
+        capabilities.close()
+        LOGGER.warning('WMS %s support not found' % version)
+    raise ValueError('No WMS capabilities document found at %s' % service.url)
+
+
+def save_capabilities_state(service, capabilities):
+    """
+    Store the validators of a capabilities document once its layers are harvested.
+    """
+    from hypermap.aggregator.models import Service
+
+    service.capabilities_etag = capabilities.etag
+    service.capabilities_last_modified = capabilities.last_modified
+    service.capabilities_hash = capabilities.hash
+    # update does not send the service signals
+    Service.objects.filter(id=service.id).update(
+        capabilities_etag=capabilities.etag,
+        capabilities_last_modified=capabilities.last_modified,
+        capabilities_hash=capabilities.hash,
+    )
@@ -0,0 +1,165 @@
+import logging
+
+from lxml import etree
+
+
+LOGGER = logging.getLogger(__name__)
+
+WMS_ROOTS = ('WMS_Capabilities', 'WMT_MS_Capabilities')
+WMTS_ROOTS = ('Capabilities', )
+
+
+class LayerRecord(object):
+    """
+    A layer of a capabilities document, with the attributes of the OWSLib layers used by the harvesters.
+    """
+
+    def __init__(self, crs_options=None, bbox=None):
+        self.name = None
+        self.title = None
+        self.abstract = None
+        self.keywords = []
+        self.boundingBoxWGS84 = bbox
+        self.crsOptions = list(crs_options or [])
+
+
+def get_localname(element):
+    return etree.QName(element).localname
+
+
+def get_text(element):
+    return (element.text or '').strip() or None
+
+
+def get_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_keywords(element):
+    return [get_text(keyword) for keyword in element.iter() if get_localname(keyword) == 'Keyword' and
+            get_text(keyword)]
+
+
+def get_bbox(values):
+    """
+    A (minx, miny, maxx, maxy) bbox, or None if any value is missing.
+    """
+    bbox = tuple(get_float(value) for value in values)
+    if None in bbox:
+        return None
+    return bbox
+
+
+def free(element):
+    """
+    Clear a processed element and remove its processed preceding siblings, so that the tree stays small.
+    """
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def iter_layer_records(source, roots, set_value, nested):
+    """
+    Yield the named layers of a capabilities document, one at a time, parsing it with iterparse
+    and clearing the processed elements: memory does not depend on the size of the document.
+    :param source: a file name or a file object.
+    :param roots: accepted names of the root element.
+    :param set_value: function(record, name, element) setting a value of a layer from one of its child elements.
+    :param nested: layers inherit the CRS and bbox of the layer they are nested in, as in WMS.
+    """
+    layers = []
+    root = None
+    for event, element in etree.iterparse(source, events=('start', 'end'), no_network=True,
+                                          resolve_entities=False, huge_tree=True):
+        name = get_localname(element)
+        if root is None:
+            root = name
+            if root not in roots:
+                raise ValueError('Unexpected root element %s in capabilities document' % root)
+            continue
+        if event == 'start':
+            if name == 'Layer':
+                parent = layers[-1][1] if layers and nested else None
+                if parent is None:
+                    record = LayerRecord()
+                else:
+                    record = LayerRecord(parent.crsOptions, parent.boundingBoxWGS84)
+                layers.append((element, record))
+            continue
+        if name == 'Layer' and layers and layers[-1][0] is element:
+            element, record = layers.pop()
+            free(element)
+            if record.name:
+                yield record
+        elif layers and element.getparent() is layers[-1][0]:
+            set_value(layers[-1][1], name, element)
+            element.clear()
+        elif not layers and element.getparent() is not None:
+            free(element)
+
+
+def set_wms_value(record, name, element):
+    if name == 'Name':
+        record.name = get_text(element)
+    elif name == 'Title':
+        record.title = get_text(element)
+    elif name == 'Abstract':
+        record.abstract = get_text(element)
+    elif name == 'KeywordList':
+        record.keywords = get_keywords(element)
+    elif name in ('CRS', 'SRS'):
+        # WMS 1.1.1 allows several space separated codes
+        for code in (element.text or '').split():
+            if code not in record.crsOptions:
+                record.crsOptions.append(code)
+    elif name == 'EX_GeographicBoundingBox':
+        values = {}
+        for child in element:
+            values[get_localname(child)] = child.text
+        bbox = get_bbox([values.get('westBoundLongitude'), values.get('southBoundLatitude'),
+                         values.get('eastBoundLongitude'), values.get('northBoundLatitude')])
+        record.boundingBoxWGS84 = bbox or record.boundingBoxWGS84
+    elif name == 'LatLonBoundingBox':
+        bbox = get_bbox([element.get('minx'), element.get('miny'), element.get('maxx'), element.get('maxy')])
+        record.boundingBoxWGS84 = bbox or record.boundingBoxWGS84
+
+
+def set_wmts_value(record, name, element):
+    if name == 'Identifier':
+        record.name = get_text(element)
+    elif name == 'Title':
+        record.title = get_text(element)
+    elif name == 'Abstract':
+        record.abstract = get_text(element)
+    elif name == 'Keywords':
+        record.keywords = get_keywords(element)
+    elif name == 'WGS84BoundingBox':
+        corners = {}
+        for child in element:
+            corners[get_localname(child)] = (child.text or '').split()
+        lower = corners.get('LowerCorner') or [None, None]
+        upper = corners.get('UpperCorner') or [None, None]
+        record.boundingBoxWGS84 = get_bbox(lower[:2] + upper[:2])
+        record.crsOptions = ['EPSG:4326']
+
+
+def iter_wms_layers(source):
+    """
+    Yield the named layers of a WMS 1.1.1 or 1.3.0 capabilities document as LayerRecord:
+    name, title, abstract, keywords, WGS84 bbox and CRS codes, inherited from the parent layers.
+    A layer is yielded at its end tag, after the layers nested in it.
+    """
+    return iter_layer_records(source, WMS_ROOTS, set_wms_value, nested=True)
+
+
+def iter_wmts_layers(source):
+    """
+    Yield the layers of a WMTS 1.0.0 capabilities document as LayerRecord.
+    """
+    return iter_layer_records(source, WMTS_ROOTS, set_wmts_value, nested=False)
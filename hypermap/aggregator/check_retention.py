@@ -0,0 +1,172 @@
+import math
+import logging
+import datetime
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from hypermap.aggregator.enums import ROLLUP_HOUR, ROLLUP_DAY
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_CHECK_RETENTION_DAYS = getattr(settings, 'REGISTRY_CHECK_RETENTION_DAYS', 30)
+REGISTRY_CHECK_HOURLY_RETENTION_DAYS = getattr(settings, 'REGISTRY_CHECK_HOURLY_RETENTION_DAYS', 90)
+REGISTRY_CHECK_PRUNE_BATCH_SIZE = getattr(settings, 'REGISTRY_CHECK_PRUNE_BATCH_SIZE', 200)
+
+
+def truncate(value, period):
+    """
+    Return the start of the hour or day of a datetime.
+    """
+    if period == ROLLUP_DAY:
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+def merge_rollup(rollup, other):
+    """
+    Add the checks of other to rollup, the percentiles of both being averaged by their number of checks.
+    """
+    checks_count = rollup.checks_count + other.checks_count
+    for name in ('response_time_p50', 'response_time_p95'):
+        values = [(getattr(r, name), r.checks_count) for r in (rollup, other) if getattr(r, name) is not None]
+        if values:
+            setattr(rollup, name, sum(value * count for value, count in values) / float(checks_count))
+    rollup.checks_count = checks_count
+    rollup.success_count += other.success_count
+
+
+def save_rollups(content_type_id, rows):
+    """
+    Save the hourly and daily CheckRollup rows of checks of resources with the same content type.
+    :param rows: (object_id, checked_datetime, success, response_time) tuples.
+    """
+    from hypermap.aggregator.models import CheckRollup
+    from hypermap.aggregator.harvesting import bulk_update
+
+    groups = OrderedDict()
+    for object_id, checked_datetime, success, response_time in rows:
+        for period in (ROLLUP_HOUR, ROLLUP_DAY):
+            groups.setdefault((object_id, period, truncate(checked_datetime, period)), []).append(
+                (success, float(response_time or 0))
+            )
+
+    rollups = {}
+    for key, checks in groups.items():
+        object_id, period, period_start = key
+        response_times = sorted(response_time for success, response_time in checks)
+        rollups[key] = CheckRollup(
+            content_type_id=content_type_id,
+            object_id=object_id,
+            period=period,
+            period_start=period_start,
+            checks_count=len(checks),
+            success_count=len([success for success, response_time in checks if success]),
+            response_time_p50=percentile(response_times, 50),
+            response_time_p95=percentile(response_times, 95),
+        )
+
+    # checks with a date older than the checks already pruned are merged in the existing rollups
+    existing = CheckRollup.objects.filter(
+        content_type_id=content_type_id,
+        object_id__in=set(key[0] for key in rollups),
+        period_start__gte=min(key[2] for key in rollups),
+        period_start__lte=max(key[2] for key in rollups),
+    )
+    changed = []
+    for rollup in existing:
+        key = (rollup.object_id, rollup.period, rollup.period_start)
+        if key in rollups:
+            merge_rollup(rollup, rollups.pop(key))
+            changed.append(rollup)
+    CheckRollup.objects.bulk_create(rollups.values())
+    bulk_update(CheckRollup, changed, ('checks_count', 'success_count', 'response_time_p50', 'response_time_p95'))
+
+
+def prune_checks(retention_days=None, hourly_retention_days=None, batch_size=None):
+    """
+    Roll up the checks older than retention_days in hourly and daily CheckRollup rows, and delete them.
+    Checks are processed a day and batch_size resources at a time, each batch being rolled up and deleted
+    in its own transaction, so that pruning can be interrupted without losing or counting twice any check.
+    Hourly rollups are kept for hourly_retention_days, daily ones forever.
+    The first and last checks of the resources are kept, as their CheckStats reference them.
+    :return: number of deleted checks.
+    """
+    from hypermap.aggregator.models import Check, CheckRollup, CheckStats
+    from hypermap.aggregator.harvesting import chunks
+
+    retention_days = retention_days or REGISTRY_CHECK_RETENTION_DAYS
+    hourly_retention_days = hourly_retention_days or REGISTRY_CHECK_HOURLY_RETENTION_DAYS
+    batch_size = batch_size or REGISTRY_CHECK_PRUNE_BATCH_SIZE
+
+    now = timezone.now()
+    cutoff = truncate(now - datetime.timedelta(days=retention_days), ROLLUP_DAY)
+    old_checks = Check.objects.filter(checked_datetime__lt=cutoff).exclude(
+        id__in=CheckStats.objects.filter(first_check__isnull=False).values('first_check')
+    ).exclude(
+        id__in=CheckStats.objects.filter(last_check__isnull=False).values('last_check')
+    ).order_by()
+    pruned = 0
+    while True:
+        oldest = old_checks.order_by('checked_datetime').values_list('checked_datetime', flat=True).first()
+        if oldest is None:
+            break
+        day_start = truncate(oldest, ROLLUP_DAY)
+        day_checks = old_checks.filter(
+            checked_datetime__gte=day_start,
+            checked_datetime__lt=day_start + datetime.timedelta(days=1)
+        )
+        resources = OrderedDict()
+        for content_type_id, object_id in day_checks.values_list('content_type_id', 'object_id').distinct():
+            resources.setdefault(content_type_id, []).append(object_id)
+        for content_type_id, object_ids in resources.items():
+            for chunk in chunks(object_ids, batch_size):
+                with transaction.atomic():
+                    rows = list(day_checks.filter(content_type_id=content_type_id, object_id__in=chunk).values_list(
+                        'id', 'object_id', 'checked_datetime', 'success', 'response_time'
+                    ))
+                    if not rows:
+                        continue
+                    save_rollups(content_type_id, [row[1:] for row in rows])
+                    for ids in chunks([row[0] for row in rows], 500):
+                        Check.objects.filter(id__in=ids).delete()
+                    pruned += len(rows)
+        LOGGER.debug('Rolled up the checks of %s' % day_start.date())
+
+    CheckRollup.objects.filter(
+        period=ROLLUP_HOUR,
+        period_start__lt=now - datetime.timedelta(days=hourly_retention_days)
+    ).delete()
+    return pruned
+
+
+def get_check_history(resource, days):
+    """
+    Return the checks of a resource in the last days as (datetime, response time, success) tuples,
+    most recent first: the checks which are still kept, then the hourly rollups of the older ones,
+    or the daily rollups for ranges longer than REGISTRY_CHECK_HOURLY_RETENTION_DAYS.
+    """
+    since = timezone.now() - datetime.timedelta(days=days)
+    history = [
+        (check.checked_datetime, check.response_time, check.success)
+        for check in resource.check_set.filter(checked_datetime__gte=since).order_by('-checked_datetime')
+    ]
+    period = ROLLUP_DAY if days > REGISTRY_CHECK_HOURLY_RETENTION_DAYS else ROLLUP_HOUR
+    rollups = resource.check_rollup_set.filter(period=period, period_start__gte=truncate(since, period))
+    if history:
+        rollups = rollups.filter(period_start__lt=history[-1][0])
+    for rollup in rollups.order_by('-period_start'):
+        history.append((rollup.period_start, rollup.response_time_p50, rollup.success_count == rollup.checks_count))
+    return history
@@ -0,0 +1,140 @@
+import logging
+from collections import OrderedDict
+
+from django.db import connection, transaction, IntegrityError
+from django.db.models import AutoField
+
+
+LOGGER = logging.getLogger(__name__)
+
+# number of results kept in CheckStats.recent_results
+RECENT_CHECKS_NUMBER = 30
+RECENT_CHECKS_MASK = (1 << RECENT_CHECKS_NUMBER) - 1
+
+CHECK_STATS_FIELDS = (
+    'checks_count', 'success_count', 'response_time_sum', 'min_response_time', 'max_response_time',
+    'recent_results', 'first_check', 'last_check', 'last_check_datetime', 'last_status',
+)
+
+
+def add_check(check_stats, check):
+    """
+    Add a check to a CheckStats, in memory.
+    """
+    response_time = float(check.response_time or 0)
+    check_stats.checks_count += 1
+    check_stats.success_count += int(bool(check.success))
+    check_stats.response_time_sum += response_time
+    if check_stats.min_response_time is None or response_time < check_stats.min_response_time:
+        check_stats.min_response_time = response_time
+    if check_stats.max_response_time is None or response_time > check_stats.max_response_time:
+        check_stats.max_response_time = response_time
+    check_stats.recent_results = ((check_stats.recent_results << 1) | int(bool(check.success))) & RECENT_CHECKS_MASK
+    if check_stats.first_check_id is None:
+        check_stats.first_check_id = check.pk
+    if check.pk is not None:
+        check_stats.last_check_id = check.pk
+    check_stats.last_check_datetime = check.checked_datetime
+    check_stats.last_status = bool(check.success)
+
+
+def create_checks(checks, chunk_size=500):
+    """
+    Insert new checks with their primary keys set, which bulk_create does not do, so that the CheckStats
+    can reference them: PostgreSQL returns the ids of a multi-row INSERT, other databases insert the
+    checks one at a time. Does not send the model signals.
+    """
+    from hypermap.aggregator.models import Check
+    from hypermap.aggregator.harvesting import chunks
+
+    checks = [check for check in checks if check.pk is None]
+    if not checks:
+        return
+    fields = [field for field in Check._meta.concrete_fields if not isinstance(field, AutoField)]
+    quote_name = connection.ops.quote_name
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            for chunk in chunks(checks, chunk_size):
+                params = []
+                for check in chunk:
+                    params.extend(field.get_db_prep_save(field.pre_save(check, True), connection) for field in fields)
+                sql = 'INSERT INTO %s (%s) VALUES %s RETURNING %s' % (
+                    quote_name(Check._meta.db_table),
+                    ', '.join(quote_name(field.column) for field in fields),
+                    ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(chunk)),
+                    quote_name(Check._meta.pk.column)
+                )
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    # the rows are returned in the order of the VALUES
+                    for check, row in zip(chunk, cursor.fetchall()):
+                        check.pk = row[0]
+        else:
+            for check in checks:
+                check.pk = Check._base_manager._insert([check], fields=fields, return_id=True)
+    for check in checks:
+        check._state.adding = False
+        check._state.db = connection.alias
+
+
+def update_check_stats(checks):
+    """
+    Add new checks to the CheckStats of their resources.
+    The CheckStats rows are locked while they are updated, so that concurrent checks of the same
+    resource are all counted.
+    """
+    from hypermap.aggregator.models import CheckStats
+    from hypermap.aggregator.harvesting import bulk_update, chunks
+
+    checks = list(checks)
+    if not checks:
+        return
+    resources_checks = OrderedDict()
+    for check in sorted(checks, key=lambda check: (check.checked_datetime, check.pk)):
+        resources_checks.setdefault((check.content_type_id, check.object_id), []).append(check)
+
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                existing = {}
+                for content_type_id in set(key[0] for key in resources_checks):
+                    object_ids = [key[1] for key in resources_checks if key[0] == content_type_id]
+                    for chunk in chunks(object_ids, 500):
+                        rows = CheckStats.objects.select_for_update().filter(
+                            content_type_id=content_type_id, object_id__in=chunk
+                        )
+                        for check_stats in rows:
+                            existing[(check_stats.content_type_id, check_stats.object_id)] = check_stats
+                new_stats = []
+                for key, resource_checks in resources_checks.items():
+                    check_stats = existing.get(key)
+                    if check_stats is None:
+                        check_stats = CheckStats(content_type_id=key[0], object_id=key[1])
+                        new_stats.append(check_stats)
+                    for check in resource_checks:
+                        add_check(check_stats, check)
+                CheckStats.objects.bulk_create(new_stats)
+                bulk_update(CheckStats, list(existing.values()), CHECK_STATS_FIELDS)
+            return
+        except IntegrityError:
+            # the stats of a resource were created by another check in the meanwhile
+            if attempt:
+                raise
+            LOGGER.debug('Retrying the update of the check stats')
+
+
+def build_check_stats(check_stats_model, checks):
+    """
+    Compute the CheckStats of all the resources from checks ordered by resource and date,
+    in a single pass: used to fill the CheckStats table.
+    """
+    check_stats = None
+    for check in checks:
+        if check_stats is None or (check_stats.content_type_id, check_stats.object_id) != (
+                check.content_type_id, check.object_id):
+            if check_stats is not None:
+                yield check_stats
+            check_stats = check_stats_model(content_type_id=check.content_type_id, object_id=check.object_id)
+        add_check(check_stats, check)
+    if check_stats is not None:
+        yield check_stats
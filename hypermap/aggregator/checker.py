@@ -0,0 +1,92 @@
+import logging
+import threading
+
+from django.conf import settings
+
+from hypermap.aggregator.governor import governed, get_host
+from hypermap.aggregator.check_stats import create_checks, update_check_stats
+from hypermap.aggregator.workers import WorkerPool
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_CHECK_THREADS = getattr(settings, 'REGISTRY_CHECK_THREADS', 8)
+REGISTRY_CHECK_HOST_CONCURRENCY = getattr(settings, 'REGISTRY_CHECK_HOST_CONCURRENCY', 4)
+
+
+class ServiceClients(object):
+    """
+    OWS clients shared by the checks of the layers of a service, so that the capabilities
+    document of a WMS or WMTS service is downloaded once instead of once per layer.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get(self, layer):
+        from hypermap.aggregator.capabilities import get_ows
+
+        if layer.type not in ('OGC:WMS', 'OGC:WMTS'):
+            return None
+        with self._lock:
+            if layer.service_id not in self._clients:
+                with governed(layer.service.url):
+                    self._clients[layer.service_id] = get_ows(layer.service.url, layer.type)
+            return self._clients[layer.service_id]
+
+
+def check_layers(layers, threads=None, host_concurrency=None):
+    """
+    Check n layers with a pool of threads, sending at most host_concurrency requests at a time to the
+    same host, and save all the resulting Check rows at once.
+    The layers should be fetched with their service (select_related), as the worker threads do not
+    access the database: thumbnails are stored by the threads but saved in the layers here.
+    :return: list of (layer, check) tuples.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from hypermap.aggregator.models import Layer
+
+    threads = threads or REGISTRY_CHECK_THREADS
+    host_concurrency = host_concurrency or REGISTRY_CHECK_HOST_CONCURRENCY
+    layers = list(layers)
+    if not layers:
+        return []
+
+    # warm the content types cache before the threads build the checks
+    ContentType.objects.get_for_model(Layer)
+
+    semaphores = {}
+    for layer in layers:
+        host = get_host(layer.get_remote_url())
+        if host not in semaphores:
+            semaphores[host] = threading.BoundedSemaphore(host_concurrency)
+    clients = ServiceClients()
+
+    def run_check(layer):
+        with semaphores[get_host(layer.get_remote_url())]:
+            try:
+                ows = clients.get(layer)
+            except Exception as err:
+                # the check of the layer reports the service error
+                LOGGER.debug('Cannot load the service of layer id %s: %s' % (layer.id, err))
+                ows = None
+            thumbnail = layer.thumbnail.name
+            check = layer.run_check(save_thumbnail=False, ows=ows)
+            return layer, check, layer.thumbnail.name != thumbnail
+
+    with WorkerPool(min(threads, len(layers))) as pool:
+        results = pool.map(run_check, layers)
+
+    for layer, check, thumbnail_updated in results:
+        if thumbnail_updated:
+            # update does not send the layer signals
+            Layer.objects.filter(id=layer.id).update(thumbnail=layer.thumbnail.name)
+    # create_checks does not send post_save
+    create_checks([check for layer, check, thumbnail_updated in results])
+    update_check_stats([check for layer, check, thumbnail_updated in results])
+
+    checks = [(layer, check) for layer, check, thumbnail_updated in results]
+    available = len([check for layer, check in checks if check.success])
+    LOGGER.debug('Checked %s layers, %s available' % (len(checks), available))
+    return checks
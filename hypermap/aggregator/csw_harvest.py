@@ -0,0 +1,165 @@
+import logging
+
+from django.conf import settings
+from django.utils import timezone
+
+from hypermap.aggregator.enums import SERVICE_TYPES
+from hypermap.aggregator.governor import CircuitOpenError, governed
+from hypermap.aggregator.harvesting import chunks
+from hypermap.aggregator.workers import WorkerPool
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_CSW_HARVEST_THREADS = getattr(settings, 'REGISTRY_CSW_HARVEST_THREADS', 4)
+
+TYPENAMES = 'csw:Record'
+OUTPUTSCHEMA = 'http://www.opengis.net/cat/csw/2.0.2'
+
+
+def get_pagesize():
+    manager = getattr(settings, 'REGISTRY_PYCSW', {}).get('manager', {})
+    return int(manager.get('csw_harvest_pagesize', 100))
+
+
+def get_csw(endpoint, timeout=30):
+    """
+    A CSW client which does not request the capabilities: each thread needs its own client,
+    as the records of the last request are stored in it.
+    """
+    from owslib.csw import CatalogueServiceWeb
+
+    return CatalogueServiceWeb(endpoint, timeout=timeout, skip_caps=True)
+
+
+def get_matches(endpoint):
+    """
+    The number of records of a CSW endpoint.
+    """
+    csw = get_csw(endpoint)
+    try:
+        with governed(endpoint):
+            csw.getrecords2(typenames=TYPENAMES, resulttype='hits', outputschema=OUTPUTSCHEMA)
+        return csw.results['matches']
+    except CircuitOpenError:
+        raise
+    except Exception:  # this is a CSW, but server rejects query
+        raise RuntimeError(csw.response)
+
+
+def get_service_links(record):
+    """
+    The (url, service type) of the services referenced by a CSW record, via dct:references
+    or the GeoNetwork-ish dc:URI.
+    """
+    from hypermap.aggregator.utils import detect_metadata_url_scheme
+
+    service_types = [service_type[0] for service_type in SERVICE_TYPES]
+    links = []
+    for ref in record.references or []:
+        if ref['scheme'] in service_types:
+            scheme = ref['scheme']
+        else:  # loose detection
+            scheme = detect_metadata_url_scheme(ref['url'])
+        if scheme is not None:
+            links.append((ref['url'], scheme))
+    for uri in record.uris or []:  # loose detection
+        scheme = detect_metadata_url_scheme(uri['url'])
+        if scheme is not None:
+            links.append((uri['url'], scheme))
+    return links
+
+
+def fetch_page(endpoint, startposition, pagesize):
+    """
+    Request a page of records of a CSW endpoint, through the governor of its host.
+    :return: the service links of its records.
+    """
+    LOGGER.info('Parsing records from %s of %s' % (startposition, endpoint))
+    csw = get_csw(endpoint)
+    try:
+        with governed(endpoint):
+            csw.getrecords2(typenames=TYPENAMES, startposition=startposition,
+                            maxrecords=pagesize, outputschema=OUTPUTSCHEMA, esn='full')
+        records = csw.records.values()
+    except CircuitOpenError:
+        raise
+    except Exception:  # this is a CSW, but server rejects query
+        raise RuntimeError(csw.response)
+    links = []
+    for record in records:
+        # try to parse metadata
+        try:
+            links.extend(get_service_links(record))
+        except Exception as err:  # parsing failed for some reason
+            LOGGER.warning('Metadata parsing failed %s', err)
+            LOGGER.error(err, exc_info=True)
+    return links
+
+
+def create_service(link, catalog):
+    """
+    Create the service of a link of a CSW record.
+    :return: True if the service was created.
+    """
+    from hypermap.aggregator.utils import create_service_from_endpoint
+
+    url, scheme = link
+    try:
+        return create_service_from_endpoint(url, scheme, catalog=catalog) is not None
+    except Exception as err:
+        LOGGER.error('Could not create service for %s : %s' % (scheme, url))
+        LOGGER.error(err, exc_info=True)
+        return False
+
+
+def harvest_csw(endpoint, catalog, pagesize=None, threads=None):
+    """
+    Create the services referenced by the records of a CSW endpoint.
+    The records are requested threads pages at a time, concurrently, and the service links of a window
+    of pages are deduplicated, against the services of the catalog as well, before the services are created
+    by the same pool of threads. The progress is stored in a CSWHarvestJob after each window:
+    a harvest which stopped resumes from its first page whose services were not created.
+    :return: number of created services.
+    """
+    from hypermap.aggregator.models import CSWHarvestJob, Service
+
+    pagesize = pagesize or get_pagesize()
+    threads = threads or REGISTRY_CSW_HARVEST_THREADS
+    job, created = CSWHarvestJob.objects.get_or_create(url=endpoint, catalog=catalog)
+    if job.finished_datetime is not None:
+        # the last harvest is complete, start over
+        job.next_record = 1
+        job.services_count = 0
+        job.finished_datetime = None
+
+    LOGGER.debug('Harvesting CSW %s' % endpoint)
+    job.matches = get_matches(endpoint)
+    job.save()
+    LOGGER.info('Harvesting %d CSW records from record %s' % (job.matches, job.next_record))
+
+    seen = set(Service.objects.filter(catalog=catalog).values_list('url', flat=True))
+    positions = range(job.next_record, job.matches + 1, pagesize)
+
+    def fetch(startposition):
+        return fetch_page(endpoint, startposition, pagesize)
+
+    def create(link):
+        return create_service(link, catalog)
+
+    with WorkerPool(threads) as pool:
+        for window in chunks(positions, threads):
+            pages = pool.map(fetch, window)
+            links = []
+            for link in [link for page in pages for link in page]:
+                if link[0] not in seen:
+                    seen.add(link[0])
+                    links.append(link)
+            results = pool.map(create, links)
+            job.services_count += len([result for result in results if result])
+            job.next_record = window[-1] + pagesize
+            job.save()
+    job.finished_datetime = timezone.now()
+    job.save()
+    LOGGER.info('Found %s services on endpoint %s' % (job.services_count, endpoint))
+    return job.services_count
@@ -0,0 +1,243 @@
+import urllib
+import logging
+import itertools
+import urlparse
+
+import requests
+
+from django.conf import settings
+from lxml import etree
+
+
+LOGGER = logging.getLogger(__name__)
+
+# the root element of a capabilities document is read from its first bytes only
+SNIFF_SIZE = 16384
+CHUNK_SIZE = 4096
+# bytes of a detected capabilities document kept for the first harvest of the service: larger documents
+# are not kept, and are downloaded again by the harvest (memcached does not store values larger than 1 MB)
+REGISTRY_DETECTED_CAPABILITIES_MAX_SIZE = getattr(settings, 'REGISTRY_DETECTED_CAPABILITIES_MAX_SIZE', 900000)
+
+# service types by (namespace, name) of the root element of their capabilities document
+ROOT_ELEMENTS = {
+    ('http://www.opengis.net/cat/csw/2.0.2', 'Capabilities'): 'OGC:CSW',
+    ('http://www.opengis.net/wms', 'WMS_Capabilities'): 'OGC:WMS',
+    (None, 'WMT_MS_Capabilities'): 'OGC:WMS',
+    ('http://www.opengis.net/wmts/1.0', 'Capabilities'): 'OGC:WMTS',
+    (None, 'TileMapService'): 'OSGeo:TMS',
+}
+
+# GetCapabilities requests tried when the endpoint itself is not a capabilities document
+CAPABILITIES_REQUESTS = (
+    ('OGC:WMS', {'service': 'WMS', 'request': 'GetCapabilities'}),
+    ('OGC:WMTS', {'service': 'WMTS', 'request': 'GetCapabilities', 'version': '1.0.0'}),
+    ('OGC:CSW', {'service': 'CSW', 'request': 'GetCapabilities', 'version': '2.0.2'}),
+)
+
+# OWSLib supports WMS 1.1.1 and 1.3.0 only
+WMS_VERSIONS = {'1.3.0': '1.3.0', '1.1.1': '1.1.1', '1.1.0': '1.1.1'}
+
+# elements holding the title and abstract of a service, the root element being the one of TMS
+SERVICE_ELEMENTS = ('Service', 'ServiceIdentification', 'TileMapService')
+# elements following the description of the service, where the sniffing of its title stops
+SERVICE_END_ELEMENTS = ('Capability', 'OperationsMetadata', 'Contents', 'TileMaps')
+
+
+class Detection(object):
+    """
+    A capabilities document of a detected service type, downloaded once and handed to OWSLib and the harvester.
+    The content is None if the document is larger than REGISTRY_DETECTED_CAPABILITIES_MAX_SIZE.
+    """
+
+    def __init__(self, service_type, version, url, content, etag=None, last_modified=None, title=None,
+                 abstract=None):
+        self.service_type = service_type
+        self.version = version
+        self.url = url
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.title = title
+        self.abstract = abstract
+
+    def get_ows(self, endpoint, timeout=10):
+        """
+        The OWSLib object of the service, built from the downloaded document without requesting it again
+        if it was kept.
+        """
+        from owslib.csw import CatalogueServiceWeb
+        from owslib.tms import TileMapService
+        from owslib.wms import WebMapService
+        from owslib.wmts import WebMapTileService
+
+        if self.service_type == 'OGC:CSW':
+            # the capabilities are not used by the CSW harvest
+            return CatalogueServiceWeb(endpoint, timeout=timeout, skip_caps=True)
+        if self.service_type == 'OGC:WMS':
+            return WebMapService(endpoint, version=self.version, xml=self.content, timeout=timeout)
+        if self.service_type == 'OGC:WMTS':
+            return WebMapTileService(endpoint, xml=self.content)
+        return TileMapService(endpoint, xml=self.content, timeout=timeout)
+
+
+def sniff_root(chunks):
+    """
+    Parse the first chunks of a document with a streaming parser until its root element is found.
+    :return: (namespace, name, attributes) of the root element, or None if the document is not XML.
+    """
+    parser = etree.XMLPullParser(events=('start',), no_network=True, resolve_entities=False)
+    size = 0
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                qname = etree.QName(element)
+                return qname.namespace, qname.localname, dict(element.attrib)
+            size += len(chunk)
+            if size >= SNIFF_SIZE:
+                break
+    except etree.XMLSyntaxError:
+        pass
+    return None
+
+
+def sniff_identification(chunks):
+    """
+    Read the title and abstract of a service from the chunks of its capabilities document with a streaming
+    parser, stopping at the end of the description of the service.
+    :return: (title, abstract), None for the values which are not found.
+    """
+    parser = etree.XMLPullParser(events=('start', 'end'), no_network=True, resolve_entities=False)
+    values = {}
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                name = etree.QName(element).localname
+                if event == 'start':
+                    if name in SERVICE_END_ELEMENTS:
+                        return values.get('Title'), values.get('Abstract')
+                    continue
+                parent = element.getparent()
+                if name in ('Title', 'Abstract') and parent is not None and \
+                        etree.QName(parent).localname in SERVICE_ELEMENTS:
+                    values.setdefault(name, (element.text or '').strip() or None)
+                    if 'Title' in values and 'Abstract' in values:
+                        return values['Title'], values['Abstract']
+    except etree.XMLSyntaxError as err:
+        LOGGER.debug('Cannot read the title of the service: %s' % err)
+    return values.get('Title'), values.get('Abstract')
+
+
+def get_service_type(root):
+    """
+    The service type and version of a capabilities document from its root element.
+    """
+    if root is None:
+        return None, None
+    namespace, name, attributes = root
+    service_type = ROOT_ELEMENTS.get((namespace, name))
+    version = attributes.get('version')
+    if service_type == 'OGC:WMS':
+        version = WMS_VERSIONS.get(version, '1.1.1')
+    return service_type, version
+
+
+def get_capabilities_url(endpoint, params):
+    """
+    The endpoint url with the parameters of a GetCapabilities request, replacing the OGC ones it may have.
+    """
+    parts = urlparse.urlparse(endpoint)
+    query = [
+        (key, value) for key, value in urlparse.parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in ('service', 'request', 'version', 'acceptversions')
+    ]
+    query.extend(sorted(params.items()))
+    return urlparse.urlunparse(parts._replace(query=urllib.urlencode(query)))
+
+
+def fetch_and_sniff(url, timeout=10, max_size=None):
+    """
+    Download the first bytes of url and, if it is a known capabilities document, the rest of it,
+    reading the title and abstract of the service on the way.
+    The download stops once the document is larger than max_size and its title is read.
+    :return: a Detection, or None.
+    """
+    max_size = max_size or REGISTRY_DETECTED_CAPABILITIES_MAX_SIZE
+    response = requests.get(url, stream=True, timeout=timeout)
+    try:
+        if response.status_code != 200:
+            LOGGER.debug('Status code %s for %s' % (response.status_code, url))
+            return None
+        read = []
+
+        def iter_chunks():
+            for chunk in response.iter_content(CHUNK_SIZE):
+                read.append(chunk)
+                yield chunk
+
+        chunks = iter_chunks()
+        service_type, version = get_service_type(sniff_root(chunks))
+        if service_type is None:
+            return None
+        title, abstract = None, None
+        if service_type != 'OGC:CSW':
+            title, abstract = sniff_identification(itertools.chain(list(read), chunks))
+        # the rest of the document, unless it is too large to be kept
+        size = sum(len(chunk) for chunk in read)
+        for chunk in chunks:
+            size += len(chunk)
+            if size > max_size:
+                break
+        if size > max_size:
+            LOGGER.debug('The capabilities document of %s is larger than %s bytes' % (url, max_size))
+            content = None
+        else:
+            content = b''.join(read)
+        LOGGER.debug('Detected a %s %s service at %s' % (service_type, version or '', url))
+        return Detection(
+            service_type, version, url, content,
+            response.headers.get('ETag'), response.headers.get('Last-Modified'), title, abstract
+        )
+    finally:
+        response.close()
+
+
+def get_capabilities_requests(endpoint):
+    """
+    The GetCapabilities requests to try on an endpoint, the ones matching its url first.
+    """
+    lower = endpoint.lower()
+    return sorted(
+        CAPABILITIES_REQUESTS,
+        key=lambda item: item[1]['service'].lower() not in lower
+    )
+
+
+def detect_service(endpoint, timeout=10, capabilities_requests=True):
+    """
+    Detect the service type of an endpoint with as few requests as possible: the endpoint itself
+    is requested first, and if it is not a capabilities document the GetCapabilities requests of the
+    service types are tried one at a time, the ones matching the endpoint url first.
+    Errors of the first request are raised: the endpoint cannot be reached.
+    :param capabilities_requests: try the GetCapabilities requests.
+    :return: a Detection, or None if the endpoint is not a WMS, WMTS, TMS or CSW.
+    """
+    detection = fetch_and_sniff(endpoint, timeout)
+    if detection is not None or not capabilities_requests:
+        return detection
+    if '/rest/services' in endpoint:
+        # ESRI endpoints are detected with their REST API
+        return None
+    for service_type, params in get_capabilities_requests(endpoint):
+        url = get_capabilities_url(endpoint, params)
+        if url == endpoint:
+            continue
+        try:
+            detection = fetch_and_sniff(url, timeout)
+        except Exception as err:
+            LOGGER.debug('Cannot request %s: %s' % (url, err))
+            continue
+        if detection is not None:
+            return detection
+    return None
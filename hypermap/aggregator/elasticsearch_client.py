@@ -7,10 +7,11 @@ from urlparse import urlparse
 from django.conf import settings
 from django.utils.html import strip_tags
 
-from elasticsearch import Elasticsearch
+from elasticsearch import helpers
 from shapely.geometry import box
 
-from hypermap.aggregator.utils import mercator_to_llbbox, get_date
+from hypermap.aggregator.utils import mercator_to_llbbox, get_date, get_layers_check_stats
+from hypermap.aggregator.search_client import get_elasticsearch, get_es_capabilities, is_index_missing_error
 
 REGISTRY_MAPPING_PRECISION = getattr(settings, "REGISTRY_MAPPING_PRECISION", "500m")
 REGISTRY_SEARCH_URL = getattr(settings, "REGISTRY_SEARCH_URL", "elasticsearch+http://localhost:9200")
@@ -21,10 +22,19 @@ SEARCH_URL = REGISTRY_SEARCH_URL.split('+')[1]
 LOGGER = logging.getLogger(__name__)
 
 
+class ESClient(object):
+    """
+    Get the pooled Elasticsearch client of the current process when ESHypermap.es is used.
+    """
+
+    def __get__(self, instance, owner):
+        return get_elasticsearch(owner.es_url)
+
+
 class ESHypermap(object):
 
     es_url = SEARCH_URL
-    es = Elasticsearch(hosts=[es_url])
+    es = ESClient()
     index_name = 'hypermap'
 
     def __init__(self):
@@ -88,15 +98,31 @@ class ESHypermap(object):
         return (-180.0, -90.0, 180.0, 90.0)
 
     @staticmethod
-    def layer_to_es(layer, with_bulk=False):
+    def layers_to_es(layers):
+        """
+        Return the bulk actions to index n layers, skipping the layers that cannot be serialized.
+        Use hypermap.aggregator.utils.get_layers_for_indexing to build the layers queryset,
+        so that the related objects are not fetched for each layer.
+        """
+        check_stats = get_layers_check_stats([layer.id for layer in layers])
+        es_records = []
+        for layer in layers:
+            es_record = ESHypermap.layer_to_es(layer, with_bulk=True, check_stats=check_stats[layer.id])
+            if isinstance(es_record, dict):
+                es_records.append(es_record)
+        return es_records
+
+    @staticmethod
+    def layer_to_es(layer, with_bulk=False, check_stats=None):
         category = None
         username = None
         LOGGER.info("Elasticsearch: record to save: [%s] %s" % (layer.catalog.slug, layer.id))
 
         try:
             bbox = ESHypermap.get_bbox(layer)
-            for proj in layer.service.srs.values():
-                if proj['code'] in ('102113', '102100'):
+            srs_codes = [srs.code for srs in layer.service.srs.all()]
+            for code in srs_codes:
+                if code in ('102113', '102100'):
                     bbox = mercator_to_llbbox(bbox)
             if (ESHypermap.good_coords(bbox)) is False:
                 LOGGER.debug('Elasticsearch: There are not valid coordinates for this layer ', layer.title)
@@ -137,6 +163,12 @@ class ESHypermap(object):
                     originator = username
                 else:
                     originator = domain
+                if check_stats is None:
+                    check_stats = {
+                        'reliability': layer.reliability,
+                        'recent_reliability': layer.recent_reliability,
+                        'last_status': layer.last_status,
+                    }
                 # we need to remove the exising index in case there is already one
                 # ESHypermap.es.delete('hypermap', 'layer', layer.id)
                 # now we add the index
@@ -153,9 +185,9 @@ class ESHypermap(object):
                     "layer_username": username,
                     "url": layer.url,
                     "keywords": [kw.name for kw in layer.keywords.all()],
-                    "reliability": layer.reliability,
-                    "recent_reliability": layer.recent_reliability,
-                    "last_status": layer.last_status,
+                    "reliability": check_stats['reliability'],
+                    "recent_reliability": check_stats['recent_reliability'],
+                    "last_status": check_stats['last_status'],
                     "is_public": layer.is_public,
                     "availability": "Online",
                     "location": {
@@ -172,7 +204,11 @@ class ESHypermap(object):
                     "bbox": wkt,
                     "centroid_x": rectangle.centroid.x,
                     "centroid_y": rectangle.centroid.y,
-                    "srs": [srs.encode('utf-8') for srs in layer.service.srs.values_list('code', flat=True)],
+                    "layer_centroid": {
+                        "lat": rectangle.centroid.y,
+                        "lon": rectangle.centroid.x
+                    },
+                    "srs": [code.encode('utf-8') for code in srs_codes],
                     "layer_geoshape": {
                        "type": "envelope",
                        "coordinates": [
@@ -200,11 +236,15 @@ class ESHypermap(object):
                     }
 
                 LOGGER.info(es_record)
-                # TODO: cache index creation.
-                ESHypermap.create_indices(layer.catalog.slug)
+                ESHypermap.ensure_indices(layer.catalog.slug)
                 if not with_bulk:
-                    ESHypermap.es.index(layer.catalog.slug, 'layer', json.dumps(es_record), id=layer.id,
-                                        request_timeout=20)
+                    try:
+                        ESHypermap.es.index(layer.catalog.slug, 'layer', json.dumps(es_record), id=layer.id,
+                                            request_timeout=20)
+                    except Exception as e:
+                        if is_index_missing_error(e):
+                            ESHypermap.capabilities().invalidate(layer.catalog.slug)
+                        raise
                     LOGGER.info("Elasticsearch: record saved for layer with id: %s" % layer.id)
                     return True, None
 
@@ -217,13 +257,46 @@ class ESHypermap(object):
                          layer.id, sys.exc_info()[1]))
             return False, sys.exc_info()[1]
 
+    @staticmethod
+    def remove_layers(layers_ids, catalog_slug, chunk_size=500):
+        """
+        Remove n layers from a catalog index, sending the delete actions in _bulk requests of chunk_size.
+        :return: True if all the layers were removed or were not in the index.
+        """
+        actions = [
+            {"_op_type": "delete", "_index": catalog_slug, "_type": "layer", "_id": str(layer_id)}
+            for layer_id in layers_ids
+        ]
+        success, errors = helpers.bulk(ESHypermap.es, actions, chunk_size=chunk_size, raise_on_error=False)
+        # deleting a layer which is not in the index is not an error
+        errors = [error for error in errors if error.get('delete', {}).get('status') != 404]
+        for error in errors:
+            LOGGER.error('Elasticsearch: Error removing layer: %s' % error)
+        LOGGER.debug('Elasticsearch: %s layers removed from %s' % (success, catalog_slug))
+        return not errors
+
     @staticmethod
     def clear_es():
         """Clear all indexes in the es core"""
         # TODO: should receive a catalog slug.
         ESHypermap.es.indices.delete(ESHypermap.index_name, ignore=[400, 404])
+        ESHypermap.capabilities().invalidate(ESHypermap.index_name)
         LOGGER.debug('Elasticsearch: Index cleared')
 
+    @staticmethod
+    def capabilities():
+        """
+        Cached version and indices of the cluster.
+        """
+        return get_es_capabilities(ESHypermap.es_url)
+
+    @staticmethod
+    def ensure_indices(catalog_slug):
+        """
+        Create the catalog indices, unless they were created or checked recently by this process.
+        """
+        ESHypermap.capabilities().ensure_index(catalog_slug, ESHypermap.create_indices)
+
     @staticmethod
     def create_indices(catalog_slug):
         """Create ES core indices """
@@ -239,9 +312,20 @@ class ESHypermap(object):
                            "type": "geo_shape",
                            "tree": "quadtree",
                            "precision": REGISTRY_MAPPING_PRECISION
+                        },
+                        "layer_centroid": {
+                            "type": "geo_point"
+                        },
+                        "layer_id": {
+                            "type": "long"
                         }
                     }
                 }
             }
         }
         ESHypermap.es.indices.create(catalog_slug, ignore=[400, 404], body=mapping)
+        # add the fields mapped since to an existing index
+        ESHypermap.es.indices.put_mapping(
+            index=catalog_slug, doc_type='layer', ignore=[400, 404],
+            body={"properties": {"layer_centroid": mapping["mappings"]["layer"]["properties"]["layer_centroid"]}}
+        )
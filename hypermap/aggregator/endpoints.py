@@ -0,0 +1,163 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from hypermap.aggregator.governor import CircuitOpenError, governed, get_host
+from hypermap.aggregator.harvesting import chunks
+from hypermap.aggregator.workers import WorkerPool
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_ENDPOINT_BATCH_SIZE = getattr(settings, 'REGISTRY_ENDPOINT_BATCH_SIZE', 500)
+REGISTRY_ENDPOINT_THREADS = getattr(settings, 'REGISTRY_ENDPOINT_THREADS', 8)
+REGISTRY_ENDPOINT_HOST_CONCURRENCY = getattr(settings, 'REGISTRY_ENDPOINT_HOST_CONCURRENCY', 2)
+
+# max_length of Endpoint.url
+MAX_URL_LENGTH = 255
+
+
+def read_endpoint_urls(lines):
+    """
+    Yield the urls of the lines of an endpoint list file, read one at a time.
+    """
+    for line in lines:
+        url = line.strip()
+        if not url:
+            continue
+        if len(url) > MAX_URL_LENGTH:
+            LOGGER.debug('Skipping this endpoint, as it is more than %s characters: %s' % (MAX_URL_LENGTH, url))
+            continue
+        yield url
+
+
+def create_endpoints(endpoint_list, urls):
+    """
+    Create the endpoints of urls with a bulk_create, falling back to one insert per endpoint
+    if some of them were created in the meanwhile.
+    """
+    from hypermap.aggregator.models import Endpoint
+
+    endpoints = [Endpoint(url=url, endpoint_list=endpoint_list, catalog=endpoint_list.catalog) for url in urls]
+    try:
+        with transaction.atomic():
+            Endpoint.objects.bulk_create(endpoints)
+        return len(endpoints)
+    except IntegrityError:
+        LOGGER.debug('Creating %s endpoints one by one' % len(endpoints))
+    created = 0
+    for endpoint in endpoints:
+        try:
+            with transaction.atomic():
+                endpoint.save()
+            created += 1
+        except IntegrityError:
+            pass
+    return created
+
+
+def import_endpoint_list(endpoint_list, batch_size=None):
+    """
+    Stream the file of an endpoint list and create its new endpoints, batch_size at a time.
+    Urls are deduplicated in memory, against the urls of the catalog fetched with a single query.
+    Endpoints are created without sending their signals: they are processed by process_endpoints.
+    :return: number of created endpoints.
+    """
+    from hypermap.aggregator.models import Endpoint, EndpointList
+
+    batch_size = batch_size or REGISTRY_ENDPOINT_BATCH_SIZE
+    # the urls of endpoints created before the urls were stripped may end with a newline
+    seen = set(url.strip() for url in Endpoint.objects.filter(
+        catalog=endpoint_list.catalog).values_list('url', flat=True))
+    created = 0
+    batch = []
+    with open(endpoint_list.upload.file.name, mode='rb') as f:
+        for url in read_endpoint_urls(f):
+            if url in seen:
+                continue
+            seen.add(url)
+            batch.append(url)
+            if len(batch) == batch_size:
+                created += create_endpoints(endpoint_list, batch)
+                batch = []
+    if batch:
+        created += create_endpoints(endpoint_list, batch)
+
+    endpoints_count = endpoint_list.endpoint_set.count()
+    endpoint_list.endpoints_count = endpoints_count
+    # update does not send the endpoint list signals
+    EndpointList.objects.filter(id=endpoint_list.id).update(endpoints_count=endpoints_count)
+    LOGGER.debug('Created %s endpoints from endpoint list id %s' % (created, endpoint_list.id))
+    return created
+
+
+def process_endpoint(endpoint_id, url, catalog, greedy):
+    """
+    Create the services of an endpoint and store the result in the endpoint.
+    The endpoint is left unprocessed if its host is suspended by the governor.
+    :return: True if services were imported, None if the endpoint was not processed.
+    """
+    from hypermap.aggregator.models import Endpoint
+    from hypermap.aggregator.utils import create_services_from_endpoint
+
+    LOGGER.debug('Processing endpoint with id %s: %s' % (endpoint_id, url))
+    try:
+        with governed(url):
+            imported, message = create_services_from_endpoint(url, greedy_opt=greedy, catalog=catalog)
+    except CircuitOpenError as err:
+        LOGGER.debug('Postponing endpoint %s: %s' % (url, err))
+        return None
+    except Exception as err:
+        LOGGER.error('Error processing endpoint %s: %s' % (url, err), exc_info=True)
+        imported, message = False, str(err)
+    # this update will not execute the endpoint_post_save signal.
+    Endpoint.objects.filter(id=endpoint_id).update(imported=imported, message=message, processed=True)
+    return bool(imported)
+
+
+def process_endpoints(endpoint_list, threads=None, host_concurrency=None, chunk_size=None):
+    """
+    Create the services of the unprocessed endpoints of an endpoint list with a pool of threads,
+    probing at most host_concurrency endpoints of the same host at a time.
+    Progress is stored in the processed_count and imported_count of the endpoint list after each chunk.
+    :return: number of endpoints left unprocessed, as their host is suspended.
+    """
+    from hypermap.aggregator.models import EndpointList
+
+    threads = threads or REGISTRY_ENDPOINT_THREADS
+    host_concurrency = host_concurrency or REGISTRY_ENDPOINT_HOST_CONCURRENCY
+    chunk_size = chunk_size or REGISTRY_ENDPOINT_BATCH_SIZE
+    postponed = 0
+    endpoints = list(endpoint_list.endpoint_set.filter(processed=False).order_by('id').values_list('id', 'url'))
+    catalog = endpoint_list.catalog
+
+    semaphores = {}
+    for endpoint_id, url in endpoints:
+        host = get_host(url)
+        if host not in semaphores:
+            semaphores[host] = threading.BoundedSemaphore(host_concurrency)
+
+    def run(endpoint):
+        endpoint_id, url = endpoint
+        with semaphores[get_host(url)]:
+            return process_endpoint(endpoint_id, url, catalog, endpoint_list.greedy)
+
+    with WorkerPool(min(threads, len(endpoints))) as pool:
+        for chunk in chunks(endpoints, chunk_size):
+            results = pool.map(run, chunk)
+            processed = [result for result in results if result is not None]
+            postponed += len(results) - len(processed)
+            EndpointList.objects.filter(id=endpoint_list.id).update(
+                processed_count=F('processed_count') + len(processed),
+                imported_count=F('imported_count') + len([result for result in processed if result]),
+            )
+            LOGGER.debug('Processed %s endpoints of endpoint list id %s' % (len(processed), endpoint_list.id))
+    if postponed:
+        LOGGER.debug('Postponed %s endpoints of endpoint list id %s' % (postponed, endpoint_list.id))
+    else:
+        EndpointList.objects.filter(id=endpoint_list.id).update(processed_datetime=timezone.now())
+    return postponed
@@ -39,3 +39,19 @@ DATE_TYPES = (
     (DATE_DETECTED, 'Detected'),
     (DATE_FROM_METADATA, 'From Metadata'),
 )
+
+INDEX_UPSERT = 'upsert'
+INDEX_DELETE = 'delete'
+
+INDEX_OPERATIONS = (
+    (INDEX_UPSERT, 'Add or update'),
+    (INDEX_DELETE, 'Remove'),
+)
+
+ROLLUP_HOUR = 'hour'
+ROLLUP_DAY = 'day'
+
+ROLLUP_PERIODS = (
+    (ROLLUP_HOUR, 'Hour'),
+    (ROLLUP_DAY, 'Day'),
+)
@@ -0,0 +1,179 @@
+import urllib
+import hashlib
+import logging
+import urlparse
+
+import requests
+
+from django.conf import settings
+from django.core.cache import cache
+
+from hypermap.aggregator.governor import CircuitOpenError, governed
+from hypermap.aggregator.workers import WorkerPool
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_ESRI_THREADS = getattr(settings, 'REGISTRY_ESRI_THREADS', 8)
+REGISTRY_DETECTED_CAPABILITIES_TIMEOUT = getattr(settings, 'REGISTRY_DETECTED_CAPABILITIES_TIMEOUT', 600)
+
+# the harvested ArcGIS REST services
+SERVICE_TYPES = {
+    'MapServer': 'ESRI:ArcGIS:MapServer',
+    'ImageServer': 'ESRI:ArcGIS:ImageServer',
+}
+
+
+def get_resource_url(url, path=''):
+    """
+    The JSON url of the ArcGIS REST resource at path, relative to the resource of url, as arcrest builds it:
+    http://example.com/arcgis/rest/services/myservice/MapServer/?f=json
+    """
+    parts = urlparse.urlsplit(url)
+    base = parts.path if parts.path.endswith('/') else parts.path + '/'
+    query = [(key, value) for key, value in urlparse.parse_qsl(parts.query) if key != 'f']
+    query.append(('f', 'json'))
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, base + path, urllib.urlencode(query), ''))
+
+
+def get_json(url, timeout=30):
+    """
+    The JSON of an ArcGIS REST resource url, see get_resource_url.
+    :raise ValueError: if the server returns an error, as it does with a 200 status code.
+    """
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    if 'error' in data:
+        raise ValueError('ArcGIS REST error for %s: %s' % (url, data['error'].get('message')))
+    return data
+
+
+def get_json_or_none(url):
+    """
+    The JSON of an ArcGIS REST resource url requested through the governor of its host, or None if it fails.
+    :raise CircuitOpenError: if the requests to the host are suspended.
+    """
+    try:
+        with governed(url):
+            return get_json(url)
+    except CircuitOpenError:
+        raise
+    except Exception as err:
+        LOGGER.warning('Cannot request %s: %s' % (url, err))
+        return None
+
+
+def get_service_json_key(url):
+    return 'esri_service_json:%s' % hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def store_service_json(url, data):
+    """
+    Keep the JSON of a crawled service, so that its first harvest does not download it again.
+    """
+    cache.set(get_service_json_key(url), data, REGISTRY_DETECTED_CAPABILITIES_TIMEOUT)
+
+
+def get_service_json(url):
+    """
+    The JSON of a service, kept by the crawler or requested.
+    """
+    key = get_service_json_key(url)
+    data = cache.get(key)
+    if data is not None:
+        cache.delete(key)
+        LOGGER.debug('Using the JSON downloaded by the crawl of %s' % url)
+        return data
+    return get_json(get_resource_url(url))
+
+
+def crawl_folders(endpoint, pool=None):
+    """
+    Walk the folder tree of an ArcGIS REST endpoint breadth-first, the folders of a level being requested
+    concurrently.
+    :param pool: a WorkerPool.
+    :return: list of (url, service type) of the MapServer and ImageServer services.
+    """
+    pool = pool or WorkerPool(1)
+    services = []
+    level = [get_resource_url(endpoint)]
+    seen = set(level)
+    while level:
+        LOGGER.debug('Crawling %s ArcGIS REST folders' % len(level))
+        next_level = []
+        for folder_url, data in zip(level, pool.map(get_json_or_none, level)):
+            if data is None:
+                continue
+            for folder in data.get('folders', []):
+                url = get_resource_url(folder_url, '%s/' % folder.strip('/').split('/')[-1])
+                if url not in seen:
+                    seen.add(url)
+                    next_level.append(url)
+            for service in data.get('services', []):
+                if service.get('type') in SERVICE_TYPES:
+                    name = service['name'].rstrip('/').split('/')[-1]
+                    url = get_resource_url(folder_url, '%s/%s/' % (name, service['type']))
+                    services.append((url, SERVICE_TYPES[service['type']]))
+        level = next_level
+    return services
+
+
+def create_esri_service(url, service_type, data, catalog):
+    """
+    Create the service of a crawled MapServer or ImageServer, from its JSON.
+    :return: the service, or None.
+    """
+    from hypermap.aggregator.utils import create_service_from_endpoint
+
+    if service_type == 'ESRI:ArcGIS:MapServer':
+        # we import only MapServer with at least one layer
+        if not data.get('layers'):
+            return None
+        title, abstract = data.get('mapName'), data.get('description')
+    else:
+        title, abstract = '', data.get('serviceDescription')
+    store_service_json(url, data)
+    return create_service_from_endpoint(url, service_type, title, abstract, catalog=catalog, check_endpoint=False)
+
+
+def crawl_esri(endpoint, catalog, threads=None):
+    """
+    Create the services of an ArcGIS REST endpoint and of all its folders.
+    Folders and services are requested with a pool of threads, and the JSON of each service is kept for
+    its first harvest. Services are created one at a time.
+    :return: list of the created services.
+    """
+    threads = threads or REGISTRY_ESRI_THREADS
+    with WorkerPool(threads) as pool:
+        services = crawl_folders(endpoint, pool)
+        LOGGER.debug('Found %s ArcGIS REST services at %s' % (len(services), endpoint))
+        services_json = pool.map(get_json_or_none, [url for url, service_type in services])
+    created = []
+    for (url, service_type), data in zip(services, services_json):
+        if data is None:
+            continue
+        try:
+            service = create_esri_service(url, service_type, data, catalog)
+        except Exception as err:
+            LOGGER.error('Could not create service for %s : %s' % (service_type, url))
+            LOGGER.error(err, exc_info=True)
+            continue
+        if service is not None:
+            created.append(service)
+    return created
+
+
+def get_layers_json(url, service_json, threads=None):
+    """
+    The JSON of the layers of a MapServer, with a single request to its /layers resource, or with one request
+    per layer, with a pool of threads, for the servers which do not support it (before ArcGIS Server 10).
+    Layers returning an error are skipped.
+    """
+    try:
+        return get_json(get_resource_url(url, 'layers')).get('layers', [])
+    except Exception as err:
+        LOGGER.debug('Cannot request the layers of %s at once: %s' % (url, err))
+    urls = [get_resource_url(url, '%s/' % layer['id']) for layer in service_json.get('layers', [])]
+    with WorkerPool(min(threads or REGISTRY_ESRI_THREADS, len(urls))) as pool:
+        return [layer for layer in pool.map(get_json_or_none, urls) if layer is not None]
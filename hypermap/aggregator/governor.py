@@ -0,0 +1,151 @@
+import time
+import socket
+import threading
+import httplib
+import logging
+import urllib2
+import urlparse
+from contextlib import contextmanager
+
+import requests
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_HOST_RATE_LIMIT = getattr(settings, 'REGISTRY_HOST_RATE_LIMIT', 10)
+REGISTRY_HOST_FAILURE_THRESHOLD = getattr(settings, 'REGISTRY_HOST_FAILURE_THRESHOLD', 5)
+REGISTRY_HOST_COOLDOWN = getattr(settings, 'REGISTRY_HOST_COOLDOWN', 300)
+
+# errors telling that a host is down or does not answer, as opposed to errors in its content
+HOST_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    urllib2.URLError,
+    httplib.HTTPException,
+    socket.error,
+    socket.timeout,
+)
+
+
+def get_host(url):
+    return urlparse.urlparse(url or '').netloc.lower()
+
+
+def is_host_error(host, error):
+    """
+    True if error tells that host is down or does not answer.
+    Errors of requests sent to other hosts (for example a GetMap url advertised by a WMS
+    capabilities document) do not count.
+    """
+    if not isinstance(error, HOST_ERRORS):
+        return False
+    request = getattr(error, 'request', None)
+    if request is not None and getattr(request, 'url', None):
+        return get_host(request.url) == host
+    return True
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to a host which failed too many times in a row.
+    """
+
+
+class HostGovernor(object):
+    """
+    Coordinates the outbound requests of all the workers sharing the Django cache, per host.
+    Each governed block (a harvest, a service check, a layer check) counts as one request:
+    - at most rate_limit requests are sent to a host in each second, the extra requests wait
+      for the next second (a fixed window counter, updated with the atomic cache.incr);
+    - after failure_threshold consecutive host errors the circuit of the host is open for cooldown
+      seconds, during which requests raise CircuitOpenError without being sent.
+    A rate_limit or failure_threshold of 0 disables the corresponding feature.
+    A block governed within a block of the same host in the same thread, such as a page of a harvest
+    requested by the thread which started the harvest, is part of the outer request and not counted again.
+    """
+
+    key_prefix = 'governor'
+
+    def __init__(self, rate_limit=REGISTRY_HOST_RATE_LIMIT, failure_threshold=REGISTRY_HOST_FAILURE_THRESHOLD,
+                 cooldown=REGISTRY_HOST_COOLDOWN):
+        self.rate_limit = rate_limit
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        # the hosts of the governed blocks of each thread
+        self._local = threading.local()
+
+    def _key(self, kind, host, *args):
+        return ':'.join([self.key_prefix, kind, host] + [str(arg) for arg in args])
+
+    def _incr(self, key, timeout):
+        cache.add(key, 0, timeout)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # the key expired between add and incr
+            cache.add(key, 1, timeout)
+            return 1
+
+    def acquire(self, host):
+        """
+        Wait until a request can be sent to host without exceeding the rate limit.
+        """
+        if not self.rate_limit:
+            return
+        while True:
+            now = time.time()
+            window = int(now)
+            if self._incr(self._key('rate', host, window), 2) <= self.rate_limit:
+                return
+            time.sleep(window + 1 - now)
+
+    def is_open(self, host):
+        return bool(self.failure_threshold) and bool(cache.get(self._key('open', host)))
+
+    def record_success(self, host):
+        cache.delete(self._key('failures', host))
+
+    def record_failure(self, host):
+        if not self.failure_threshold:
+            return
+        failures = self._incr(self._key('failures', host), self.cooldown)
+        if failures >= self.failure_threshold:
+            LOGGER.warning('Opening the circuit of host %s for %s seconds after %s failures' % (
+                host, self.cooldown, failures))
+            cache.set(self._key('open', host), True, self.cooldown)
+            cache.delete(self._key('failures', host))
+
+    @contextmanager
+    def governed(self, url):
+        """
+        Wrap the requests sent to the host of url.
+        """
+        host = get_host(url)
+        hosts = self._local.__dict__.setdefault('hosts', set())
+        if host in hosts:
+            yield
+            return
+        if self.is_open(host):
+            raise CircuitOpenError(
+                'Requests to %s are suspended for up to %s seconds after %s consecutive failures' % (
+                    host, self.cooldown, self.failure_threshold)
+            )
+        self.acquire(host)
+        hosts.add(host)
+        try:
+            yield
+        except Exception as err:
+            if is_host_error(host, err):
+                self.record_failure(host)
+            raise
+        else:
+            self.record_success(host)
+        finally:
+            hosts.discard(host)
+
+
+governor = HostGovernor()
+governed = governor.governed
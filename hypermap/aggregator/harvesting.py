@@ -0,0 +1,307 @@
+import logging
+import operator
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Case, When, Value, F, Q
+from django.utils import timezone
+
+
+LOGGER = logging.getLogger(__name__)
+
+# the Layer fields written by the harvesters
+LAYER_HARVEST_FIELDS = (
+    'type', 'title', 'abstract', 'url', 'page_url', 'is_public',
+    'bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1', 'wkt_geometry', 'xml', 'anytext',
+    'harvest_hash', 'is_valid', 'last_updated',
+)
+
+LAYER_WM_FIELDS = ('category', 'username', 'temporal_extent_start', 'temporal_extent_end')
+
+
+def chunks(items, size):
+    """
+    Split a list in lists of at most size items.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class HarvestedLayer(object):
+    """
+    A layer read from a remote service, to be written by bulk_upsert_layers.
+    :param lookup: the fields identifying the layer in its service, for example {'name': name}.
+    :param data: the remote layer, passed to the update function of bulk_upsert_layers.
+    :param harvest_hash: hash of the harvested values, the layer is not updated if it did not change.
+    :param keywords: keywords of the layer.
+    :param dates: metadata dates of the layer, see add_metadata_dates_to_layer.
+    :param wm: LayerWM values of a WorldMap layer.
+    """
+
+    def __init__(self, lookup, data, harvest_hash=None, keywords=None, dates=None, wm=None):
+        self.lookup = lookup
+        self.data = data
+        self.harvest_hash = harvest_hash
+        self.keywords = keywords or []
+        self.dates = dates or []
+        self.wm = wm
+
+
+def bulk_update(model, objs, fields, chunk_size=100):
+    """
+    Write fields of objs with one UPDATE ... SET field = CASE id WHEN ... query per chunk.
+    Does not send the model signals.
+    """
+    if not objs:
+        return
+    model_fields = [model._meta.get_field(name) for name in fields]
+    # each object takes two parameters per field, and one in the where clause
+    batch_size = connection.ops.bulk_batch_size(list(fields) * 2 + ['pk'], objs)
+    for chunk in chunks(objs, max(1, min(chunk_size, batch_size))):
+        values = {}
+        for field in model_fields:
+            values[field.attname] = Case(
+                *[When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in chunk],
+                default=F(field.attname),
+                output_field=field
+            )
+        model.objects.filter(pk__in=[obj.pk for obj in chunk]).update(**values)
+
+
+def get_or_create_tags(names, chunk_size=200):
+    """
+    Return a dictionary of the taggit tags of names, creating the missing ones with a bulk_create.
+    Names are matched like TaggableManager.add does, ignoring the case with TAGGIT_CASE_INSENSITIVE.
+    """
+    from taggit.models import Tag
+
+    if getattr(settings, 'TAGGIT_CASE_INSENSITIVE', False):
+        def normalize(name):
+            return name.lower()
+
+        def query(names):
+            return reduce(operator.or_, [Q(name__iexact=name) for name in names])
+    else:
+        def normalize(name):
+            return name
+
+        def query(names):
+            return Q(name__in=names)
+
+    wanted = OrderedDict()
+    for name in names:
+        wanted.setdefault(normalize(name), name)
+    tags = {}
+    for chunk in chunks(list(wanted), chunk_size):
+        for tag in Tag.objects.filter(query(chunk)):
+            tags.setdefault(normalize(tag.name), tag)
+
+    missing = [name for key, name in wanted.items() if key not in tags]
+    if missing:
+        new_tags = [Tag(name=name, slug=Tag().slugify(name)) for name in missing]
+        used_slugs = set()
+        for chunk in chunks([tag.slug for tag in new_tags], chunk_size):
+            used_slugs.update(Tag.objects.filter(slug__in=chunk).values_list('slug', flat=True))
+        for tag in new_tags:
+            i = 1
+            slug = tag.slug
+            while slug in used_slugs:
+                slug = tag.slugify(tag.name, i)
+                i += 1
+            tag.slug = slug
+            used_slugs.add(slug)
+        try:
+            with transaction.atomic():
+                Tag.objects.bulk_create(new_tags)
+        except IntegrityError:
+            # a tag or slug was created in the meanwhile, fall back to the taggit way
+            LOGGER.debug('Creating %s tags one by one' % len(missing))
+            for name in missing:
+                tag = Tag.objects.filter(query([name])).first()
+                if tag is None:
+                    tag = Tag.objects.create(name=name)
+                tags[normalize(name)] = tag
+        else:
+            for chunk in chunks(missing, chunk_size):
+                for tag in Tag.objects.filter(name__in=chunk):
+                    tags[normalize(tag.name)] = tag
+    return dict((key, tags[key]) for key in wanted)
+
+
+def set_layers_keywords(layers_keywords, replace=False, chunk_size=500):
+    """
+    Tag layers with keywords, inserting the missing tagged items with a bulk_create.
+    :param layers_keywords: dictionary of keyword lists by layer id.
+    :param replace: also remove the keywords of the layers which are not in their list.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from hypermap.aggregator.models import Layer
+
+    through = Layer._meta.get_field('keywords').through
+    content_type = ContentType.objects.get_for_model(Layer)
+    tags = get_or_create_tags([name for names in layers_keywords.values() for name in names])
+    case_insensitive = getattr(settings, 'TAGGIT_CASE_INSENSITIVE', False)
+
+    wanted = set()
+    for layer_id, names in layers_keywords.items():
+        for name in names:
+            wanted.add((layer_id, tags[name.lower() if case_insensitive else name].id))
+
+    existing = set()
+    obsolete = []
+    for chunk in chunks(list(layers_keywords), chunk_size):
+        items = through.objects.filter(content_type=content_type, object_id__in=chunk)
+        for item_id, layer_id, tag_id in items.values_list('id', 'object_id', 'tag_id'):
+            existing.add((layer_id, tag_id))
+            if (layer_id, tag_id) not in wanted:
+                obsolete.append(item_id)
+
+    if replace:
+        for chunk in chunks(obsolete, chunk_size):
+            through.objects.filter(id__in=chunk).delete()
+    through.objects.bulk_create([
+        through(content_type=content_type, object_id=layer_id, tag_id=tag_id)
+        for layer_id, tag_id in wanted - existing
+    ])
+
+
+def add_layers_dates(layers_dates, chunk_size=500):
+    """
+    Insert the missing LayerDate rows with a bulk_create.
+    :param layers_dates: dictionary of (date, type) lists by layer id.
+    """
+    from hypermap.aggregator.models import LayerDate
+
+    existing = set()
+    for chunk in chunks(list(layers_dates), chunk_size):
+        existing.update(LayerDate.objects.filter(layer_id__in=chunk).values_list('layer_id', 'date', 'type'))
+    new_dates = []
+    for layer_id, dates in layers_dates.items():
+        for date, date_type in dates:
+            if (layer_id, date, date_type) not in existing:
+                existing.add((layer_id, date, date_type))
+                new_dates.append(LayerDate(layer_id=layer_id, date=date, type=date_type))
+    LayerDate.objects.bulk_create(new_dates)
+
+
+def save_layers_wm(layers_wm, chunk_size=500):
+    """
+    Create or update the LayerWM rows of WorldMap layers.
+    :param layers_wm: dictionary of LayerWM values by layer id.
+    """
+    from hypermap.aggregator.models import LayerWM
+
+    existing = {}
+    for chunk in chunks(list(layers_wm), chunk_size):
+        for layer_wm in LayerWM.objects.filter(layer_id__in=chunk):
+            existing[layer_wm.layer_id] = layer_wm
+    new_layers_wm = []
+    changed_layers_wm = []
+    for layer_id, values in layers_wm.items():
+        layer_wm = existing.get(layer_id)
+        if layer_wm is None:
+            new_layers_wm.append(LayerWM(layer_id=layer_id, **values))
+        elif any(getattr(layer_wm, name) != value for name, value in values.items()):
+            for name, value in values.items():
+                setattr(layer_wm, name, value)
+            changed_layers_wm.append(layer_wm)
+    LayerWM.objects.bulk_create(new_layers_wm)
+    bulk_update(LayerWM, changed_layers_wm, LAYER_WM_FIELDS)
+
+
+def bulk_upsert_layers(service, harvested, update, replace_keywords=False):
+    """
+    Write the harvested layers of a service with a few queries per batch of layers, instead of
+    the get_or_create, save and tagging queries of each layer:
+    the existing layers of the batch are read with one query per chunk of their lookup values
+    and diffed in memory against the harvested ones,
+    the new ones are created with a bulk_create, the changed ones are written with bulk_update,
+    and their keywords, dates and WorldMap attributes are inserted in bulk as well.
+    Layer signals are not sent: validity is computed here as in layer_pre_save.
+    :param harvested: list of HarvestedLayer.
+    :param update: function(layer, data) setting the harvested values of an active layer.
+    :param replace_keywords: remove the keywords which are not harvested anymore.
+    :return: the list of the updated layers.
+    """
+    from hypermap.aggregator.models import (Layer, get_layer_validity, get_layer_mined_dates,
+                                            get_metadata_dates)
+
+    if not harvested:
+        return []
+    lookup_fields = sorted(harvested[0].lookup)
+
+    def get_key(values):
+        return tuple(unicode(values[name]) for name in lookup_fields)
+
+    records = OrderedDict()
+    for record in harvested:
+        records[get_key(record.lookup)] = record
+
+    def get_layers(keys):
+        # only read the layers of these records, a service may have many more:
+        # each field is filtered on the values of a chunk of records, the full key is matched in memory
+        queryset = Layer.objects.filter(service=service, catalog=service.catalog)
+        candidates = []
+        for chunk in chunks(keys, 500):
+            lookups = [records[key].lookup for key in chunk]
+            filters = []
+            for name in lookup_fields:
+                values = set(lookup[name] for lookup in lookups)
+                # __in does not match null values
+                condition = Q(**{'%s__in' % name: values - set([None])})
+                if None in values:
+                    condition |= Q(**{'%s__isnull' % name: True})
+                filters.append(condition)
+            candidates.extend(queryset.filter(*filters))
+        layers = {}
+        # the oldest layer wins if several have the same key
+        for layer in sorted(candidates, key=lambda layer: layer.id):
+            key = get_key(layer.__dict__)
+            if key in records:
+                layer.service = service
+                layer.catalog = service.catalog
+                layers.setdefault(key, layer)
+        return layers
+
+    # 1. create the new layers, which need an id before their harvested values are set
+    layers = get_layers(list(records))
+    new_keys = [key for key in records if key not in layers]
+    if new_keys:
+        Layer.objects.bulk_create([Layer(service=service, catalog=service.catalog, **records[key].lookup)
+                                   for key in new_keys])
+        layers.update(get_layers(new_keys))
+        LOGGER.debug('Added %s new layers to service id %s' % (len(new_keys), service.id))
+
+    # 2. set the harvested values in memory
+    updated = []
+    layers_keywords = {}
+    layers_dates = {}
+    layers_wm = {}
+    now = timezone.now()
+    for key, record in records.items():
+        layer = layers[key]
+        if not layer.active:
+            continue
+        if record.harvest_hash is not None and layer.harvest_hash == record.harvest_hash:
+            continue
+        update(layer, record.data)
+        layer.harvest_hash = record.harvest_hash
+        layer.is_valid = get_layer_validity(layer)
+        layer.last_updated = now
+        updated.append(layer)
+        layers_keywords[layer.id] = [keyword for keyword in record.keywords if keyword]
+        layers_dates[layer.id] = (
+            [(date, 0) for date in get_layer_mined_dates(layer)] +
+            [(date, 1) for date in get_metadata_dates(record.dates)]
+        )
+        if record.wm is not None:
+            layers_wm[layer.id] = record.wm
+
+    # 3. write them
+    bulk_update(Layer, updated, LAYER_HARVEST_FIELDS)
+    set_layers_keywords(layers_keywords, replace=replace_keywords)
+    add_layers_dates(layers_dates)
+    save_layers_wm(layers_wm)
+    LOGGER.debug('Updated %s layers of service id %s' % (len(updated), service.id))
+    return updated
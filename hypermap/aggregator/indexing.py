@@ -0,0 +1,267 @@
+import time
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
+
+from hypermap.aggregator.enums import INDEX_UPSERT
+from hypermap.aggregator.search_cache import bump_index_generation
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_SEARCH_URL = getattr(settings, 'REGISTRY_SEARCH_URL', None)
+REGISTRY_SEARCH_BATCH_SIZE = getattr(settings, 'REGISTRY_SEARCH_BATCH_SIZE', 50)
+REGISTRY_SEARCH_INDEX_WINDOW = getattr(settings, 'REGISTRY_SEARCH_INDEX_WINDOW', 4)
+
+if REGISTRY_SEARCH_URL is None:
+    SEARCH_TYPE = None
+else:
+    SEARCH_TYPE = REGISTRY_SEARCH_URL.split('+')[0]
+
+
+def serialize_layers(layer_ids):
+    """
+    Convert a batch of layers to search backend documents.
+    """
+    from hypermap.aggregator.utils import get_layers_for_indexing
+
+    layers = get_layers_for_indexing(layer_ids)
+    if SEARCH_TYPE == 'solr':
+        from hypermap.aggregator.solr import SolrHypermap
+        documents, layers_errors_ids = SolrHypermap().layers_to_dicts(layers)
+        return documents
+    elif SEARCH_TYPE == 'elasticsearch':
+        from hypermap.aggregator.elasticsearch_client import ESHypermap
+        return ESHypermap.layers_to_es(layers)
+    raise Exception("Incorrect SEARCH_TYPE=%s" % SEARCH_TYPE)
+
+
+def push_documents(documents):
+    """
+    Send a batch of documents (see serialize_layers) to the search backend.
+    Does not touch the database, so it can run in a worker thread.
+    :return: True if all the documents were indexed.
+    """
+    if not documents:
+        return True
+    if SEARCH_TYPE == 'solr':
+        from hypermap.aggregator.solr import SolrHypermap
+        success, layers_errors_ids = SolrHypermap().dicts_to_solr(documents)
+    elif SEARCH_TYPE == 'elasticsearch':
+        from elasticsearch import helpers
+        from hypermap.aggregator.elasticsearch_client import ESHypermap
+        from hypermap.aggregator.search_client import is_index_missing_error
+        try:
+            len_indexed_layers, errors = helpers.bulk(ESHypermap.es, documents)
+        except Exception as err:
+            if is_index_missing_error(err):
+                # the indices will be created again for the next batch
+                ESHypermap.capabilities().invalidate()
+            raise
+        success = len_indexed_layers == len(documents)
+    else:
+        raise Exception("Incorrect SEARCH_TYPE=%s" % SEARCH_TYPE)
+    # some documents may have been written even if the batch failed
+    bump_index_generation()
+    return success
+
+
+def index_layers(layer_ids):
+    """
+    Serialize and index a batch of layers.
+    :return: True if all the layers that could be serialized were indexed.
+    """
+    return push_documents(serialize_layers(layer_ids))
+
+
+def unindex_layers(layer_ids):
+    """
+    Remove a batch of layers from the search backend.
+    The layers do not need to exist in the database anymore.
+    :return: True if all the layers were removed.
+    """
+    layer_ids = list(layer_ids)
+    if not layer_ids:
+        return True
+    if SEARCH_TYPE == 'solr':
+        from hypermap.aggregator.solr import SolrHypermap
+        SolrHypermap().remove_layers(layer_ids)
+        bump_index_generation()
+        return True
+    elif SEARCH_TYPE == 'elasticsearch':
+        from hypermap.aggregator.models import Layer, Catalog
+        from hypermap.aggregator.elasticsearch_client import ESHypermap
+        # documents are stored in one index per catalog
+        layers_catalogs = dict(Layer.objects.filter(id__in=layer_ids).values_list('id', 'catalog__slug'))
+        ids_by_catalog = {}
+        for layer_id, catalog_slug in layers_catalogs.items():
+            ids_by_catalog.setdefault(catalog_slug, []).append(layer_id)
+        missing_ids = [layer_id for layer_id in layer_ids if layer_id not in layers_catalogs]
+        if missing_ids:
+            # the catalog of a layer removed from the database is unknown: look for it in every catalog
+            for catalog_slug in Catalog.objects.values_list('slug', flat=True):
+                ids_by_catalog.setdefault(catalog_slug, []).extend(missing_ids)
+        success = True
+        for catalog_slug, catalog_layer_ids in ids_by_catalog.items():
+            success = ESHypermap.remove_layers(catalog_layer_ids, catalog_slug) and success
+        bump_index_generation()
+        return success
+    raise Exception("Incorrect SEARCH_TYPE=%s" % SEARCH_TYPE)
+
+
+def enqueue_layers(layer_ids, operation=INDEX_UPSERT):
+    """
+    Add layers to the index queue, or update the operation of the layers already queued.
+    Safe to call concurrently: the queue has a unique constraint on the layer id.
+    """
+    from hypermap.aggregator.models import LayerIndexQueue
+
+    layer_ids = sorted(set(layer_ids))
+    for i in range(0, len(layer_ids), REGISTRY_SEARCH_BATCH_SIZE):
+        chunk = layer_ids[i:i + REGISTRY_SEARCH_BATCH_SIZE]
+        now = timezone.now()
+        LayerIndexQueue.objects.filter(layer_id__in=chunk).update(operation=operation, queued_datetime=now)
+        queued_ids = set(LayerIndexQueue.objects.filter(layer_id__in=chunk).values_list('layer_id', flat=True))
+        missing = [
+            LayerIndexQueue(layer_id=layer_id, operation=operation, queued_datetime=now)
+            for layer_id in chunk if layer_id not in queued_ids
+        ]
+        if not missing:
+            continue
+        try:
+            with transaction.atomic():
+                LayerIndexQueue.objects.bulk_create(missing)
+        except IntegrityError:
+            # another worker queued some of these layers in the meantime
+            for entry in missing:
+                try:
+                    with transaction.atomic():
+                        entry.save()
+                except IntegrityError:
+                    LayerIndexQueue.objects.filter(layer_id=entry.layer_id).update(
+                        operation=operation, queued_datetime=now
+                    )
+
+
+def claim_queued_layers(operation, limit):
+    """
+    Lock and return the oldest limit entries of the index queue for an operation.
+    Must be called inside a transaction. On PostgreSQL the rows locked by other workers are skipped,
+    so that several workers can drain the queue in parallel without processing a layer twice.
+    """
+    from hypermap.aggregator.models import LayerIndexQueue
+
+    if connection.vendor == 'postgresql' and getattr(connection, 'pg_version', 0) >= 90500:
+        sql = (
+            'SELECT * FROM %s WHERE operation = %%s ORDER BY queued_datetime LIMIT %%s FOR UPDATE SKIP LOCKED'
+            % connection.ops.quote_name(LayerIndexQueue._meta.db_table)
+        )
+        return list(LayerIndexQueue.objects.raw(sql, [operation, limit]))
+    return list(
+        LayerIndexQueue.objects.select_for_update().filter(operation=operation).order_by('queued_datetime')[:limit]
+    )
+
+
+def process_index_queue(operation, batch_size=None):
+    """
+    Index or unindex the queued layers for an operation, a batch at a time.
+    A batch is removed from the queue only if it was processed correctly, otherwise it stays queued
+    for the next run.
+    :return: number of processed layers.
+    """
+    from hypermap.aggregator.models import LayerIndexQueue
+
+    batch_size = batch_size or REGISTRY_SEARCH_BATCH_SIZE
+    process = index_layers if operation == INDEX_UPSERT else unindex_layers
+    processed = 0
+    while True:
+        with transaction.atomic():
+            entries = claim_queued_layers(operation, batch_size)
+            if not entries:
+                break
+            layer_ids = [entry.layer_id for entry in entries]
+            LOGGER.debug('Processing %s for %s queued layers: %s' % (operation, len(layer_ids), layer_ids))
+            try:
+                success = process(layer_ids)
+            except Exception as err:
+                LOGGER.error(err, exc_info=True)
+                success = False
+            if not success:
+                LOGGER.error('Layers were NOT processed correctly, leaving them in the queue')
+                break
+            LayerIndexQueue.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
+            processed += len(entries)
+    return processed
+
+
+def iter_layer_ids(queryset, chunk_size):
+    """
+    Yield the ids of a layer queryset in chunks, using keyset pagination on the id,
+    so that neither the database nor this process ever holds more than a chunk.
+    """
+    last_id = 0
+    while True:
+        layer_ids = list(
+            queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size]
+        )
+        if not layer_ids:
+            return
+        yield layer_ids
+        last_id = layer_ids[-1]
+
+
+def reindex_layers(queryset=None, chunk_size=None, window=None):
+    """
+    Stream layers to the search backend.
+    Chunks of layers are serialized in this thread and sent by a pool of threads, with at most
+    window chunks in flight: when the window is full serialization waits for the oldest request.
+    Memory usage depends on chunk_size and window, not on the number of layers.
+    :param queryset: layers to index, defaults to all the valid and not deleted layers.
+    :return: dict with the number of indexed and failed chunks and layers.
+    """
+    from hypermap.aggregator.models import Layer
+
+    if queryset is None:
+        queryset = Layer.objects.filter(is_valid=True, was_deleted=False)
+    chunk_size = chunk_size or REGISTRY_SEARCH_BATCH_SIZE
+    window = window or REGISTRY_SEARCH_INDEX_WINDOW
+
+    stats = {'chunks': 0, 'layers': 0, 'failed_chunks': 0, 'failed_layers': 0}
+    start_time = time.time()
+    pool = ThreadPool(window)
+    in_flight = deque()
+
+    def collect(result, chunk_length):
+        try:
+            success = result.get()
+        except Exception as err:
+            LOGGER.error(err, exc_info=True)
+            success = False
+        stats['chunks'] += 1
+        stats['layers'] += chunk_length
+        if not success:
+            stats['failed_chunks'] += 1
+            stats['failed_layers'] += chunk_length
+        elapsed = time.time() - start_time
+        LOGGER.info('Reindexed %s layers in %.1fs (%.1f layers/s), %s failed' % (
+            stats['layers'], elapsed, stats['layers'] / max(elapsed, 0.001), stats['failed_layers']
+        ))
+
+    try:
+        for layer_ids in iter_layer_ids(queryset, chunk_size):
+            documents = serialize_layers(layer_ids)
+            # backpressure: wait for the oldest request before adding a new one to a full window
+            while len(in_flight) >= window:
+                collect(*in_flight.popleft())
+            in_flight.append((pool.apply_async(push_documents, (documents, )), len(layer_ids)))
+        while in_flight:
+            collect(*in_flight.popleft())
+    finally:
+        pool.close()
+        pool.join()
+
+    return stats
@@ -0,0 +1,48 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread safe in-process cache holding at most maxsize values, each one for at most ttl seconds.
+    The least recently used value is dropped when the cache is full.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._values.pop(key, None)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.time():
+                return default
+            # move it to the end, as the most recently used
+            self._values[key] = item
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (value, time.time() + self.ttl)
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def __len__(self):
+        return len(self._values)
@@ -0,0 +1,44 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from hypermap.aggregator.indexing import reindex_layers
+from hypermap.aggregator.tasks import clear_index
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Stream all the valid layers to the search backend.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--chunk-size',
+            dest="chunk_size",
+            default=None,
+            help="Number of layers sent in each request, defaults to REGISTRY_SEARCH_BATCH_SIZE"),
+        make_option(
+            '--window',
+            dest="window",
+            default=None,
+            help="Maximum number of requests in flight, defaults to REGISTRY_SEARCH_INDEX_WINDOW"),
+        make_option(
+            '--clear',
+            action='store_true',
+            dest="clear",
+            default=False,
+            help="Clear the search backend index before reindexing"),
+    )
+
+    def handle(self, *args, **options):
+        chunk_size = options.get('chunk_size')
+        window = options.get('window')
+        if options.get('clear'):
+            clear_index()
+        stats = reindex_layers(
+            chunk_size=int(chunk_size) if chunk_size else None,
+            window=int(window) if window else None
+        )
+        self.stdout.write('%s layers indexed in %s chunks, %s layers failed' % (
+            stats['layers'], stats['chunks'], stats['failed_layers']))
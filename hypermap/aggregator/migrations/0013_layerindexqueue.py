@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0012_delete_taskerror'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayerIndexQueue',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('layer_id', models.PositiveIntegerField(unique=True)),
+                ('operation', models.CharField(default='upsert', max_length=6, choices=[('upsert', 'Add or update'), ('delete', 'Remove')])),
+                ('queued_datetime', models.DateTimeField(default=django.utils.timezone.now, db_index=True)),
+            ],
+        ),
+    ]
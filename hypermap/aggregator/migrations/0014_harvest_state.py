@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0013_layerindexqueue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='capabilities_etag',
+            field=models.CharField(max_length=255, null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='capabilities_last_modified',
+            field=models.CharField(max_length=64, null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='capabilities_hash',
+            field=models.CharField(max_length=40, null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='harvest_hash',
+            field=models.CharField(max_length=40, null=True, editable=False, blank=True),
+        ),
+    ]
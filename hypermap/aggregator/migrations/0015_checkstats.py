@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_check_stats(apps, schema_editor):
+    from hypermap.aggregator.check_stats import build_check_stats
+
+    Check = apps.get_model('aggregator', 'Check')
+    CheckStats = apps.get_model('aggregator', 'CheckStats')
+    checks = Check.objects.order_by('content_type', 'object_id', 'checked_datetime', 'id').only(
+        'content_type', 'object_id', 'checked_datetime', 'success', 'response_time'
+    ).iterator()
+    batch = []
+    for check_stats in build_check_stats(CheckStats, checks):
+        batch.append(check_stats)
+        if len(batch) == 500:
+            CheckStats.objects.bulk_create(batch)
+            batch = []
+    CheckStats.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('aggregator', '0014_harvest_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('checks_count', models.PositiveIntegerField(default=0)),
+                ('success_count', models.PositiveIntegerField(default=0)),
+                ('response_time_sum', models.FloatField(default=0)),
+                ('min_response_time', models.FloatField(null=True, blank=True)),
+                ('max_response_time', models.FloatField(null=True, blank=True)),
+                ('recent_results', models.PositiveIntegerField(default=0)),
+                ('last_check_datetime', models.DateTimeField(null=True, blank=True)),
+                ('last_status', models.NullBooleanField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('first_check', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='aggregator.Check', null=True)),
+                ('last_check', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='aggregator.Check', null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Check stats',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='checkstats',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+        migrations.RunPython(fill_check_stats, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('aggregator', '0015_checkstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('period', models.CharField(max_length=4, choices=[('hour', 'Hour'), ('day', 'Day')])),
+                ('period_start', models.DateTimeField()),
+                ('checks_count', models.PositiveIntegerField(default=0)),
+                ('success_count', models.PositiveIntegerField(default=0)),
+                ('response_time_p50', models.FloatField(null=True, blank=True)),
+                ('response_time_p95', models.FloatField(null=True, blank=True)),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+            options={
+                'ordering': ['-period_start'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='checkrollup',
+            unique_together=set([('content_type', 'object_id', 'period', 'period_start')]),
+        ),
+    ]
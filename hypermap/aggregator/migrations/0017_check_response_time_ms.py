@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Func, Max, Min
+
+# number of checks backfilled per UPDATE query
+CHUNK_SIZE = 10000
+
+# failed checks, listed by the reliability warnings of the admin (check/?success__exact=0)
+CREATE_FAILED_CHECKS_INDEX = (
+    'CREATE INDEX aggregator_check_failed ON aggregator_check (content_type_id, object_id, checked_datetime) '
+    'WHERE NOT success'
+)
+DROP_FAILED_CHECKS_INDEX = 'DROP INDEX IF EXISTS aggregator_check_failed'
+
+
+def update_checks(apps, **values):
+    """
+    Update all the checks a chunk of ids at a time, so that no query has to rewrite the whole table.
+    """
+    Check = apps.get_model('aggregator', 'Check')
+    ids = Check.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+    if ids['min_id'] is None:
+        return
+    for start in range(ids['min_id'], ids['max_id'] + 1, CHUNK_SIZE):
+        Check.objects.filter(id__gte=start, id__lt=start + CHUNK_SIZE).update(**values)
+
+
+def fill_response_time_ms(apps, schema_editor):
+    update_checks(apps, response_time_ms=Func(F('response_time') * 1000, function='ROUND'))
+
+
+def fill_response_time(apps, schema_editor):
+    update_checks(apps, response_time=F('response_time_ms') / 1000.0)
+
+
+def scale_response_times(apps, factor):
+    CheckStats = apps.get_model('aggregator', 'CheckStats')
+    CheckRollup = apps.get_model('aggregator', 'CheckRollup')
+    CheckStats.objects.update(
+        response_time_sum=F('response_time_sum') * factor,
+        min_response_time=F('min_response_time') * factor,
+        max_response_time=F('max_response_time') * factor,
+    )
+    CheckRollup.objects.update(
+        response_time_p50=F('response_time_p50') * factor,
+        response_time_p95=F('response_time_p95') * factor,
+    )
+
+
+def response_times_to_ms(apps, schema_editor):
+    scale_response_times(apps, 1000)
+
+
+def response_times_to_seconds(apps, schema_editor):
+    scale_response_times(apps, 0.001)
+
+
+def create_failed_checks_index(apps, schema_editor):
+    # partial indexes are not supported by MySQL
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute(CREATE_FAILED_CHECKS_INDEX)
+
+
+def drop_failed_checks_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute(DROP_FAILED_CHECKS_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0016_checkrollup'),
+    ]
+
+    operations = [
+        # a default lets the field be added back when unapplying the migration
+        migrations.AlterField(
+            model_name='check',
+            name='response_time',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='check',
+            name='response_time_ms',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_response_time_ms, reverse_code=fill_response_time),
+        migrations.RemoveField(
+            model_name='check',
+            name='response_time',
+        ),
+        migrations.RenameField(
+            model_name='check',
+            old_name='response_time_ms',
+            new_name='response_time',
+        ),
+        migrations.RunPython(response_times_to_ms, reverse_code=response_times_to_seconds),
+        migrations.AlterIndexTogether(
+            name='check',
+            index_together=set([('content_type', 'object_id', 'checked_datetime')]),
+        ),
+        migrations.RunPython(create_failed_checks_index, reverse_code=drop_failed_checks_index),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0017_check_response_time_ms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpointlist',
+            name='endpoints_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='endpointlist',
+            name='imported_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='endpointlist',
+            name='processed_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='endpointlist',
+            name='processed_datetime',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+        ),
+    ]
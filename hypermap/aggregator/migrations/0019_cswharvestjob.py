@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0018_endpointlist_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CSWHarvestJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('url', models.URLField(max_length=255)),
+                ('matches', models.PositiveIntegerField(default=0)),
+                ('next_record', models.PositiveIntegerField(default=1)),
+                ('services_count', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished_datetime', models.DateTimeField(null=True, blank=True)),
+                ('catalog', models.ForeignKey(default=1, to='aggregator.Catalog')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='cswharvestjob',
+            unique_together=set([('url', 'catalog')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0019_cswharvestjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='harvest_last_date',
+            field=models.CharField(max_length=64, null=True, editable=False, blank=True),
+        ),
+    ]
@@ -14,11 +14,11 @@ from django.conf import settings
 from django.db import models
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db.models import Avg, Min, Max
 from django.db.models import signals
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
 from django_extensions.db.fields import AutoSlugField
+from django.utils import timezone
 from django.utils.functional import cached_property
 
 from taggit.managers import TaggableManager
@@ -27,21 +27,37 @@ from shapely.wkt import loads
 from owslib.namespaces import Namespaces
 from owslib.util import nspath_eval
 from owslib.csw import CatalogueServiceWeb
-from owslib.tms import TileMapService
 from owslib.wms import WebMapService
-from owslib.wmts import WebMapTileService
 from arcrest import MapService as ArcMapService, ImageService as ArcImageService
 
-from enums import CSW_RESOURCE_TYPES, SERVICE_TYPES, DATE_TYPES, SUPPORTED_SRS
+from enums import (CSW_RESOURCE_TYPES, SERVICE_TYPES, DATE_TYPES, SUPPORTED_SRS, INDEX_OPERATIONS, INDEX_UPSERT,
+                   ROLLUP_PERIODS)
 from tasks import update_endpoint, update_endpoints, check_service, check_layer, index_layer, index_service
 from utils import get_esri_extent, get_esri_service_name, get_wms_version_negotiate, format_float, flip_coordinates
 
 from hypermap.dynasty.utils import get_mined_dates
+from hypermap.aggregator.governor import governed
+from hypermap.aggregator.capabilities import (get_wms_capabilities, get_wmts_capabilities, get_harvest_hash,
+                                              save_capabilities_state, get_ows, get_capabilities_file)
+from hypermap.aggregator.capabilities_parser import iter_wms_layers, iter_wmts_layers
+from hypermap.aggregator.harvesting import HarvestedLayer, bulk_upsert_layers
+from hypermap.aggregator.check_stats import update_check_stats
+from hypermap.aggregator.endpoints import import_endpoint_list
+from hypermap.aggregator.esri import get_service_json, get_layers_json
+from hypermap.aggregator.worldmap import harvest_worldmap, mark_deleted_layers
 
 LOGGER = logging.getLogger(__name__)
 
 REGISTRY_LIMIT_LAYERS = getattr(settings, 'REGISTRY_LIMIT_LAYERS', -1)
 
+# a service check uses the capabilities document downloaded up to this number of seconds before,
+# for example by the harvest of the same check_service task
+REGISTRY_CAPABILITIES_CHECK_MAX_AGE = getattr(settings, 'REGISTRY_CAPABILITIES_CHECK_MAX_AGE', 60)
+
+# harvest WMS and WMTS layers with a streaming parser, batch size layers at a time
+REGISTRY_HARVEST_STREAMING = getattr(settings, 'REGISTRY_HARVEST_STREAMING', False)
+REGISTRY_HARVEST_BATCH_SIZE = getattr(settings, 'REGISTRY_HARVEST_BATCH_SIZE', 500)
+
 if REGISTRY_LIMIT_LAYERS > 0:
     DEBUG_SERVICES = True
     DEBUG_LAYER_NUMBER = REGISTRY_LIMIT_LAYERS
@@ -63,41 +79,63 @@ def get_parsed_date(sdate):
         return None
 
 
-def add_metadata_dates_to_layer(dates, layer):
+def get_metadata_dates(dates):
+    """
+    Return the valid dates of a list of metadata dates, formatted as LayerDate dates.
+    """
     default = datetime.datetime(2016, 1, 1)
+    metadata_dates = []
     for date in dates:
         if date:
             date = '%s' % date
             if date != '':
                 if date.startswith('-'):
-                    layerdate, created = LayerDate.objects.get_or_create(layer=layer, date=date, type=1)
+                    metadata_dates.append(date)
                 else:
                     try:
                         dt = parse(date, default=default)
                         if dt:
                             iso = dt.isoformat()
                             tokens = iso.strip().split("T")
-                            fdate = tokens[0]
-                            LOGGER.debug('Adding date %s to layer %s' % (fdate, layer.id))
-                            layerdate, created = LayerDate.objects.get_or_create(layer=layer, date=fdate, type=1)
+                            metadata_dates.append(tokens[0])
                         else:
                             LOGGER.debug('Skipping date "%s" as is invalid.' % date)
                     except Exception, e:
                         LOGGER.warning('Skipping date "%s" as is invalid.' % date)
                         LOGGER.warning(str(e))
+    return metadata_dates
 
 
-def add_mined_dates(layer):
+def add_metadata_dates_to_layer(dates, layer):
+    for date in get_metadata_dates(dates):
+        LOGGER.debug('Adding date %s to layer %s' % (date, layer.id))
+        layerdate, created = LayerDate.objects.get_or_create(layer=layer, date=date, type=1)
+
+
+def get_layer_mined_dates(layer):
+    """
+    Return the dates mined from the title and abstract of a layer.
+    """
     text_to_mine = ''
     if layer.title:
         text_to_mine = text_to_mine + layer.title
     if layer.abstract:
         text_to_mine = text_to_mine + ' ' + layer.abstract
-    mined_dates = get_mined_dates(text_to_mine)
-    for date in mined_dates:
+    return get_mined_dates(text_to_mine)
+
+
+def add_mined_dates(layer):
+    for date in get_layer_mined_dates(layer):
         layer.layerdate_set.get_or_create(date=date, type=0)
 
 
+def get_response_time(delta):
+    """
+    Return the response time of a check in milliseconds from a timedelta.
+    """
+    return int(round(delta.total_seconds() * 1000))
+
+
 def get_default_now_as_string():
     return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
 
@@ -121,7 +159,8 @@ class Check(models.Model):
     object_id = models.PositiveIntegerField()
     checked_datetime = models.DateTimeField(auto_now=True)
     success = models.BooleanField(default=False)
-    response_time = models.FloatField()
+    # milliseconds
+    response_time = models.PositiveIntegerField(default=0)
     message = models.TextField(default='OK')
 
     def __unicode__(self):
@@ -129,6 +168,84 @@ class Check(models.Model):
 
     class Meta:
         ordering = ['-checked_datetime']
+        index_together = [('content_type', 'object_id', 'checked_datetime')]
+
+
+class CheckStats(models.Model):
+    """
+    CheckStats represents the statistics of the checks of a resource (service/layer),
+    updated with each new check so that they are read without aggregating the checks.
+    """
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    checks_count = models.PositiveIntegerField(default=0)
+    success_count = models.PositiveIntegerField(default=0)
+    # response times in milliseconds
+    response_time_sum = models.FloatField(default=0)
+    min_response_time = models.FloatField(null=True, blank=True)
+    max_response_time = models.FloatField(null=True, blank=True)
+    # results of the last RECENT_CHECKS_NUMBER checks, one bit each, the last check being the lowest bit
+    recent_results = models.PositiveIntegerField(default=0)
+    first_check = models.ForeignKey(Check, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_check = models.ForeignKey(Check, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_check_datetime = models.DateTimeField(null=True, blank=True)
+    last_status = models.NullBooleanField()
+
+    def __unicode__(self):
+        return 'Check stats %s' % self.id
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+        verbose_name_plural = 'Check stats'
+
+    @property
+    def reliability(self):
+        if self.checks_count:
+            return (self.success_count / float(self.checks_count)) * 100
+        else:
+            return None
+
+    @property
+    def recent_reliability(self):
+        recent_checks_number = 2
+        if self.checks_count >= recent_checks_number:
+            recent_results = self.recent_results & ((1 << recent_checks_number) - 1)
+            success_checks = bin(recent_results).count('1')
+            return (success_checks / float(recent_checks_number)) * 100
+        else:
+            return self.reliability
+
+    @property
+    def average_response_time(self):
+        if self.checks_count:
+            return self.response_time_sum / self.checks_count
+        else:
+            return None
+
+
+class CheckRollup(models.Model):
+    """
+    CheckRollup represents the checks of a resource (service/layer) during an hour or a day,
+    kept after the checks themselves are pruned.
+    """
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    period = models.CharField(max_length=4, choices=ROLLUP_PERIODS)
+    period_start = models.DateTimeField()
+    checks_count = models.PositiveIntegerField(default=0)
+    success_count = models.PositiveIntegerField(default=0)
+    # response times in milliseconds
+    response_time_p50 = models.FloatField(null=True, blank=True)
+    response_time_p95 = models.FloatField(null=True, blank=True)
+
+    def __unicode__(self):
+        return 'Check rollup %s' % self.id
+
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'period', 'period_start')
+        ordering = ['-period_start']
 
 
 class Resource(models.Model):
@@ -148,6 +265,8 @@ class Resource(models.Model):
     is_valid = models.BooleanField(default=True)
 
     check_set = generic.GenericRelation(Check, object_id_field='object_id')
+    check_stats_set = generic.GenericRelation(CheckStats, object_id_field='object_id')
+    check_rollup_set = generic.GenericRelation(CheckRollup, object_id_field='object_id')
 
     temporal_extent_start = models.CharField(max_length=255, null=True, blank=True)
     temporal_extent_end = models.CharField(max_length=255, null=True, blank=True)
@@ -203,56 +322,52 @@ class Resource(models.Model):
         return CSW_RESOURCE_TYPES[self.type]
 
     @cached_property
+    def check_stats(self):
+        """
+        The CheckStats of the resource, prefetch check_stats_set to read them for many resources.
+        """
+        for check_stats in self.check_stats_set.all():
+            return check_stats
+        return CheckStats()
+
+    @property
     def first_check(self):
-        return self.check_set.order_by('checked_datetime').first()
+        return self.check_stats.first_check
 
-    @cached_property
+    @property
     def last_check(self):
-        return self.check_set.order_by('-checked_datetime').first()
+        return self.check_stats.last_check
 
-    @cached_property
+    @property
     def average_response_time(self):
         # TODO: exclude failed checks with response time = 0.0
-        return self.check_set.aggregate(Avg('response_time')).values()[0]
+        return self.check_stats.average_response_time
 
-    @cached_property
+    @property
     def min_response_time(self):
         # TODO: exclude failed checks with response time = 0.0
-        return self.check_set.aggregate(Min('response_time')).values()[0]
+        return self.check_stats.min_response_time
 
-    @cached_property
+    @property
     def max_response_time(self):
         # TODO: exclude failed checks with response time = 0.0
-        return self.check_set.aggregate(Max('response_time')).values()[0]
+        return self.check_stats.max_response_time
 
-    @cached_property
+    @property
     def last_status(self):
-        if self.last_check:
-            return self.last_check.success
-        else:
-            return None
+        return self.check_stats.last_status
 
-    @cached_property
+    @property
     def checks_count(self):
-        return self.check_set.all().count()
+        return self.check_stats.checks_count
 
-    @cached_property
+    @property
     def reliability(self):
-        if self.checks_count:
-            success_checks = self.check_set.filter(success=True).count()
-            return (success_checks/float(self.checks_count)) * 100
-        else:
-            return None
+        return self.check_stats.reliability
 
-    @cached_property
+    @property
     def recent_reliability(self):
-        recent_checks_number = 2
-        if self.checks_count >= recent_checks_number:
-            recent_checks = self.check_set.all().order_by('-checked_datetime')[0:recent_checks_number]
-            success_checks = sum(check.success for check in recent_checks)
-            return (success_checks/float(recent_checks_number)) * 100
-        else:
-            return self.reliability
+        return self.check_stats.recent_reliability
 
     def get_checks_admin_url(self):
         path = reverse("admin:%s_%s_changelist" % (self._meta.app_label, "check"))
@@ -283,6 +398,12 @@ class Service(Resource):
     srs = models.ManyToManyField(SpatialReferenceSystem, blank=True)
     catalog = models.ForeignKey("Catalog", default=1)
     is_monitored = models.BooleanField(default=True)
+    # validators and hash of the last harvested capabilities document
+    capabilities_etag = models.CharField(max_length=255, null=True, blank=True, editable=False)
+    capabilities_last_modified = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    capabilities_hash = models.CharField(max_length=40, null=True, blank=True, editable=False)
+    # date of the newest layer of the last complete WorldMap harvest
+    harvest_last_date = models.CharField(max_length=64, null=True, blank=True, editable=False)
 
     @property
     def id_string(self):
@@ -315,20 +436,21 @@ class Service(Resource):
 
         try:
             LOGGER.debug('Updating layers for service id %s' % self.id)
-            if self.type == 'OGC:WMS':
-                update_layers_wms(self)
-            elif self.type == 'OGC:WMTS':
-                update_layers_wmts(self)
-            elif self.type == 'ESRI:ArcGIS:MapServer':
-                update_layers_esri_mapserver(self)
-            elif self.type == 'ESRI:ArcGIS:ImageServer':
-                update_layers_esri_imageserver(self)
-            elif self.type == 'Hypermap:WorldMapLegacy':
-                update_layers_wm_legacy(self)
-            elif self.type == 'Hypermap:WorldMap':
-                update_layers_geonode_wm(self)
-            elif self.type == 'Hypermap:WARPER':
-                update_layers_warper(self)
+            with governed(self.url):
+                if self.type == 'OGC:WMS':
+                    update_layers_wms(self)
+                elif self.type == 'OGC:WMTS':
+                    update_layers_wmts(self)
+                elif self.type == 'ESRI:ArcGIS:MapServer':
+                    update_layers_esri_mapserver(self)
+                elif self.type == 'ESRI:ArcGIS:ImageServer':
+                    update_layers_esri_imageserver(self)
+                elif self.type == 'Hypermap:WorldMapLegacy':
+                    update_layers_wm_legacy(self)
+                elif self.type == 'Hypermap:WorldMap':
+                    update_layers_geonode_wm(self)
+                elif self.type == 'Hypermap:WARPER':
+                    update_layers_warper(self)
 
         except:
             LOGGER.error('Error updating layers for service %s' % self.uuid)
@@ -346,94 +468,95 @@ class Service(Resource):
         LOGGER.debug('Checking service id %s' % self.id)
 
         try:
-            title = None
-            abstract = None
-            keywords = []
-            wkt_geometry = None
-            srs = '4326'
-            if self.type == 'OGC:CSW':
-                ows = CatalogueServiceWeb(self.url)
-                title = ows.identification.title
-                abstract = ows.identification.abstract
-                keywords = ows.identification.keywords
-            if self.type == 'OGC:WMS':
-                ows = get_wms_version_negotiate(self.url)
-                title = ows.identification.title
-                abstract = ows.identification.abstract
-                keywords = ows.identification.keywords
-                for c in ows.contents:
-                    if ows.contents[c].parent is None:
-                        wkt_geometry = bbox2wktpolygon(ows.contents[c].boundingBoxWGS84)
-                    break
-            if self.type == 'OGC:WMTS':
-                ows = WebMapTileService(self.url)
-                title = ows.identification.title
-                abstract = ows.identification.abstract
-                keywords = ows.identification.keywords
-            if self.type == 'OSGeo:TMS':
-                ows = TileMapService(self.url)
-                title = ows.identification.title
-                abstract = ows.identification.abstract
-                keywords = ows.identification.keywords
-            if self.type == 'ESRI:ArcGIS:MapServer':
-                esri = ArcMapService(self.url)
-                extent, srs = get_esri_extent(esri)
-                title = esri.mapName
-                if len(title) == 0:
-                    title = get_esri_service_name(self.url)
-                wkt_geometry = bbox2wktpolygon([
-                    extent['xmin'],
-                    extent['ymin'],
-                    extent['xmax'],
-                    extent['ymax']
-                ])
-            if self.type == 'ESRI:ArcGIS:ImageServer':
-                esri = ArcImageService(self.url)
-                extent, srs = get_esri_extent(esri)
-                title = esri._json_struct['name']
-                if len(title) == 0:
-                    title = get_esri_service_name(self.url)
-                wkt_geometry = bbox2wktpolygon([
-                    extent['xmin'],
-                    extent['ymin'],
-                    extent['xmax'],
-                    extent['ymax']
-                ])
-            if self.type == 'Hypermap:WorldMap':
-                urllib2.urlopen(self.url)
-            if self.type == 'Hypermap:WorldMapLegacy':
-                urllib2.urlopen(self.url)
-                title = 'Harvard WorldMap Legacy'
-            if self.type == 'Hypermap:WARPER':
-                urllib2.urlopen(self.url)
-            # update title without raising a signal and recursion
-            if title:
-                self.title = title
-                Service.objects.filter(id=self.id).update(title=title)
-            if abstract:
-                self.abstract = abstract
-                Service.objects.filter(id=self.id).update(abstract=abstract)
-            if keywords:
-                for kw in keywords:
-                    # FIXME: persist keywords to Django model
-                    self.keywords.add(kw)
-            if wkt_geometry:
-                self.wkt_geometry = wkt_geometry
-                Service.objects.filter(id=self.id).update(wkt_geometry=wkt_geometry)
-            xml = create_metadata_record(
-                identifier=self.id_string,
-                source=self.url,
-                links=[[self.type, self.url]],
-                format=self.type,
-                type='service',
-                title=title,
-                abstract=abstract,
-                keywords=keywords,
-                wkt_geometry=self.wkt_geometry,
-                srs=srs
-            )
-            anytexts = gen_anytext(title, abstract, keywords)
-            Service.objects.filter(id=self.id).update(anytext=anytexts, xml=xml, csw_type='service')
+            with governed(self.url):
+                title = None
+                abstract = None
+                keywords = []
+                wkt_geometry = None
+                srs = '4326'
+                if self.type == 'OGC:CSW':
+                    ows = CatalogueServiceWeb(self.url)
+                    title = ows.identification.title
+                    abstract = ows.identification.abstract
+                    keywords = ows.identification.keywords
+                if self.type == 'OGC:WMS':
+                    ows = get_wms_version_negotiate(self.url, max_age=REGISTRY_CAPABILITIES_CHECK_MAX_AGE)
+                    title = ows.identification.title
+                    abstract = ows.identification.abstract
+                    keywords = ows.identification.keywords
+                    for c in ows.contents:
+                        if ows.contents[c].parent is None:
+                            wkt_geometry = bbox2wktpolygon(ows.contents[c].boundingBoxWGS84)
+                        break
+                if self.type == 'OGC:WMTS':
+                    ows = get_ows(self.url, 'OGC:WMTS', max_age=REGISTRY_CAPABILITIES_CHECK_MAX_AGE)
+                    title = ows.identification.title
+                    abstract = ows.identification.abstract
+                    keywords = ows.identification.keywords
+                if self.type == 'OSGeo:TMS':
+                    ows = get_ows(self.url, 'OSGeo:TMS', max_age=REGISTRY_CAPABILITIES_CHECK_MAX_AGE)
+                    title = ows.identification.title
+                    abstract = ows.identification.abstract
+                    keywords = ows.identification.keywords
+                if self.type == 'ESRI:ArcGIS:MapServer':
+                    esri = ArcMapService(self.url)
+                    extent, srs = get_esri_extent(esri)
+                    title = esri.mapName
+                    if len(title) == 0:
+                        title = get_esri_service_name(self.url)
+                    wkt_geometry = bbox2wktpolygon([
+                        extent['xmin'],
+                        extent['ymin'],
+                        extent['xmax'],
+                        extent['ymax']
+                    ])
+                if self.type == 'ESRI:ArcGIS:ImageServer':
+                    esri = ArcImageService(self.url)
+                    extent, srs = get_esri_extent(esri)
+                    title = esri._json_struct['name']
+                    if len(title) == 0:
+                        title = get_esri_service_name(self.url)
+                    wkt_geometry = bbox2wktpolygon([
+                        extent['xmin'],
+                        extent['ymin'],
+                        extent['xmax'],
+                        extent['ymax']
+                    ])
+                if self.type == 'Hypermap:WorldMap':
+                    urllib2.urlopen(self.url)
+                if self.type == 'Hypermap:WorldMapLegacy':
+                    urllib2.urlopen(self.url)
+                    title = 'Harvard WorldMap Legacy'
+                if self.type == 'Hypermap:WARPER':
+                    urllib2.urlopen(self.url)
+                # update title without raising a signal and recursion
+                if title:
+                    self.title = title
+                    Service.objects.filter(id=self.id).update(title=title)
+                if abstract:
+                    self.abstract = abstract
+                    Service.objects.filter(id=self.id).update(abstract=abstract)
+                if keywords:
+                    for kw in keywords:
+                        # FIXME: persist keywords to Django model
+                        self.keywords.add(kw)
+                if wkt_geometry:
+                    self.wkt_geometry = wkt_geometry
+                    Service.objects.filter(id=self.id).update(wkt_geometry=wkt_geometry)
+                xml = create_metadata_record(
+                    identifier=self.id_string,
+                    source=self.url,
+                    links=[[self.type, self.url]],
+                    format=self.type,
+                    type='service',
+                    title=title,
+                    abstract=abstract,
+                    keywords=keywords,
+                    wkt_geometry=self.wkt_geometry,
+                    srs=srs
+                )
+                anytexts = gen_anytext(title, abstract, keywords)
+                Service.objects.filter(id=self.id).update(anytext=anytexts, xml=xml, csw_type='service')
         except Exception, e:
             LOGGER.error(e, exc_info=True)
             message = str(e)
@@ -441,7 +564,7 @@ class Service(Resource):
 
         end_time = datetime.datetime.utcnow()
         delta = end_time - start_time
-        response_time = '%s.%s' % (delta.seconds, delta.microseconds)
+        response_time = get_response_time(delta)
 
         check = Check(
             content_object=self,
@@ -450,7 +573,7 @@ class Service(Resource):
             message=message
         )
         check.save()
-        LOGGER.debug('Service checked in %s seconds, status is %s' % (response_time, success))
+        LOGGER.debug('Service checked in %s ms, status is %s' % (response_time, success))
 
     def update_validity(self):
         """
@@ -562,6 +685,8 @@ class Layer(Resource):
     is_monitored = models.BooleanField(default=True)
     was_deleted = models.BooleanField(default=False)
     catalog = models.ForeignKey(Catalog, default=1)
+    # hash of the harvested values of the layer, to skip the unchanged layers
+    harvest_hash = models.CharField(max_length=40, null=True, blank=True, editable=False)
 
     def __unicode__(self):
         return '%s' % self.id
@@ -629,7 +754,8 @@ class Layer(Resource):
                     end_date.append(1)
                     dates.append(end_date)
         # now we return all the other dates
-        for layerdate in self.layerdate_set.all().order_by('date'):
+        # sorting in python lets a prefetched layerdate_set be used without extra queries
+        for layerdate in sorted(self.layerdate_set.all(), key=lambda layerdate: layerdate.date):
             sdate = layerdate.date
             # for now we skip ranges
             if 'TO' not in sdate:
@@ -642,7 +768,20 @@ class Layer(Resource):
                     dates.append(date)
         return dates
 
-    def update_thumbnail(self):
+    def get_remote_url(self):
+        """
+        Returns the url of the remote server which is requested to check the layer.
+        """
+        if self.type in ('OGC:WMS', 'OGC:WMTS', 'ESRI:ArcGIS:MapServer', 'ESRI:ArcGIS:ImageServer'):
+            return self.service.url
+        return self.url
+
+    def update_thumbnail(self, save=True, ows=None):
+        """
+        Generate the layer thumbnail with a GetMap (or equivalent) request.
+        ows can be an already loaded client of the layer service, for OGC:WMS and OGC:WMTS layers.
+        If save is False the layer row is not updated.
+        """
         LOGGER.debug('Generating thumbnail for layer id %s' % self.id)
         if not self.has_valid_bbox():
             raise ValueError('Extent for this layer is invalid, cannot generate thumbnail')
@@ -650,7 +789,8 @@ class Layer(Resource):
         format_error_message = 'This layer does not expose valid formats (png, jpeg) to generate the thumbnail'
         img = None
         if self.type == 'OGC:WMS':
-            ows = get_wms_version_negotiate(self.service.url)
+            if ows is None:
+                ows = get_wms_version_negotiate(self.service.url)
             op_getmap = ows.getOperationByName('GetMap')
             image_format = 'image/png'
             if image_format not in op_getmap.formatOptions:
@@ -675,8 +815,8 @@ class Layer(Resource):
                 raise ValueError(img.read())
                 img = None
         elif self.type == 'OGC:WMTS':
-
-            ows = WebMapTileService(self.service.url)
+            if ows is None:
+                ows = get_ows(self.service.url, 'OGC:WMTS')
             ows_layer = ows.contents[self.name]
             image_format = 'image/png'
             if image_format not in ows_layer.formats:
@@ -793,22 +933,22 @@ class Layer(Resource):
         if img:
             thumbnail_file_name = '%s.jpg' % self.uuid
             upfile = SimpleUploadedFile(thumbnail_file_name, img.read(), "image/jpeg")
-            self.thumbnail.save(thumbnail_file_name, upfile, True)
+            self.thumbnail.save(thumbnail_file_name, upfile, save)
             LOGGER.debug('Thumbnail updated for layer %s' % self.name)
 
-    def check_available(self):
+    def run_check(self, save_thumbnail=True, ows=None):
         """
         Check for availability of a layer and provide run metrics.
+        Return the Check without saving it, and leave the layer signals connected: see check_available.
         """
         success = True
         start_time = datetime.datetime.utcnow()
         message = ''
         LOGGER.debug('Checking layer id %s' % self.id)
 
-        signals.post_save.disconnect(layer_post_save, sender=Layer)
-
         try:
-            self.update_thumbnail()
+            with governed(self.get_remote_url()):
+                self.update_thumbnail(save=save_thumbnail, ows=ows)
         except ValueError, err:
             # caused by update_thumbnail()
             # self.href is empty in arcserver.ExportMap
@@ -818,22 +958,31 @@ class Layer(Resource):
             message = str(err)
             success = False
 
-        signals.post_save.connect(layer_post_save, sender=Layer)
-
         end_time = datetime.datetime.utcnow()
 
         delta = end_time - start_time
-        response_time = '%s.%s' % (delta.seconds, delta.microseconds)
+        response_time = get_response_time(delta)
 
-        check = Check(
+        LOGGER.debug('Layer checked in %s ms, status is %s' % (response_time, success))
+        return Check(
             content_object=self,
             success=success,
             response_time=response_time,
             message=message
         )
+
+    def check_available(self):
+        """
+        Check for availability of a layer and provide run metrics.
+        """
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        try:
+            check = self.run_check()
+        finally:
+            signals.post_save.connect(layer_post_save, sender=Layer)
+
         check.save()
-        LOGGER.debug('Layer checked in %s seconds, status is %s' % (response_time, success))
-        return success, message
+        return check.success, check.message
 
     def registry_tags(self, query_string='{http://gis.harvard.edu/HHypermap/registry/0.1}property'):
         """
@@ -923,10 +1072,20 @@ class EndpointList(models.Model):
     upload = models.FileField(upload_to='endpoint_lists')
     greedy = models.BooleanField(default=False, editable=False)
     catalog = models.ForeignKey(Catalog, default=1)
+    # progress of the import, see hypermap.aggregator.endpoints
+    endpoints_count = models.PositiveIntegerField(default=0, editable=False)
+    processed_count = models.PositiveIntegerField(default=0, editable=False)
+    imported_count = models.PositiveIntegerField(default=0, editable=False)
+    processed_datetime = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __unicode__(self):
         return self.upload.name
 
+    def progress(self):
+        if not self.endpoints_count:
+            return '-'
+        return '%s/%s (%s imported)' % (self.processed_count, self.endpoints_count, self.imported_count)
+
     def endpoints_admin_url(self):
         url = '<a href="/admin/aggregator/endpoint/?endpoint_list=%s">Endpoints for this list</a>' % self.id
         return url
@@ -949,6 +1108,32 @@ class Endpoint(models.Model):
         unique_together = ("url", "catalog")
 
 
+class CSWHarvestJob(models.Model):
+    """
+    CSWHarvestJob is the progress of the harvest of a CSW endpoint, so that it resumes where it stopped.
+    """
+    url = models.URLField(max_length=255)
+    catalog = models.ForeignKey(Catalog, default=1)
+    matches = models.PositiveIntegerField(default=0)
+    # the startposition of the first page of records whose services are not created yet
+    next_record = models.PositiveIntegerField(default=1)
+    services_count = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished_datetime = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ("url", "catalog")
+
+    def __unicode__(self):
+        return self.url
+
+    def progress(self):
+        if not self.matches:
+            return '-'
+        return '%s/%s' % (min(self.next_record - 1, self.matches), self.matches)
+
+
 class IssueType(models.Model):
     """
     Issuetype represents type of issues that services/layers have.
@@ -971,6 +1156,19 @@ class Issue(models.Model):
     description = models.TextField(blank=True, null=True)
 
 
+class LayerIndexQueue(models.Model):
+    """
+    LayerIndexQueue represents a layer waiting to be added to or removed from the search engine.
+    There is at most one entry per layer: enqueueing a layer again only updates its operation.
+    """
+    layer_id = models.PositiveIntegerField(unique=True)
+    operation = models.CharField(max_length=6, choices=INDEX_OPERATIONS, default=INDEX_UPSERT)
+    queued_datetime = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __unicode__(self):
+        return '%s %s' % (self.operation, self.layer_id)
+
+
 def bbox2wktpolygon(bbox):
     """
     Return OGC WKT Polygon of a simple bbox list
@@ -1059,15 +1257,109 @@ def gen_anytext(*args):
     return ' '.join(bag)
 
 
+def harvest_layers_streaming(service, iter_layers, update_layer, batch_size=None):
+    """
+    Harvest the layers of a WMS or WMTS service without loading its capabilities document in memory:
+    the document is downloaded to a temporary file, parsed with iterparse one layer at a time,
+    and the layers are written batch_size at a time.
+    :param iter_layers: iter_wms_layers or iter_wmts_layers.
+    :param update_layer: function(layer, record) setting the harvested values of a layer.
+    """
+    batch_size = batch_size or REGISTRY_HARVEST_BATCH_SIZE
+    capabilities = get_capabilities_file(service)
+    if capabilities is None:
+        LOGGER.debug('Capabilities of service id %s did not change, skipping its layers' % service.id)
+        return
+    try:
+        harvested = []
+        count = 0
+        for record in iter_layers(capabilities.file):
+            if count == 0:
+                # set srs, from the first layer as the OWSLib harvest does
+                for crs_code in record.crsOptions:
+                    srs, created = SpatialReferenceSystem.objects.get_or_create(code=crs_code)
+                    service.srs.add(srs)
+                service.update_validity()
+            LOGGER.debug('Updating layer %s' % record.name)
+            harvest_hash = get_harvest_hash(
+                service.url, record.name, record.title, record.abstract, record.keywords, record.boundingBoxWGS84
+            )
+            harvested.append(HarvestedLayer(
+                {'name': record.name}, record, harvest_hash=harvest_hash, keywords=record.keywords
+            ))
+            count += 1
+            # exits if DEBUG_SERVICES
+            if DEBUG_SERVICES and count >= DEBUG_LAYER_NUMBER:
+                bulk_upsert_layers(service, harvested, update_layer)
+                return
+            if len(harvested) >= batch_size:
+                bulk_upsert_layers(service, harvested, update_layer)
+                harvested = []
+        bulk_upsert_layers(service, harvested, update_layer)
+        LOGGER.debug('Harvested %s layers of service id %s' % (count, service.id))
+        save_capabilities_state(service, capabilities)
+    finally:
+        capabilities.close()
+
+
 # updatelayers for each service type
 
-def update_layers_wms(service):
+def update_layers_wms(service, streaming=None):
     """
     Update layers for an OGC:WMS service.
     Sample endpoint: http://demo.geonode.org/geoserver/ows
+    :param streaming: use harvest_layers_streaming, defaults to REGISTRY_HARVEST_STREAMING.
     """
+
+    def update_layer(layer, ows_layer):
+        links = [['OGC:WMS', service.url],
+                 ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
+        # update fields
+        layer.type = 'OGC:WMS'
+        layer.title = ows_layer.title
+        layer.abstract = ows_layer.abstract
+        layer.url = service.url
+        layer.page_url = layer.get_absolute_url
+        links.append([
+            'WWW:LINK',
+            settings.SITE_URL.rstrip('/') + layer.page_url
+        ])
+        # bbox
+        bbox = list(ows_layer.boundingBoxWGS84 or (-179.0, -89.0, 179.0, 89.0))
+        layer.bbox_x0 = bbox[0]
+        layer.bbox_y0 = bbox[1]
+        layer.bbox_x1 = bbox[2]
+        layer.bbox_y1 = bbox[3]
+        layer.wkt_geometry = bbox2wktpolygon(bbox)
+        # crsOptions
+        # TODO we may rather prepopulate with fixutres the SpatialReferenceSystem table
+        layer.xml = create_metadata_record(
+            identifier=str(layer.uuid),
+            source=service.url,
+            links=links,
+            format='OGC:WMS',
+            type=layer.csw_type,
+            relation=service.id_string,
+            title=ows_layer.title,
+            alternative=ows_layer.name,
+            abstract=ows_layer.abstract,
+            keywords=ows_layer.keywords,
+            wkt_geometry=layer.wkt_geometry
+        )
+        layer.anytext = gen_anytext(layer.title, layer.abstract, ows_layer.keywords.sort())
+
+    if streaming is None:
+        streaming = REGISTRY_HARVEST_STREAMING
+
     try:
-        wms = get_wms_version_negotiate(service.url)
+        if streaming:
+            harvest_layers_streaming(service, iter_wms_layers, update_layer)
+            return
+        capabilities = get_wms_capabilities(service)
+        if capabilities is None:
+            LOGGER.debug('Capabilities of service id %s did not change, skipping its layers' % service.id)
+            return
+        wms = capabilities.ows
         layer_names = list(wms.contents)
         parent = wms.contents[layer_names[0]].parent
         # fallback, some endpoint like this one:
@@ -1085,60 +1377,23 @@ def update_layers_wms(service):
         service.update_validity()
 
         # now update layers
-        layer_n = 0
-        total = len(layer_names)
+        harvested = []
         for layer_name in layer_names:
             ows_layer = wms.contents[layer_name]
             LOGGER.debug('Updating layer %s' % ows_layer.name)
-            # get or create layer
-            layer, created = Layer.objects.get_or_create(name=ows_layer.name, service=service, catalog=service.catalog)
-            if layer.active:
-                links = [['OGC:WMS', service.url],
-                         ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
-                # update fields
-                layer.type = 'OGC:WMS'
-                layer.title = ows_layer.title
-                layer.abstract = ows_layer.abstract
-                layer.url = service.url
-                layer.page_url = layer.get_absolute_url
-                links.append([
-                    'WWW:LINK',
-                    settings.SITE_URL.rstrip('/') + layer.page_url
-                ])
-                # bbox
-                bbox = list(ows_layer.boundingBoxWGS84 or (-179.0, -89.0, 179.0, 89.0))
-                layer.bbox_x0 = bbox[0]
-                layer.bbox_y0 = bbox[1]
-                layer.bbox_x1 = bbox[2]
-                layer.bbox_y1 = bbox[3]
-                layer.wkt_geometry = bbox2wktpolygon(bbox)
-                # keywords
-                for keyword in ows_layer.keywords:
-                    layer.keywords.add(keyword)
-                # crsOptions
-                # TODO we may rather prepopulate with fixutres the SpatialReferenceSystem table
-                layer.xml = create_metadata_record(
-                    identifier=str(layer.uuid),
-                    source=service.url,
-                    links=links,
-                    format='OGC:WMS',
-                    type=layer.csw_type,
-                    relation=service.id_string,
-                    title=ows_layer.title,
-                    alternative=ows_layer.name,
-                    abstract=ows_layer.abstract,
-                    keywords=ows_layer.keywords,
-                    wkt_geometry=layer.wkt_geometry
-                )
-                layer.anytext = gen_anytext(layer.title, layer.abstract, ows_layer.keywords.sort())
-                layer.save()
-                # dates
-                add_mined_dates(layer)
-            layer_n = layer_n + 1
-            # exits if DEBUG_SERVICES
-            LOGGER.debug("Updating layer n. %s/%s" % (layer_n, total))
-            if DEBUG_SERVICES and layer_n == DEBUG_LAYER_NUMBER:
-                return
+            harvest_hash = get_harvest_hash(
+                service.url, ows_layer.name, ows_layer.title, ows_layer.abstract, ows_layer.keywords,
+                ows_layer.boundingBoxWGS84
+            )
+            harvested.append(HarvestedLayer(
+                {'name': ows_layer.name}, ows_layer, harvest_hash=harvest_hash, keywords=ows_layer.keywords
+            ))
+        # exits if DEBUG_SERVICES
+        if DEBUG_SERVICES:
+            bulk_upsert_layers(service, harvested[:DEBUG_LAYER_NUMBER], update_layer)
+            return
+        bulk_upsert_layers(service, harvested, update_layer)
+        save_capabilities_state(service, capabilities)
     except Exception as err:
         message = "update_layers_wms: {0}".format(
             err
@@ -1152,13 +1407,61 @@ def update_layers_wms(service):
         check.save()
 
 
-def update_layers_wmts(service):
+def update_layers_wmts(service, streaming=None):
     """
     Update layers for an OGC:WMTS service.
     Sample endpoint: http://map1.vis.earthdata.nasa.gov/wmts-geo/1.0.0/WMTSCapabilities.xml
+    :param streaming: use harvest_layers_streaming, defaults to REGISTRY_HARVEST_STREAMING.
     """
+
+    def update_layer(layer, ows_layer):
+        links = [['OGC:WMTS', service.url],
+                 ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
+        layer.type = 'OGC:WMTS'
+        layer.title = ows_layer.title
+        layer.abstract = ows_layer.abstract
+        # keywords
+        # @tomkralidis wmts does not seem to support this attribute
+        keywords = getattr(ows_layer, 'keywords', None)
+        layer.url = service.url
+        layer.page_url = layer.get_absolute_url
+        links.append([
+            'WWW:LINK',
+            settings.SITE_URL.rstrip('/') + layer.page_url
+        ])
+        bbox = list(ows_layer.boundingBoxWGS84 or (-179.0, -89.0, 179.0, 89.0))
+        layer.bbox_x0 = bbox[0]
+        layer.bbox_y0 = bbox[1]
+        layer.bbox_x1 = bbox[2]
+        layer.bbox_y1 = bbox[3]
+        layer.wkt_geometry = bbox2wktpolygon(bbox)
+        layer.xml = create_metadata_record(
+            identifier=str(layer.uuid),
+            source=service.url,
+            links=links,
+            format='OGC:WMS',
+            type=layer.csw_type,
+            relation=service.id_string,
+            title=ows_layer.title,
+            alternative=ows_layer.name,
+            abstract=layer.abstract,
+            keywords=keywords,
+            wkt_geometry=layer.wkt_geometry
+        )
+        layer.anytext = gen_anytext(layer.title, layer.abstract, keywords)
+
+    if streaming is None:
+        streaming = REGISTRY_HARVEST_STREAMING
+
     try:
-        wmts = WebMapTileService(service.url)
+        if streaming:
+            harvest_layers_streaming(service, iter_wmts_layers, update_layer)
+            return
+        capabilities = get_wmts_capabilities(service)
+        if capabilities is None:
+            LOGGER.debug('Capabilities of service id %s did not change, skipping its layers' % service.id)
+            return
+        wmts = capabilities.ows
 
         # set srs
         # WMTS is always in 4326
@@ -1167,60 +1470,24 @@ def update_layers_wmts(service):
 
         service.update_validity()
 
-        layer_names = list(wmts.contents)
-        layer_n = 0
-        total = len(layer_names)
-        for layer_name in layer_names:
+        harvested = []
+        for layer_name in list(wmts.contents):
             ows_layer = wmts.contents[layer_name]
             LOGGER.debug('Updating layer %s' % ows_layer.name)
-            layer, created = Layer.objects.get_or_create(name=ows_layer.name, service=service, catalog=service.catalog)
-            if layer.active:
-                links = [['OGC:WMTS', service.url],
-                         ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
-                layer.type = 'OGC:WMTS'
-                layer.title = ows_layer.title
-                layer.abstract = ows_layer.abstract
-                # keywords
-                # @tomkralidis wmts does not seem to support this attribute
-                keywords = None
-                if hasattr(ows_layer, 'keywords'):
-                    keywords = ows_layer.keywords
-                    for keyword in keywords:
-                        layer.keywords.add(keyword)
-                layer.url = service.url
-                layer.page_url = layer.get_absolute_url
-                links.append([
-                    'WWW:LINK',
-                    settings.SITE_URL.rstrip('/') + layer.page_url
-                ])
-                bbox = list(ows_layer.boundingBoxWGS84 or (-179.0, -89.0, 179.0, 89.0))
-                layer.bbox_x0 = bbox[0]
-                layer.bbox_y0 = bbox[1]
-                layer.bbox_x1 = bbox[2]
-                layer.bbox_y1 = bbox[3]
-                layer.wkt_geometry = bbox2wktpolygon(bbox)
-                layer.xml = create_metadata_record(
-                    identifier=str(layer.uuid),
-                    source=service.url,
-                    links=links,
-                    format='OGC:WMS',
-                    type=layer.csw_type,
-                    relation=service.id_string,
-                    title=ows_layer.title,
-                    alternative=ows_layer.name,
-                    abstract=layer.abstract,
-                    keywords=keywords,
-                    wkt_geometry=layer.wkt_geometry
-                )
-                layer.anytext = gen_anytext(layer.title, layer.abstract, keywords)
-                layer.save()
-                # dates
-                add_mined_dates(layer)
-            layer_n = layer_n + 1
-            # exits if DEBUG_SERVICES
-            LOGGER.debug("Updating layer n. %s/%s" % (layer_n, total))
-            if DEBUG_SERVICES and layer_n == DEBUG_LAYER_NUMBER:
-                return
+            keywords = getattr(ows_layer, 'keywords', None)
+            harvest_hash = get_harvest_hash(
+                service.url, ows_layer.name, ows_layer.title, ows_layer.abstract, keywords,
+                ows_layer.boundingBoxWGS84
+            )
+            harvested.append(HarvestedLayer(
+                {'name': ows_layer.name}, ows_layer, harvest_hash=harvest_hash, keywords=keywords
+            ))
+        # exits if DEBUG_SERVICES
+        if DEBUG_SERVICES:
+            bulk_upsert_layers(service, harvested[:DEBUG_LAYER_NUMBER], update_layer)
+            return
+        bulk_upsert_layers(service, harvested, update_layer)
+        save_capabilities_state(service, capabilities)
     except Exception as err:
         message = "update_layers_wmts: {0}".format(
             err
@@ -1234,20 +1501,134 @@ def update_layers_wmts(service):
         check.save()
 
 
-def update_layers_geonode_wm(service, num_layers=None):
+def update_worldmap_layer(layer, row):
     """
-    Update layers for a WorldMap instance.
-    Sample endpoint: http://localhost:8000/
+    Set the values of a WorldMap layer from a row of the WorldMap layers api (see update_layers_geonode_wm
+    and update_layers_wm_legacy).
+    """
+    links = [['Hypermap:WorldMap', row['endpoint']]]
+    if row['wmts_link']:
+        links.append(['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()])
+    # update fields
+    layer.type = 'Hypermap:WorldMap'
+    layer.title = row['title']
+    layer.abstract = row['abstract']
+    layer.is_public = row['is_public']
+    layer.url = row['endpoint']
+    layer.page_url = row['page_url']
+    x0, y0, x1, y1 = row['bbox']
+    layer.bbox_x0 = x0
+    layer.bbox_y0 = y0
+    layer.bbox_x1 = x1
+    layer.bbox_y1 = y1
+    layer.wkt_geometry = bbox2wktpolygon([x0, y0, x1, y1])
+    layer.xml = create_metadata_record(
+        identifier=str(layer.uuid),
+        source=row['endpoint'],
+        links=links,
+        format='Hypermap:WorldMap',
+        type=layer.csw_type,
+        relation=layer.service.id_string,
+        title=layer.title,
+        alternative=row['name'],
+        abstract=layer.abstract,
+        keywords=row['keywords'],
+        wkt_geometry=layer.wkt_geometry
+    )
+    layer.anytext = gen_anytext(layer.title, layer.abstract, row['keywords'])
+
+
+def parse_geonode_wm_row(service, row):
     """
-    wm_api_url = urlparse.urljoin(service.url, 'worldmap/api/2.8/layer/?format=json')
+    The HarvestedLayer of a row of the layers api of a WorldMap instance.
+    """
+    typename = row['typename']
+    # name = typename.split(':')[1]
+    name = typename
+    LOGGER.debug('Updating layer %s' % name)
+    bbox = row['bbox']
+    page_url = urlparse.urljoin(service.url, 'data/%s' % name)
+    temporal_extent_start = row.get('temporal_extent_start', '')
+    temporal_extent_end = row.get('temporal_extent_end', '')
+    # we use the geoserver virtual layer getcapabilities for wm endpoint
+    # TODO we should port make geoserver port configurable some way...
+    # endpoint = urlparse.urljoin(service.url, 'geoserver/geonode/%s/wms?' % name)
+    endpoint = urlparse.urljoin(service.url, 'geoserver/wms?')
+    endpoint = endpoint.replace('8000', '8080')
+    # bbox [x0, y0, x1, y1]
+    x0 = format_float(bbox[0])
+    x1 = format_float(bbox[1])
+    y0 = format_float(bbox[2])
+    y1 = format_float(bbox[3])
+    # In many cases for some reason to be fixed GeoServer has x coordinates flipped in WM.
+    x0, x1 = flip_coordinates(x0, x1)
+    y0, y1 = flip_coordinates(y0, y1)
+    keywords = [keyword['name'] for keyword in row['keywords']]
+    return HarvestedLayer(
+        {'name': name, 'uuid': row['uuid']},
+        {
+            'name': name, 'title': row['title'], 'abstract': row['abstract'], 'is_public': row.get('is_public', True),
+            'endpoint': endpoint, 'page_url': page_url, 'bbox': (x0, y0, x1, y1),
+            'keywords': keywords, 'wmts_link': False,
+        },
+        keywords=keywords,
+        dates=[temporal_extent_start, temporal_extent_end],
+        wm={
+            'category': row.get('topic_category', ''),
+            'username': row.get('owner_username', ''),
+            'temporal_extent_start': temporal_extent_start,
+            'temporal_extent_end': temporal_extent_end,
+        }
+    )
 
-    if num_layers:
-        total = num_layers
+
+def parse_wm_legacy_row(row):
+    """
+    The HarvestedLayer of a row of the layers api of WorldMap Legacy.
+    """
+    name = row['typename']
+    LOGGER.debug('Updating layer %s' % name)
+    bbox = row['llbbox']
+    page_url = 'http://worldmap.harvard.edu/data/%s' % name
+    temporal_extent_start = row.get('temporal_extent_start', '')
+    temporal_extent_end = row.get('temporal_extent_end', '')
+    # we use the geoserver virtual layer getcapabilities for wm endpoint
+    endpoint = 'http://worldmap.harvard.edu/geoserver/geonode/%s/wms?' % name
+    # bbox [x0, y0, x1, y1]
+    # check if it is a valid bbox (TODO improve this check)
+    bbox = bbox.replace('-inf', 'None')
+    bbox = bbox.replace('inf', 'None')
+    if bbox.count(',') == 3:
+        bbox_list = bbox[1:-1].split(',')
     else:
-        response = requests.get(wm_api_url)
-        data = json.loads(response.content)
-        total = data['meta']['total_count']
+        bbox_list = [None, None, None, None]
+    x0 = format_float(bbox_list[0])
+    y0 = format_float(bbox_list[1])
+    x1 = format_float(bbox_list[2])
+    y1 = format_float(bbox_list[3])
+    # In many cases for some reason to be fixed GeoServer has x coordinates flipped in WM.
+    x0, x1 = flip_coordinates(x0, x1)
+    y0, y1 = flip_coordinates(y0, y1)
+    keywords = [keyword['name'] for keyword in row['keywords']]
+    return HarvestedLayer(
+        {'name': name, 'uuid': row['uuid']},
+        {
+            'name': name, 'title': row['title'], 'abstract': row['abstract'], 'is_public': row.get('is_public', True),
+            'endpoint': endpoint, 'page_url': page_url, 'bbox': (x0, y0, x1, y1),
+            'keywords': keywords, 'wmts_link': True,
+        },
+        keywords=keywords,
+        dates=[temporal_extent_start, temporal_extent_end],
+        wm={
+            'category': row.get('topic_category', ''),
+            'username': row.get('owner_username', ''),
+            'temporal_extent_start': temporal_extent_start,
+            'temporal_extent_end': temporal_extent_end,
+        }
+    )
+
 
+def set_worldmap_srs(service):
     # set srs
     # WorldMap supports only 4326, 900913, 3857
     for crs_code in ['EPSG:4326', 'EPSG:900913', 'EPSG:3857']:
@@ -1256,285 +1637,67 @@ def update_layers_geonode_wm(service, num_layers=None):
 
     service.update_validity()
 
-    layer_n = 0
-    limit = 10
 
-    for i in range(0, total, limit):
-        try:
-            url = (
-                    '%s&order_by=-date&offset=%s&limit=%s' % (wm_api_url, i, limit)
-            )
-            LOGGER.debug('Fetching %s' % url)
-            response = requests.get(url)
-            data = json.loads(response.content)
-            for row in data['objects']:
-                typename = row['typename']
-                # name = typename.split(':')[1]
-                name = typename
-                uuid = row['uuid']
-                LOGGER.debug('Updating layer %s' % name)
-                title = row['title']
-                abstract = row['abstract']
-                bbox = row['bbox']
-                page_url = urlparse.urljoin(service.url, 'data/%s' % name)
-                category = ''
-                if 'topic_category' in row:
-                    category = row['topic_category']
-                username = ''
-                if 'owner_username' in row:
-                    username = row['owner_username']
-                temporal_extent_start = ''
-                if 'temporal_extent_start' in row:
-                    temporal_extent_start = row['temporal_extent_start']
-                temporal_extent_end = ''
-                if 'temporal_extent_end' in row:
-                    temporal_extent_end = row['temporal_extent_end']
-                # we use the geoserver virtual layer getcapabilities for wm endpoint
-                # TODO we should port make geoserver port configurable some way...
-                # endpoint = urlparse.urljoin(service.url, 'geoserver/geonode/%s/wms?' % name)
-                endpoint = urlparse.urljoin(service.url, 'geoserver/wms?')
-                endpoint = endpoint.replace('8000', '8080')
-                print endpoint
-                if 'is_public' in row:
-                    is_public = row['is_public']
-                layer, created = Layer.objects.get_or_create(
-                    service=service, catalog=service.catalog, name=name, uuid=uuid)
-                if created:
-                    LOGGER.debug('Added a new layer in registry: %s, %s' % (name, uuid))
-                if layer.active:
-                    links = [['Hypermap:WorldMap', endpoint]]
-                    # update fields
-                    layer.type = 'Hypermap:WorldMap'
-                    layer.title = title
-                    layer.abstract = abstract
-                    layer.is_public = is_public
-                    layer.url = endpoint
-                    layer.page_url = page_url
-                    # category and owner username
-                    layer_wm, created = LayerWM.objects.get_or_create(layer=layer)
-                    layer_wm.category = category
-                    layer_wm.username = username
-                    layer_wm.temporal_extent_start = temporal_extent_start
-                    layer_wm.temporal_extent_end = temporal_extent_end
-                    layer_wm.save()
-                    # bbox [x0, y0, x1, y1]
-                    # check if it is a valid bbox (TODO improve this check)
-                    # bbox = bbox.replace('-inf', 'None')
-                    # bbox = bbox.replace('inf', 'None')
-                    # if bbox.count(',') == 3:
-                    #    bbox_list = bbox[1:-1].split(',')
-                    # else:
-                    #    bbox_list = [None, None, None, None]
-                    x0 = format_float(bbox[0])
-                    x1 = format_float(bbox[1])
-                    y0 = format_float(bbox[2])
-                    y1 = format_float(bbox[3])
-                    # In many cases for some reason to be fixed GeoServer has x coordinates flipped in WM.
-                    x0, x1 = flip_coordinates(x0, x1)
-                    y0, y1 = flip_coordinates(y0, y1)
-                    layer.bbox_x0 = x0
-                    layer.bbox_y0 = y0
-                    layer.bbox_x1 = x1
-                    layer.bbox_y1 = y1
-                    # keywords
-                    keywords = []
-                    for keyword in row['keywords']:
-                        keywords.append(keyword['name'])
-                    layer.keywords.all().delete()
-                    for keyword in keywords:
-                        layer.keywords.add(keyword)
-                    layer.wkt_geometry = bbox2wktpolygon([x0, y0, x1, y1])
-                    layer.xml = create_metadata_record(
-                        identifier=str(layer.uuid),
-                        source=endpoint,
-                        links=links,
-                        format='Hypermap:WorldMap',
-                        type=layer.csw_type,
-                        relation=service.id_string,
-                        title=layer.title,
-                        alternative=name,
-                        abstract=layer.abstract,
-                        keywords=keywords,
-                        wkt_geometry=layer.wkt_geometry
-                    )
-                    layer.anytext = gen_anytext(layer.title, layer.abstract, keywords)
-                    layer.save()
-                    # dates
-                    add_mined_dates(layer)
-                    add_metadata_dates_to_layer([layer_wm.temporal_extent_start, layer_wm.temporal_extent_end], layer)
-                    layer_n = layer_n + 1
-                    # exits if DEBUG_SERVICES
-                    LOGGER.debug("Updated layer n. %s/%s" % (layer_n, total))
-                    if DEBUG_SERVICES and layer_n == DEBUG_LAYER_NUMBER:
-                        return
-
-        except Exception as err:
-            LOGGER.error('Error! %s' % err)
+def update_layers_geonode_wm(service, num_layers=None, incremental=False):
+    """
+    Update layers for a WorldMap instance.
+    Sample endpoint: http://localhost:8000/
+    :param num_layers: update at most this number of layers, the newest ones.
+    :param incremental: only update the layers newer than the last complete harvest.
+    :return: the list of the ids of the updated layers.
+    """
+    wm_api_url = urlparse.urljoin(service.url, 'worldmap/api/2.8/layer/')
+    set_worldmap_srs(service)
+    # exits if DEBUG_SERVICES
+    if DEBUG_SERVICES:
+        num_layers = min(num_layers or DEBUG_LAYER_NUMBER, DEBUG_LAYER_NUMBER)
+
+    updated = []
+    try:
+        updated = harvest_worldmap(
+            service, wm_api_url, 'date', lambda row: parse_geonode_wm_row(service, row), update_worldmap_layer,
+            num_layers=num_layers, incremental=incremental
+        )
+    except Exception as err:
+        LOGGER.error('Error! %s' % err)
 
     # update deleted layers. For now we check the whole set of deleted layers
     # we should optimize it if the list will grow
     # TODO implement the actions application
-    url = urlparse.urljoin(service.url, 'worldmap/api/2.8/actionlayerdelete/?format=json')
-    LOGGER.debug('Fetching %s for detecting deleted layers' % url)
     try:
-        response = requests.get(url)
-        data = json.loads(response.content)
-        for deleted_layer in data['objects']:
-            if Layer.objects.filter(uuid=deleted_layer['args']).count() > 0:
-                layer = Layer.objects.get(uuid=deleted_layer['args'])
-                layer.was_deleted = True
-                layer.save()
-                LOGGER.debug('Layer %s marked as deleted' % layer.uuid)
+        mark_deleted_layers(service, urlparse.urljoin(service.url, 'worldmap/api/2.8/actionlayerdelete/?format=json'))
     except Exception as err:
         LOGGER.error('Error! %s' % err)
+    return updated
 
 
-def update_layers_wm_legacy(service, num_layers=None):
+def update_layers_wm_legacy(service, num_layers=None, incremental=False):
     """
     Update layers for a WorldMap Legacy instance.
     Sample endpoint: http://worldmap.harvard.edu/
+    :param num_layers: update at most this number of layers, the newest ones.
+    :param incremental: only update the layers newer than the last complete harvest.
+    :return: the list of the ids of the updated layers.
     """
+    set_worldmap_srs(service)
+    # exits if DEBUG_SERVICES
+    if DEBUG_SERVICES:
+        num_layers = min(num_layers or DEBUG_LAYER_NUMBER, DEBUG_LAYER_NUMBER)
 
-    if num_layers:
-        total = num_layers
-    else:
-        response = requests.get('http://worldmap.harvard.edu/api/1.5/layer/?format=json')
-        data = json.loads(response.content)
-        total = data['meta']['total_count']
-
-    # set srs
-    # WorldMap supports only 4326, 900913, 3857
-    for crs_code in ['EPSG:4326', 'EPSG:900913', 'EPSG:3857']:
-        srs, created = SpatialReferenceSystem.objects.get_or_create(code=crs_code)
-        service.srs.add(srs)
-
-    service.update_validity()
-
-    layer_n = 0
-    limit = 10
-
-    for i in range(0, total, limit):
-        try:
-            url = (
-                    'http://worldmap.harvard.edu/api/1.5/layer/?format=json&order_by=-created_dttm&offset=%s&limit=%s'
-                    % (i, limit)
-            )
-            LOGGER.debug('Fetching %s' % url)
-            response = requests.get(url)
-            data = json.loads(response.content)
-            for row in data['objects']:
-                name = row['typename']
-                uuid = row['uuid']
-                LOGGER.debug('Updating layer %s' % name)
-                title = row['title']
-                abstract = row['abstract']
-                bbox = row['llbbox']
-                page_url = 'http://worldmap.harvard.edu/data/%s' % name
-                category = ''
-                if 'topic_category' in row:
-                    category = row['topic_category']
-                username = ''
-                if 'owner_username' in row:
-                    username = row['owner_username']
-                temporal_extent_start = ''
-                if 'temporal_extent_start' in row:
-                    temporal_extent_start = row['temporal_extent_start']
-                temporal_extent_end = ''
-                if 'temporal_extent_end' in row:
-                    temporal_extent_end = row['temporal_extent_end']
-                # we use the geoserver virtual layer getcapabilities for wm endpoint
-                endpoint = 'http://worldmap.harvard.edu/geoserver/geonode/%s/wms?' % name
-                is_public = True
-                if 'is_public' in row:
-                    is_public = row['is_public']
-                layer, created = Layer.objects.get_or_create(
-                    service=service, catalog=service.catalog, name=name, uuid=uuid)
-                if created:
-                    LOGGER.debug('Added a new layer in registry: %s, %s' % (name, uuid))
-                if layer.active:
-                    links = [['Hypermap:WorldMap', endpoint],
-                             ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
-                    # update fields
-                    layer.type = 'Hypermap:WorldMap'
-                    layer.title = title
-                    layer.abstract = abstract
-                    layer.is_public = is_public
-                    layer.url = endpoint
-                    layer.page_url = page_url
-                    # category and owner username
-                    layer_wm, created = LayerWM.objects.get_or_create(layer=layer)
-                    layer_wm.category = category
-                    layer_wm.username = username
-                    layer_wm.temporal_extent_start = temporal_extent_start
-                    layer_wm.temporal_extent_end = temporal_extent_end
-                    layer_wm.save()
-                    # bbox [x0, y0, x1, y1]
-                    # check if it is a valid bbox (TODO improve this check)
-                    bbox = bbox.replace('-inf', 'None')
-                    bbox = bbox.replace('inf', 'None')
-                    if bbox.count(',') == 3:
-                        bbox_list = bbox[1:-1].split(',')
-                    else:
-                        bbox_list = [None, None, None, None]
-                    x0 = format_float(bbox_list[0])
-                    y0 = format_float(bbox_list[1])
-                    x1 = format_float(bbox_list[2])
-                    y1 = format_float(bbox_list[3])
-                    # In many cases for some reason to be fixed GeoServer has x coordinates flipped in WM.
-                    x0, x1 = flip_coordinates(x0, x1)
-                    y0, y1 = flip_coordinates(y0, y1)
-                    layer.bbox_x0 = x0
-                    layer.bbox_y0 = y0
-                    layer.bbox_x1 = x1
-                    layer.bbox_y1 = y1
-                    # keywords
-                    keywords = []
-                    for keyword in row['keywords']:
-                        keywords.append(keyword['name'])
-                    layer.keywords.all().delete()
-                    for keyword in keywords:
-                        layer.keywords.add(keyword)
-                    layer.wkt_geometry = bbox2wktpolygon([x0, y0, x1, y1])
-                    layer.xml = create_metadata_record(
-                        identifier=str(layer.uuid),
-                        source=endpoint,
-                        links=links,
-                        format='Hypermap:WorldMap',
-                        type=layer.csw_type,
-                        relation=service.id_string,
-                        title=layer.title,
-                        alternative=name,
-                        abstract=layer.abstract,
-                        keywords=keywords,
-                        wkt_geometry=layer.wkt_geometry
-                    )
-                    layer.anytext = gen_anytext(layer.title, layer.abstract, keywords)
-                    layer.save()
-                    # dates
-                    add_mined_dates(layer)
-                    add_metadata_dates_to_layer([layer_wm.temporal_extent_start, layer_wm.temporal_extent_end], layer)
-                    layer_n = layer_n + 1
-                    # exits if DEBUG_SERVICES
-                    LOGGER.debug("Updated layer n. %s/%s" % (layer_n, total))
-                    if DEBUG_SERVICES and layer_n == DEBUG_LAYER_NUMBER:
-                        return
-
-        except Exception as err:
-            LOGGER.error('Error! %s' % err)
+    updated = []
+    try:
+        updated = harvest_worldmap(
+            service, 'http://worldmap.harvard.edu/api/1.5/layer/', 'created_dttm', parse_wm_legacy_row,
+            update_worldmap_layer, num_layers=num_layers, incremental=incremental
+        )
+    except Exception as err:
+        LOGGER.error('Error! %s' % err)
 
     # update deleted layers. For now we check the whole set of deleted layers
     # we should optimize it if the list will grow
     # TODO implement the actions application
-    url = 'http://worldmap.harvard.edu/api/1.5/actionlayerdelete/?format=json'
-    LOGGER.debug('Fetching %s for detecting deleted layers' % url)
-    response = requests.get(url)
-    data = json.loads(response.content)
-    for deleted_layer in data['objects']:
-        if Layer.objects.filter(uuid=deleted_layer['args']).count() > 0:
-            layer = Layer.objects.get(uuid=deleted_layer['args'])
-            layer.was_deleted = True
-            layer.save()
-            LOGGER.debug('Layer %s marked as deleted' % layer.uuid)
+    mark_deleted_layers(service, 'http://worldmap.harvard.edu/api/1.5/actionlayerdelete/?format=json')
+    return updated
 
 
 def update_layers_warper(service):
@@ -1542,6 +1705,34 @@ def update_layers_warper(service):
     Update layers for a Warper service.
     Sample endpoint: http://warp.worldmap.harvard.edu/maps
     """
+
+    def update_layer(layer, warper_layer):
+        # update fields
+        # links = [['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
+        name = warper_layer['id']
+        bbox = warper_layer['bbox']
+        layer.type = 'Hypermap:WARPER'
+        layer.title = warper_layer['title']
+        layer.abstract = warper_layer['description']
+        layer.is_public = True
+        layer.url = '%s/wms/%s?' % (service.url, name)
+        layer.page_url = '%s/%s' % (service.url, name)
+        # bbox
+        x0 = None
+        y0 = None
+        x1 = None
+        y1 = None
+        if bbox:
+            bbox_list = bbox.split(',')
+            x0 = format_float(bbox_list[0])
+            y0 = format_float(bbox_list[1])
+            x1 = format_float(bbox_list[2])
+            y1 = format_float(bbox_list[3])
+        layer.bbox_x0 = x0
+        layer.bbox_y0 = y0
+        layer.bbox_x1 = x1
+        layer.bbox_y1 = y1
+
     params = {'field': 'title', 'query': '', 'show_warped': '1', 'format': 'json'}
     headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
     request = requests.get(service.url, headers=headers, params=params)
@@ -1563,14 +1754,8 @@ def update_layers_warper(service):
             request = requests.get(service.url, headers=headers, params=params)
             records = json.loads(request.content)
             LOGGER.debug('Fetched %s' % request.url)
-            layers = records['items']
-            layer_n = 0
-            total = len(layers)
-            for layer in layers:
-                name = layer['id']
-                title = layer['title']
-                abstract = layer['description']
-                bbox = layer['bbox']
+            harvested = []
+            for layer in records['items']:
                 # dates
                 dates = []
                 if 'published_date' in layer:
@@ -1581,40 +1766,12 @@ def update_layers_warper(service):
                     dates.append(layer['depicts_year'])
                 if 'issue_year' in layer:
                     dates.append(layer['issue_year'])
-                layer, created = Layer.objects.get_or_create(name=name, service=service, catalog=service.catalog)
-                if layer.active:
-                    # update fields
-                    # links = [['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
-                    layer.type = 'Hypermap:WARPER'
-                    layer.title = title
-                    layer.abstract = abstract
-                    layer.is_public = True
-                    layer.url = '%s/wms/%s?' % (service.url, name)
-                    layer.page_url = '%s/%s' % (service.url, name)
-                    # bbox
-                    x0 = None
-                    y0 = None
-                    x1 = None
-                    y1 = None
-                    if bbox:
-                        bbox_list = bbox.split(',')
-                        x0 = format_float(bbox_list[0])
-                        y0 = format_float(bbox_list[1])
-                        x1 = format_float(bbox_list[2])
-                        y1 = format_float(bbox_list[3])
-                    layer.bbox_x0 = x0
-                    layer.bbox_y0 = y0
-                    layer.bbox_x1 = x1
-                    layer.bbox_y1 = y1
-                    layer.save()
-                    # dates
-                    add_mined_dates(layer)
-                    add_metadata_dates_to_layer(dates, layer)
-                layer_n = layer_n + 1
-                # exits if DEBUG_SERVICES
-                LOGGER.debug("Updating layer n. %s/%s" % (layer_n, total))
-                if DEBUG_SERVICES and layer_n == DEBUG_LAYER_NUMBER:
-                    return
+                harvested.append(HarvestedLayer({'name': layer['id']}, layer, dates=dates))
+            # exits if DEBUG_SERVICES
+            if DEBUG_SERVICES:
+                bulk_upsert_layers(service, harvested[:DEBUG_LAYER_NUMBER], update_layer)
+                return
+            bulk_upsert_layers(service, harvested, update_layer)
 
     except Exception as err:
         message = "update_layers_warper: {0}. request={1} response={2}".format(
@@ -1636,8 +1793,44 @@ def update_layers_esri_mapserver(service, greedy_opt=False):
     Update layers for an ESRI REST MapServer.
     Sample endpoint: https://gis.ngdc.noaa.gov/arcgis/rest/services/SampleWorldCities/MapServer/?f=json
     """
+
+    def update_layer(layer, esri_layer):
+        layer.type = 'ESRI:ArcGIS:MapServer'
+        links = [[layer.type, service.url],
+                 ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
+        layer.title = esri_layer['name']
+        layer.abstract = esri_service.get('serviceDescription')
+        layer.url = service.url
+        layer.page_url = layer.get_absolute_url
+        links.append([
+            'WWW:LINK',
+            settings.SITE_URL.rstrip('/') + layer.page_url
+        ])
+        try:
+            layer.bbox_x0 = esri_layer['extent']['xmin']
+            layer.bbox_y0 = esri_layer['extent']['ymin']
+            layer.bbox_x1 = esri_layer['extent']['xmax']
+            layer.bbox_y1 = esri_layer['extent']['ymax']
+        except Exception:
+            pass
+        layer.wkt_geometry = bbox2wktpolygon([layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1])
+        layer.xml = create_metadata_record(
+            identifier=str(layer.uuid),
+            source=service.url,
+            links=links,
+            format='ESRI:ArcGIS:MapServer',
+            type=layer.csw_type,
+            relation=service.id_string,
+            title=layer.title,
+            alternative=layer.title,
+            abstract=layer.abstract,
+            wkt_geometry=layer.wkt_geometry
+        )
+        layer.anytext = gen_anytext(layer.title, layer.abstract)
+
     try:
-        esri_service = ArcMapService(service.url)
+        # the JSON downloaded by the crawl of the ArcGIS REST endpoint, if any
+        esri_service = get_service_json(service.url)
         # set srs
         # both mapserver and imageserver exposes just one srs at the service level
         # not sure if other ones are supported, for now we just store this one
@@ -1649,15 +1842,15 @@ def update_layers_esri_mapserver(service, greedy_opt=False):
         #     object = json.loads(req.content)
         #     srs = int(object['codes'][0]['code'])
 
-        srs_code = esri_service.spatialReference.wkid
+        srs_code = esri_service['spatialReference']['wkid']
         srs, created = SpatialReferenceSystem.objects.get_or_create(code=srs_code)
         service.srs.add(srs)
 
         service.update_validity()
 
         # check if it has a WMS interface
-        if 'supportedExtensions' in esri_service._json_struct and greedy_opt:
-            if 'WMSServer' in esri_service._json_struct['supportedExtensions']:
+        if 'supportedExtensions' in esri_service and greedy_opt:
+            if 'WMSServer' in esri_service['supportedExtensions']:
                 # we need to change the url
                 # http://cga1.cga.harvard.edu/arcgis/rest/services/ecuador/ecuadordata/MapServer?f=pjson
                 # http://cga1.cga.harvard.edu/arcgis/services/ecuador/
@@ -1671,70 +1864,19 @@ def update_layers_esri_mapserver(service, greedy_opt=False):
                 # import here as otherwise is circular (TODO refactor)
                 from utils import create_service_from_endpoint
                 create_service_from_endpoint(wms_url, 'OGC:WMS', catalog=service.catalog)
-        # now process the REST interface
-        layer_n = 0
-        total = len(esri_service.layers)
-        for esri_layer in esri_service.layers:
-            # in some case the json is invalid
-            # esri_layer._json_struct
+        # now process the REST interface, requesting all the layers at once if the server supports it
+        harvested = []
+        for esri_layer in get_layers_json(service.url, esri_service):
+            # in some case the json is invalid, such layers are skipped by get_layers_json
             # {u'currentVersion': 10.01,
             # u'error':
             # {u'message': u'An unexpected error occurred processing the request.', u'code': 500, u'details': []}}
-            if 'error' not in esri_layer._json_struct:
-                LOGGER.debug('Updating layer %s' % esri_layer.name)
-                layer, created = Layer.objects.get_or_create(
-                    name=esri_layer.id,
-                    service=service,
-                    catalog=service.catalog
-                )
-                if layer.active:
-                    layer.type = 'ESRI:ArcGIS:MapServer'
-                    links = [[layer.type, service.url],
-                             ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
-                    layer.title = esri_layer.name
-                    layer.abstract = esri_service.serviceDescription
-                    layer.url = service.url
-                    layer.page_url = layer.get_absolute_url
-                    links.append([
-                        'WWW:LINK',
-                        settings.SITE_URL.rstrip('/') + layer.page_url
-                    ])
-                    try:
-                        layer.bbox_x0 = esri_layer.extent.xmin
-                        layer.bbox_y0 = esri_layer.extent.ymin
-                        layer.bbox_x1 = esri_layer.extent.xmax
-                        layer.bbox_y1 = esri_layer.extent.ymax
-                    except KeyError:
-                        pass
-                    try:
-                        layer.bbox_x0 = esri_layer._json_struct['extent']['xmin']
-                        layer.bbox_y0 = esri_layer._json_struct['extent']['ymin']
-                        layer.bbox_x1 = esri_layer._json_struct['extent']['xmax']
-                        layer.bbox_y1 = esri_layer._json_struct['extent']['ymax']
-                    except Exception:
-                        pass
-                    layer.wkt_geometry = bbox2wktpolygon([layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1])
-                    layer.xml = create_metadata_record(
-                        identifier=str(layer.uuid),
-                        source=service.url,
-                        links=links,
-                        format='ESRI:ArcGIS:MapServer',
-                        type=layer.csw_type,
-                        relation=service.id_string,
-                        title=layer.title,
-                        alternative=layer.title,
-                        abstract=layer.abstract,
-                        wkt_geometry=layer.wkt_geometry
-                    )
-                    layer.anytext = gen_anytext(layer.title, layer.abstract)
-                    layer.save()
-                    # dates
-                    add_mined_dates(layer)
-                layer_n = layer_n + 1
-                # exits if DEBUG_SERVICES
-                LOGGER.debug("Updating layer n. %s/%s" % (layer_n, total))
-                if DEBUG_SERVICES and layer_n == DEBUG_LAYER_NUMBER:
-                    return
+            LOGGER.debug('Updating layer %s' % esri_layer['name'])
+            harvested.append(HarvestedLayer({'name': esri_layer['id']}, esri_layer))
+        # exits if DEBUG_SERVICES
+        if DEBUG_SERVICES:
+            harvested = harvested[:DEBUG_LAYER_NUMBER]
+        bulk_upsert_layers(service, harvested, update_layer)
     except Exception as err:
         message = "update_layers_esri_mapserver: {0}".format(
             err
@@ -1753,52 +1895,50 @@ def update_layers_esri_imageserver(service):
     Update layers for an ESRI REST ImageServer.
     Sample endpoint: https://gis.ngdc.noaa.gov/arcgis/rest/services/bag_bathymetry/ImageServer/?f=json
     """
+
+    def update_layer(layer, obj):
+        layer.type = 'ESRI:ArcGIS:ImageServer'
+        links = [[layer.type, service.url],
+                 ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
+        layer.title = obj['name']
+        layer.abstract = obj.get('serviceDescription')
+        layer.url = service.url
+        layer.bbox_x0 = str(obj['extent']['xmin'])
+        layer.bbox_y0 = str(obj['extent']['ymin'])
+        layer.bbox_x1 = str(obj['extent']['xmax'])
+        layer.bbox_y1 = str(obj['extent']['ymax'])
+        layer.page_url = layer.get_absolute_url
+        links.append([
+            'WWW:LINK',
+            settings.SITE_URL.rstrip('/') + layer.page_url
+        ])
+        layer.wkt_geometry = bbox2wktpolygon([layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1])
+        layer.xml = create_metadata_record(
+            identifier=str(layer.uuid),
+            source=service.url,
+            links=links,
+            format='ESRI:ArcGIS:ImageServer',
+            type=layer.csw_type,
+            relation=service.id_string,
+            title=layer.title,
+            alternative=layer.title,
+            abstract=layer.abstract,
+            wkt_geometry=layer.wkt_geometry
+        )
+        layer.anytext = gen_anytext(layer.title, layer.abstract)
+
     try:
-        esri_service = ArcImageService(service.url)
         # set srs
         # both mapserver and imageserver exposes just one srs at the service level
         # not sure if other ones are supported, for now we just store this one
-        obj = json.loads(esri_service._contents)
+        obj = get_service_json(service.url)
         srs_code = obj['spatialReference']['wkid']
         srs, created = SpatialReferenceSystem.objects.get_or_create(code=srs_code)
         service.srs.add(srs)
 
         service.update_validity()
 
-        layer, created = Layer.objects.get_or_create(name=obj['name'], service=service, catalog=service.catalog)
-        if layer.active:
-            layer.type = 'ESRI:ArcGIS:ImageServer'
-            links = [[layer.type, service.url],
-                     ['OGC:WMTS', settings.SITE_URL.rstrip('/') + '/' + layer.get_url_endpoint()]]
-            layer.title = obj['name']
-            layer.abstract = esri_service.serviceDescription
-            layer.url = service.url
-            layer.bbox_x0 = str(obj['extent']['xmin'])
-            layer.bbox_y0 = str(obj['extent']['ymin'])
-            layer.bbox_x1 = str(obj['extent']['xmax'])
-            layer.bbox_y1 = str(obj['extent']['ymax'])
-            layer.page_url = layer.get_absolute_url
-            links.append([
-                'WWW:LINK',
-                settings.SITE_URL.rstrip('/') + layer.page_url
-            ])
-            layer.wkt_geometry = bbox2wktpolygon([layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1])
-            layer.xml = create_metadata_record(
-                identifier=str(layer.uuid),
-                source=service.url,
-                links=links,
-                format='ESRI:ArcGIS:ImageServer',
-                type=layer.csw_type,
-                relation=service.id_string,
-                title=layer.title,
-                alternative=layer.title,
-                abstract=layer.abstract,
-                wkt_geometry=layer.wkt_geometry
-            )
-            layer.anytext = gen_anytext(layer.title, layer.abstract)
-            layer.save()
-            # dates
-            add_mined_dates(layer)
+        bulk_upsert_layers(service, [HarvestedLayer({'name': obj['name']}, obj)], update_layer)
     except Exception as err:
         message = "update_layers_esri_imageserver: {0}".format(
             err
@@ -1818,16 +1958,7 @@ def endpointlist_post_save(instance, *args, **kwargs):
     """
     Used to process the lines of the endpoint list.
     """
-    with open(instance.upload.file.name, mode='rb') as f:
-        lines = f.readlines()
-    for url in lines:
-        if len(url) > 255:
-            LOGGER.debug('Skipping this endpoint, as it is more than 255 characters: %s' % url)
-        else:
-            if Endpoint.objects.filter(url=url, catalog=instance.catalog).count() == 0:
-                endpoint = Endpoint(url=url, endpoint_list=instance)
-                endpoint.catalog = instance.catalog
-                endpoint.save()
+    import_endpoint_list(instance)
     if not settings.REGISTRY_SKIP_CELERY:
         update_endpoints.delay(instance.id)
     else:
@@ -1879,29 +2010,36 @@ def service_post_save(instance, *args, **kwargs):
         check_service.delay(instance.id)
 
 
-def layer_pre_save(instance, *args, **kwargs):
+def get_layer_validity(layer):
     """
-    Used to check layer validity.
+    Return the validity of a layer.
     """
 
     is_valid = True
 
     # we do not need to check validity for WM layers
-    if not instance.service.type == 'Hypermap:WorldMap':
+    if not layer.service.type == 'Hypermap:WorldMap':
 
         # 0. a layer is invalid if its service its invalid as well
-        if not instance.service.is_valid:
+        if not layer.service.is_valid:
             is_valid = False
-            LOGGER.debug('Layer with id %s is marked invalid because its service is invalid' % instance.id)
+            LOGGER.debug('Layer with id %s is marked invalid because its service is invalid' % layer.id)
 
         # 1. a layer is invalid with an extent within (-2, -2, +2, +2)
-        if instance.bbox_x0 > -2 and instance.bbox_x1 < 2 and instance.bbox_y0 > -2 and instance.bbox_y1 < 2:
+        if layer.bbox_x0 > -2 and layer.bbox_x1 < 2 and layer.bbox_y0 > -2 and layer.bbox_y1 < 2:
             is_valid = False
             LOGGER.debug(
-                'Layer with id %s is marked invalid because its extent is within (-2, -2, +2, +2)' % instance.id
+                'Layer with id %s is marked invalid because its extent is within (-2, -2, +2, +2)' % layer.id
             )
 
-    instance.is_valid = is_valid
+    return is_valid
+
+
+def layer_pre_save(instance, *args, **kwargs):
+    """
+    Used to check layer validity.
+    """
+    instance.is_valid = get_layer_validity(instance)
 
 
 def layer_post_save(instance, *args, **kwargs):
@@ -1917,6 +2055,14 @@ def layer_post_save(instance, *args, **kwargs):
         index_layer(instance.id)
 
 
+def check_post_save(instance, created, *args, **kwargs):
+    """
+    Used to add a new check to the statistics of its resource.
+    """
+    if created:
+        update_check_stats([instance])
+
+
 def issue_post_delete(instance, *args, **kwargs):
     """
     Used to do reindex layers/services when a issue is removed form them.
@@ -1941,3 +2087,4 @@ signals.post_save.connect(service_post_save, sender=Service)
 signals.pre_save.connect(layer_pre_save, sender=Layer)
 signals.post_save.connect(layer_post_save, sender=Layer)
 signals.post_delete.connect(issue_post_delete, sender=Issue)
+signals.post_save.connect(check_post_save, sender=Check)
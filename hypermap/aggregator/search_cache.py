@@ -0,0 +1,144 @@
+import json
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from hypermap.aggregator.lrucache import LRUCache
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_SEARCH_CACHE_TTL = getattr(settings, 'REGISTRY_SEARCH_CACHE_TTL', 60)
+REGISTRY_SEARCH_CACHE_SIZE = getattr(settings, 'REGISTRY_SEARCH_CACHE_SIZE', 256)
+# name of a cache of CACHES sharing the search responses between processes, for example a Redis cache
+REGISTRY_SEARCH_CACHE = getattr(settings, 'REGISTRY_SEARCH_CACHE', None)
+REGISTRY_SEARCH_STATS_TTL = getattr(settings, 'REGISTRY_SEARCH_STATS_TTL', 600)
+# seconds before a write to the search backend is visible to the searches: longer than the commitWithin
+# of the Solr updates (1.5 s) and the refresh interval of Elasticsearch (1 s)
+REGISTRY_SEARCH_VISIBILITY_DELAY = getattr(settings, 'REGISTRY_SEARCH_VISIBILITY_DELAY', 3)
+
+GENERATION_KEY = 'search_index_generation'
+# set while the last writes may not be visible yet
+PENDING_KEY = 'search_index_pending'
+
+# search responses by catalog, query and index generation
+search_cache = LRUCache(REGISTRY_SEARCH_CACHE_SIZE, REGISTRY_SEARCH_CACHE_TTL)
+# statistics of the indexed documents, such as the min and max dates, by name and index generation
+stats_cache = LRUCache(64, REGISTRY_SEARCH_STATS_TTL)
+
+
+def get_shared_cache():
+    if REGISTRY_SEARCH_CACHE:
+        return caches[REGISTRY_SEARCH_CACHE]
+    return None
+
+
+def get_generation_cache():
+    """
+    The generation must be seen by the indexing workers and by the web processes:
+    it is kept in the shared cache if there is one, else in the default cache.
+    """
+    return get_shared_cache() or cache
+
+
+def get_index_generation():
+    """
+    The number of writes to the search backend, used to invalidate the cached search responses.
+    """
+    generation_cache = get_generation_cache()
+    generation = generation_cache.get(GENERATION_KEY)
+    if generation is None:
+        generation_cache.add(GENERATION_KEY, 0, None)
+        generation = generation_cache.get(GENERATION_KEY, 0)
+    return generation
+
+
+def bump_index_generation():
+    """
+    Invalidate all the cached search responses, to be called after every write to the search backend.
+    The responses are not cached either until the write is visible, see is_index_pending.
+    """
+    generation_cache = get_generation_cache()
+    generation_cache.set(PENDING_KEY, True, REGISTRY_SEARCH_VISIBILITY_DELAY)
+    try:
+        return generation_cache.incr(GENERATION_KEY)
+    except ValueError:
+        # the key is missing, or was evicted
+        generation_cache.add(GENERATION_KEY, 1, None)
+        return generation_cache.get(GENERATION_KEY, 1)
+
+
+def is_index_pending():
+    """
+    True while the last writes to the search backend may not be committed or refreshed: a search may
+    not see them, and its response must not be cached under the new generation.
+    """
+    return bool(get_generation_cache().get(PENDING_KEY))
+
+
+def get_search_key(catalog_slug, params, generation):
+    """
+    Key of the response of a search: the validated parameters are normalized, so that the same query
+    gives the same key whatever the order and the format of its parameters.
+    """
+    query = json.dumps(params, sort_keys=True, default=unicode)
+    return 'search:%s:%s:%s' % (
+        catalog_slug, generation, hashlib.sha1(query.encode('utf-8')).hexdigest()
+    )
+
+
+def get_cached_search(catalog_slug, params):
+    """
+    The cached response of a search, from the in-process cache, or from the shared cache.
+    :return: (key, response) where response is None if it is not cached, and key is None if the response
+        must not be cached as the last writes may not be visible yet.
+    """
+    if is_index_pending():
+        return None, None
+    key = get_search_key(catalog_slug, params, get_index_generation())
+    data = search_cache.get(key)
+    if data is not None:
+        return key, data
+    shared_cache = get_shared_cache()
+    if shared_cache is not None:
+        data = shared_cache.get(key)
+        if data is not None:
+            search_cache.set(key, data)
+    return key, data
+
+
+def set_cached_search(key, data):
+    if key is None:
+        return
+    search_cache.set(key, data)
+    shared_cache = get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.set(key, data, REGISTRY_SEARCH_CACHE_TTL)
+
+
+def get_index_stats(name, compute):
+    """
+    Statistics of the indexed documents, computed once per index generation, as they only change
+    when the index does. They are computed but not cached while the last writes may not be visible.
+    :param name: identifies the statistics, for example the search endpoint and the field.
+    :param compute: function returning the statistics, or None if they cannot be computed, which is not cached.
+    """
+    if is_index_pending():
+        return compute()
+    key = 'search_stats:%s:%s' % (get_index_generation(), hashlib.sha1(name.encode('utf-8')).hexdigest())
+    stats = stats_cache.get(key)
+    if stats is not None:
+        return stats
+    shared_cache = get_shared_cache()
+    if shared_cache is not None:
+        stats = shared_cache.get(key)
+    if stats is None:
+        stats = compute()
+        if stats is None:
+            return None
+        if shared_cache is not None:
+            shared_cache.set(key, stats, REGISTRY_SEARCH_STATS_TTL)
+    stats_cache.set(key, stats)
+    return stats
@@ -0,0 +1,216 @@
+import os
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.conf import settings
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_SEARCH_POOL_SIZE = getattr(settings, 'REGISTRY_SEARCH_POOL_SIZE', 10)
+REGISTRY_SEARCH_RETRIES = getattr(settings, 'REGISTRY_SEARCH_RETRIES', 3)
+REGISTRY_SEARCH_BACKOFF = getattr(settings, 'REGISTRY_SEARCH_BACKOFF', 0.3)
+REGISTRY_SEARCH_TIMEOUT = getattr(settings, 'REGISTRY_SEARCH_TIMEOUT', 30)
+REGISTRY_SEARCH_CAPABILITIES_TTL = getattr(settings, 'REGISTRY_SEARCH_CAPABILITIES_TTL', 300)
+
+# Elasticsearch field types which can be sorted on
+SORTABLE_TYPES = ('long', 'integer', 'short', 'keyword')
+
+_lock = threading.Lock()
+_sessions = {}
+_es_clients = {}
+_es_capabilities = {}
+
+
+class SearchSession(requests.Session):
+    """
+    requests session with a default timeout, as requests waits forever unless a timeout is given.
+    """
+
+    def __init__(self, timeout=None):
+        super(SearchSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(SearchSession, self).request(method, url, **kwargs)
+
+
+def build_session():
+    """
+    Create a session keeping up to REGISTRY_SEARCH_POOL_SIZE connections alive per host,
+    and retrying connection errors and 502/503/504 responses with an exponential backoff.
+    """
+    session = SearchSession(timeout=REGISTRY_SEARCH_TIMEOUT)
+    retries = Retry(
+        total=REGISTRY_SEARCH_RETRIES,
+        backoff_factor=REGISTRY_SEARCH_BACKOFF,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=REGISTRY_SEARCH_POOL_SIZE,
+        pool_maxsize=REGISTRY_SEARCH_POOL_SIZE,
+        max_retries=retries,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _get_for_process(clients, key, factory):
+    """
+    Return the client of this process for key, creating it on first use.
+    Clients are kept per process id, so that forked workers do not share the connections of their parent.
+    """
+    pid = os.getpid()
+    client = clients.get((pid, key))
+    if client is None:
+        with _lock:
+            client = clients.get((pid, key))
+            if client is None:
+                for client_key in list(clients):
+                    if client_key[0] != pid:
+                        del clients[client_key]
+                client = clients[(pid, key)] = factory()
+    return client
+
+
+def get_session():
+    """
+    Return the pooled session used for all the HTTP calls to the search backend.
+    """
+    return _get_for_process(_sessions, None, build_session)
+
+
+def get_solr(url, timeout=60):
+    """
+    Return a pysolr client using the pooled session.
+    """
+    import pysolr
+    solr = pysolr.Solr(url, timeout=timeout)
+    solr.session = get_session()
+    return solr
+
+
+def get_elasticsearch(url):
+    """
+    Return the Elasticsearch client for url, which keeps its own urllib3 connection pool.
+    """
+    def factory():
+        from elasticsearch import Elasticsearch
+        return Elasticsearch(
+            hosts=[url],
+            maxsize=REGISTRY_SEARCH_POOL_SIZE,
+            timeout=REGISTRY_SEARCH_TIMEOUT,
+            max_retries=REGISTRY_SEARCH_RETRIES,
+            retry_on_timeout=True,
+        )
+    return _get_for_process(_es_clients, url, factory)
+
+
+class ESCapabilities(object):
+    """
+    Version, existing indices and sortable fields of an Elasticsearch cluster, discovered once and then
+    refreshed every ttl seconds, or when invalidated after an error about a missing index.
+    """
+
+    # version used when the cluster does not answer
+    default_version = 2
+
+    def __init__(self, url, ttl=REGISTRY_SEARCH_CAPABILITIES_TTL):
+        self.url = url
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_time = 0
+        self._indices = {}
+        self._sort_fields = {}
+
+    def version(self):
+        """
+        Return the major version of the cluster.
+        """
+        if self._version is None or time.time() - self._version_time > self.ttl:
+            response = get_session().get(self.url)
+            if not response.ok:
+                return self.default_version
+            # looks ugly but will work on normal ES response for "/".
+            self._version = int(response.json()["version"]["number"].split('.')[0])
+            self._version_time = time.time()
+        return self._version
+
+    def ensure_index(self, index, create):
+        """
+        Call create(index) unless the index was created or checked in the last ttl seconds.
+        """
+        checked_time = self._indices.get(index)
+        if checked_time is not None and time.time() - checked_time <= self.ttl:
+            return
+        with self._lock:
+            checked_time = self._indices.get(index)
+            if checked_time is None or time.time() - checked_time > self.ttl:
+                create(index)
+                self._indices[index] = time.time()
+
+    def sort_field(self, index, field):
+        """
+        The name of the field of an index to sort on for field: the field itself if it is mapped as a number
+        or a keyword, else its keyword sub-field, as Elasticsearch 5 maps the strings of the indices created
+        without an explicit mapping. None if neither can be sorted on.
+        """
+        checked = self._sort_fields.get((index, field))
+        if checked is not None and time.time() - checked[1] <= self.ttl:
+            return checked[0]
+        response = get_session().get('%s/%s/_mapping/field/%s,%s.keyword' % (self.url, index, field, field))
+        types = {}
+        if response.ok:
+            for index_mappings in response.json().values():
+                mappings = index_mappings.get('mappings', {})
+                # the fields are grouped by document type before Elasticsearch 7
+                for fields in [mappings] + [value for value in mappings.values() if isinstance(value, dict)]:
+                    for name, field_mapping in fields.items():
+                        if isinstance(field_mapping, dict) and 'mapping' in field_mapping:
+                            types[name] = list(field_mapping['mapping'].values())[0].get('type')
+        sort_field = None
+        for name in (field, '%s.keyword' % field):
+            if types.get(name) in SORTABLE_TYPES:
+                sort_field = name
+                break
+        if response.ok:
+            self._sort_fields[(index, field)] = (sort_field, time.time())
+        return sort_field
+
+    def invalidate(self, index=None):
+        """
+        Forget an index, or everything if no index is given.
+        """
+        with self._lock:
+            if index is None:
+                self._indices.clear()
+                self._sort_fields.clear()
+                self._version = None
+            else:
+                self._indices.pop(index, None)
+                for key in [key for key in self._sort_fields if key[0] == index]:
+                    self._sort_fields.pop(key, None)
+
+
+def get_es_capabilities(url):
+    """
+    Return the ESCapabilities of the cluster at url for this process.
+    """
+    return _get_for_process(_es_capabilities, url, lambda: ESCapabilities(url))
+
+
+def is_index_missing_error(error):
+    """
+    True if an Elasticsearch error or response is about an index which does not exist.
+    """
+    error = str(error)
+    return 'index_not_found_exception' in error or 'IndexMissingException' in error
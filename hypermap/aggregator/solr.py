@@ -1,12 +1,11 @@
 import sys
-import pysolr
-import requests
 import logging
 import json
 
 from django.conf import settings
 
-from hypermap.aggregator.utils import layer2dict
+from hypermap.aggregator.utils import layer2dict, get_layers_check_stats
+from hypermap.aggregator.search_client import get_session, get_solr
 
 SEARCH_URL = settings.REGISTRY_SEARCH_URL.split('+')[1]
 
@@ -19,27 +18,44 @@ class SolrHypermap(object):
     def layers_to_solr(self, layers):
         """
         Sync n layers in Solr.
+        Use hypermap.aggregator.utils.get_layers_for_indexing to build the layers queryset,
+        so that the related objects are not fetched for each layer.
         """
+        layers_dict_list, layers_errors_ids = self.layers_to_dicts(layers)
+        success, docs_errors_ids = self.dicts_to_solr(layers_dict_list)
+        return success, layers_errors_ids + docs_errors_ids
 
+    def layers_to_dicts(self, layers):
+        """
+        Convert n layers to Solr documents.
+        :return: documents list, [layer id, message] list for the layers that could not be converted
+        """
         layers_dict_list = []
-        layers_success_ids = []
         layers_errors_ids = []
 
+        check_stats = get_layers_check_stats([layer.id for layer in layers])
+
         for layer in layers:
-            layer_dict, message = layer2dict(layer)
+            layer_dict, message = layer2dict(layer, check_stats[layer.id])
             if not layer_dict:
                 layers_errors_ids.append([layer.id, message])
                 LOGGER.error(message)
             else:
                 layers_dict_list.append(layer_dict)
-                layers_success_ids.append(layer.id)
 
+        return layers_dict_list, layers_errors_ids
+
+    def dicts_to_solr(self, layers_dict_list):
+        """
+        Send n Solr documents (see layers_to_dicts) in a single request.
+        """
+        layers_errors_ids = []
         layers_json = json.dumps(layers_dict_list)
         try:
             url_solr_update = '%s/solr/hypermap/update/json/docs' % SEARCH_URL
             headers = {"content-type": "application/json"}
             params = {"commitWithin": 1500}
-            requests.post(url_solr_update, data=layers_json, params=params, headers=headers)
+            get_session().post(url_solr_update, data=layers_json, params=params, headers=headers)
             LOGGER.info('Solr synced for the given layers')
         except Exception:
             message = "Error saving solr records: %s" % sys.exc_info()[1]
@@ -65,7 +81,7 @@ class SolrHypermap(object):
                 url_solr_update = '%s/solr/hypermap/update/json/docs' % SEARCH_URL
                 headers = {"content-type": "application/json"}
                 params = {"commitWithin": 1500}
-                res = requests.post(url_solr_update, data=layer_json, params=params,  headers=headers)
+                res = get_session().post(url_solr_update, data=layer_json, params=params,  headers=headers)
                 res = res.json()
                 if 'error' in res:
                     success = False
@@ -83,7 +99,7 @@ class SolrHypermap(object):
     def clear_solr(self, catalog="hypermap"):
         """Clear all indexes in the solr core"""
         solr_url = "{0}/solr/{1}".format(SEARCH_URL, catalog)
-        solr = pysolr.Solr(solr_url, timeout=60)
+        solr = get_solr(solr_url, timeout=60)
         solr.delete(q='*:*')
         LOGGER.debug('Solr core cleared')
 
@@ -92,10 +108,23 @@ class SolrHypermap(object):
         Remove a layer from Solr.
         """
         solr_url = "{0}/solr/{1}".format(SEARCH_URL, catalog)
-        solr = pysolr.Solr(solr_url, timeout=60)
+        solr = get_solr(solr_url, timeout=60)
         solr.delete(q='uuid:%s' % layer_uiid)
         LOGGER.debug('Layer %s removed from Solr' % layer_uiid)
 
+    def remove_layers(self, layers_ids, catalog="hypermap", chunk_size=500):
+        """
+        Remove n layers from Solr, sending a single delete by id request per chunk.
+        """
+        solr_url = "{0}/solr/{1}".format(SEARCH_URL, catalog)
+        solr = get_solr(solr_url, timeout=60)
+        layers_ids = [str(layer_id) for layer_id in layers_ids]
+        for i in range(0, len(layers_ids), chunk_size):
+            chunk = layers_ids[i:i + chunk_size]
+            # commit once, with the last chunk
+            solr.delete(id=chunk, commit=i + chunk_size >= len(layers_ids))
+        LOGGER.debug('%s layers removed from Solr' % len(layers_ids))
+
     def update_schema(self, catalog="hypermap"):
         """
         set the mapping in solr.
@@ -118,7 +147,7 @@ class SolrHypermap(object):
                 "distanceUnits": "degrees"
             }
         }
-        requests.post(schema_url, json=location_rpt_quad_5m_payload)
+        get_session().post(schema_url, json=location_rpt_quad_5m_payload)
 
         # create a special type to implement ngrm text for search.
         text_ngrm_payload = {
@@ -152,7 +181,7 @@ class SolrHypermap(object):
                 }
             }
         }
-        requests.post(schema_url, json=text_ngrm_payload)
+        get_session().post(schema_url, json=text_ngrm_payload)
 
         # now the other fields
         fields = [
@@ -211,11 +240,11 @@ class SolrHypermap(object):
             data = {
                 "add-field": field
             }
-            requests.post(schema_url, json=data, headers=headers)
+            get_session().post(schema_url, json=data, headers=headers)
 
         for field in copy_fields:
             data = {
                 "add-copy-field": field
             }
             print data
-            requests.post(schema_url, json=data, headers=headers)
+            get_session().post(schema_url, json=data, headers=headers)
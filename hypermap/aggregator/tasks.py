@@ -6,7 +6,6 @@ from celery import shared_task, states
 from celery.exceptions import Ignore
 
 from django.conf import settings
-from django.core.cache import cache
 
 
 LOGGER = logging.getLogger(__name__)
@@ -49,14 +48,17 @@ def check_service(self, service_id):
     if getattr(settings, 'REGISTRY_HARVEST_SERVICES', True):
         service.update_layers()
 
-    layer_to_process = service.layer_set.all()
+    layer_to_process = service.layer_set.select_related('service', 'catalog')
     if DEBUG_SERVICES:
         layer_to_process = layer_to_process[0:DEBUG_LAYERS_NUMBER]
 
     service.check_available()
 
     # 2. check layers if the service is monitored and the layer is monitored
-    if service.is_monitored:
+    if service.is_monitored and getattr(settings, 'REGISTRY_CHECK_LAYERS_BY_SERVICE', False):
+        # check all the layers in this worker, with a bounded concurrency per host
+        check_service_layers(service, layer_to_process)
+    elif service.is_monitored:
         for layer in layer_to_process:
             if layer.is_monitored and not layer.was_deleted:
                 if not settings.REGISTRY_SKIP_CELERY:
@@ -72,6 +74,26 @@ def check_service(self, service_id):
             index_service(service.id)
 
 
+def check_service_layers(service, layers):
+    """
+    Check the monitored layers of a service with hypermap.aggregator.checker.check_layers,
+    and index the available ones. layers should be fetched with their service.
+    """
+    from hypermap.aggregator.checker import check_layers
+
+    checks = check_layers([layer for layer in layers if layer.is_monitored and not layer.was_deleted])
+    if not SEARCH_ENABLED:
+        return
+    # every time a layer is checked it should be indexed
+    available_ids = [layer.id for layer, check in checks if check.success]
+    if settings.REGISTRY_SKIP_CELERY:
+        for layer_id in available_ids:
+            index_layer(layer_id)
+    else:
+        from hypermap.aggregator.indexing import enqueue_layers
+        enqueue_layers(available_ids)
+
+
 @shared_task(bind=True, soft_time_limit=10)
 def check_layer(self, layer_id):
     from hypermap.aggregator.models import Layer
@@ -93,88 +115,19 @@ def check_layer(self, layer_id):
 @shared_task(bind=True)
 def index_cached_layers(self):
     """
-    Index and unindex all layers in the Django cache (Index all layers who have been checked).
+    Index and unindex all layers in the index queue (Index all layers who have been checked).
+    Several workers can run this task at the same time, each one claiming different batches.
     """
-    from hypermap.aggregator.models import Layer
-
-    if SEARCH_TYPE == 'solr':
-        from hypermap.aggregator.solr import SolrHypermap
-        solrobject = SolrHypermap()
-    else:
-        from hypermap.aggregator.elasticsearch_client import ESHypermap
-        from elasticsearch import helpers
-        es_client = ESHypermap()
+    from hypermap.aggregator.enums import INDEX_UPSERT, INDEX_DELETE
+    from hypermap.aggregator.indexing import process_index_queue
 
-    layers_cache = cache.get('layers')
-    deleted_layers_cache = cache.get('deleted_layers')
+    # 1. added layers
+    indexed = process_index_queue(INDEX_UPSERT)
+    LOGGER.debug('Synced %s queued layers to %s' % (indexed, SEARCH_TYPE))
 
-    # 1. added layers cache
-    if layers_cache:
-        layers_list = list(layers_cache)
-        LOGGER.debug('There are %s layers in cache: %s' % (len(layers_list), layers_list))
-
-        batch_size = settings.REGISTRY_SEARCH_BATCH_SIZE
-        batch_lists = [layers_list[i:i+batch_size] for i in range(0, len(layers_list), batch_size)]
-
-        for batch_list_ids in batch_lists:
-            layers = Layer.objects.filter(id__in=batch_list_ids)
-
-            if batch_size > len(layers):
-                batch_size = len(layers)
-
-            LOGGER.debug('Syncing %s/%s layers to %s: %s' % (batch_size, len(layers_cache), layers, SEARCH_TYPE))
-
-            try:
-                # SOLR
-                if SEARCH_TYPE == 'solr':
-                    success, layers_errors_ids = solrobject.layers_to_solr(layers)
-                    if success:
-                        # remove layers from cache here
-                        layers_cache = layers_cache.difference(set(batch_list_ids))
-                        LOGGER.debug('Removing layers with id %s from cache' % batch_list_ids)
-                        cache.set('layers', layers_cache)
-                # ES
-                elif SEARCH_TYPE == 'elasticsearch':
-                    with_bulk, success = True, False
-                    layers_to_index = [es_client.layer_to_es(layer, with_bulk) for layer in layers]
-                    message = helpers.bulk(es_client.es, layers_to_index)
-
-                    # Check that all layers where indexed...if not, don't clear cache.
-                    # TODO: Check why es does not index all layers at first.
-                    len_indexed_layers = message[0]
-                    if len_indexed_layers == len(layers):
-                        LOGGER.debug('%d layers indexed successfully' % (len_indexed_layers))
-                        success = True
-                    if success:
-                        # remove layers from cache here
-                        layers_cache = layers_cache.difference(set(batch_list_ids))
-                        cache.set('layers', layers_cache)
-                else:
-                    raise Exception("Incorrect SEARCH_TYPE=%s" % SEARCH_TYPE)
-            except Exception as e:
-                LOGGER.error('Layers were NOT indexed correctly')
-                LOGGER.error(e, exc_info=True)
-    else:
-        LOGGER.debug('No cached layers to add in search engine.')
-
-    # 2. deleted layers cache
-    if deleted_layers_cache:
-        layers_list = list(deleted_layers_cache)
-        LOGGER.debug('There are %s layers in cache for deleting: %s' % (len(layers_list), layers_list))
-        # TODO implement me: batch layer index deletion
-        for layer_id in layers_list:
-            # SOLR
-            if SEARCH_TYPE == 'solr':
-                if Layer.objects.filter(pk=layer_id).exists():
-                    layer = Layer.objects.get(id=layer_id)
-                    unindex_layer(layer.id, use_cache=False)
-                    deleted_layers_cache = deleted_layers_cache.difference(set([layer_id]))
-                    cache.set('deleted_layers', deleted_layers_cache)
-            else:
-                # TODO implement me
-                raise NotImplementedError
-    else:
-        LOGGER.debug('No cached layers to remove in search engine.')
+    # 2. deleted layers
+    unindexed = process_index_queue(INDEX_DELETE)
+    LOGGER.debug('Removed %s queued layers from %s' % (unindexed, SEARCH_TYPE))
 
 
 @shared_task(name="clear_index")
@@ -189,6 +142,8 @@ def clear_index():
         from hypermap.aggregator.elasticsearch_client import ESHypermap
         esobject = ESHypermap()
         esobject.clear_es()
+    from hypermap.aggregator.search_cache import bump_index_generation
+    bump_index_generation()
 
 
 @shared_task(bind=True)
@@ -200,9 +155,24 @@ def remove_service_checks(self, service_id):
     service = Service.objects.get(id=service_id)
 
     service.check_set.all().delete()
+    service.check_stats_set.all().delete()
+    service.check_rollup_set.all().delete()
     layer_to_process = service.layer_set.all()
     for layer in layer_to_process:
         layer.check_set.all().delete()
+        layer.check_stats_set.all().delete()
+        layer.check_rollup_set.all().delete()
+
+
+@shared_task(bind=True)
+def prune_checks(self):
+    """
+    Roll up and remove the checks older than REGISTRY_CHECK_RETENTION_DAYS.
+    """
+    from hypermap.aggregator.check_retention import prune_checks as prune_old_checks
+
+    pruned = prune_old_checks()
+    LOGGER.debug('Pruned %s checks' % pruned)
 
 
 @shared_task(bind=True)
@@ -232,8 +202,7 @@ def index_service(self, service_id):
 def index_layer(self, layer_id, use_cache=False):
     """
     Index a layer in the search backend.
-    If cache is set, append it to the list, if it isn't send the transaction right away.
-    cache needs memcached to be available.
+    If use_cache is set, add it to the index queue, if it isn't send the transaction right away.
     """
 
     from hypermap.aggregator.models import Layer
@@ -249,18 +218,15 @@ def index_layer(self, layer_id, use_cache=False):
         unindex_layer(layer.id, use_cache)
         return
 
-    # 1. if we use cache
+    # 1. if we use the index queue
     if use_cache:
-        LOGGER.debug('Caching layer with id %s for syncing with search engine' % layer.id)
-        layers = cache.get('layers')
-        if layers is None:
-            layers = set([layer.id])
-        else:
-            layers.add(layer.id)
-        cache.set('layers', layers)
+        from hypermap.aggregator.indexing import enqueue_layers
+        LOGGER.debug('Queueing layer with id %s for syncing with search engine' % layer.id)
+        enqueue_layers([layer.id])
         return
 
-    # 2. if we don't use cache
+    # 2. if we don't use the index queue
+    from hypermap.aggregator.search_cache import bump_index_generation
     # TODO: Make this function more DRY
     # by abstracting the common bits.
     if SEARCH_TYPE == 'solr':
@@ -268,6 +234,8 @@ def index_layer(self, layer_id, use_cache=False):
         LOGGER.debug('Syncing layer %s to solr' % layer.name)
         solrobject = SolrHypermap()
         success, message = solrobject.layer_to_solr(layer)
+        if success:
+            bump_index_generation()
         # update the error message if using celery
         if not settings.REGISTRY_SKIP_CELERY:
             if not success:
@@ -281,6 +249,8 @@ def index_layer(self, layer_id, use_cache=False):
         LOGGER.debug('Syncing layer %s to es' % layer.name)
         esobject = ESHypermap()
         success, message = esobject.layer_to_es(layer)
+        if success:
+            bump_index_generation()
         # update the error message if using celery
         if not settings.REGISTRY_SKIP_CELERY:
             if not success:
@@ -302,45 +272,49 @@ def unindex_layers_with_issues(self, use_cache=False):
     layer_type = ContentType.objects.get_for_model(Layer)
     service_type = ContentType.objects.get_for_model(Service)
 
-    for issue in Issue.objects.filter(content_type__pk=layer_type.id):
-        unindex_layer(issue.content_object.id, use_cache)
+    layer_ids = set(Issue.objects.filter(content_type__pk=layer_type.id).values_list('object_id', flat=True))
+    service_ids = Issue.objects.filter(content_type__pk=service_type.id).values_list('object_id', flat=True)
+    layer_ids.update(Layer.objects.filter(service_id__in=service_ids).values_list('id', flat=True))
+    layer_ids = sorted(layer_ids)
+
+    if use_cache:
+        from hypermap.aggregator.enums import INDEX_DELETE
+        from hypermap.aggregator.indexing import enqueue_layers
+        enqueue_layers(layer_ids, INDEX_DELETE)
+        return
 
-    for issue in Issue.objects.filter(content_type__pk=service_type.id):
-        for layer in issue.content_object.layer_set.all():
-            unindex_layer(layer.id, use_cache)
+    from hypermap.aggregator.indexing import unindex_layers
+    batch_size = settings.REGISTRY_SEARCH_BATCH_SIZE
+    for i in range(0, len(layer_ids), batch_size):
+        if not unindex_layers(layer_ids[i:i + batch_size]):
+            LOGGER.error('Layers NOT correctly removed from %s' % SEARCH_TYPE)
 
 
 @shared_task(bind=True)
 def unindex_layer(self, layer_id, use_cache=False):
     """
     Remove the index for a layer in the search backend.
-    If cache is set, append it to the list of removed layers, if it isn't send the transaction right away.
+    If use_cache is set, add it to the index queue for removal, if it isn't send the transaction right away.
     """
 
     from hypermap.aggregator.models import Layer
     layer = Layer.objects.get(id=layer_id)
 
     if use_cache:
-        LOGGER.debug('Caching layer with id %s for being removed from search engine' % layer.id)
-        deleted_layers = cache.get('deleted_layers')
-        if deleted_layers is None:
-            deleted_layers = set([layer.id])
-        else:
-            deleted_layers.add(layer.id)
-        cache.set('deleted_layers', deleted_layers)
+        from hypermap.aggregator.enums import INDEX_DELETE
+        from hypermap.aggregator.indexing import enqueue_layers
+        LOGGER.debug('Queueing layer with id %s for being removed from search engine' % layer.id)
+        enqueue_layers([layer.id], INDEX_DELETE)
         return
 
-    if SEARCH_TYPE == 'solr':
-        from hypermap.aggregator.solr import SolrHypermap
-        LOGGER.debug('Removing layer %s from solr' % layer.id)
-        try:
-            solrobject = SolrHypermap()
-            solrobject.remove_layer(layer.uuid)
-        except Exception:
-            LOGGER.error('Layer NOT correctly removed from Solr')
-    elif SEARCH_TYPE == 'elasticsearch':
-        # TODO implement me
-        pass
+    from hypermap.aggregator.indexing import unindex_layers
+    LOGGER.debug('Removing layer %s from %s' % (layer.id, SEARCH_TYPE))
+    try:
+        if not unindex_layers([layer.id]):
+            LOGGER.error('Layer NOT correctly removed from %s' % SEARCH_TYPE)
+    except Exception as e:
+        LOGGER.error('Layer NOT correctly removed from %s' % SEARCH_TYPE)
+        LOGGER.error(e, exc_info=True)
 
 
 @shared_task(bind=True)
@@ -351,20 +325,38 @@ def index_all_layers(self):
     from hypermap.aggregator.models import Layer
 
     if not settings.REGISTRY_SKIP_CELERY:
-        layers_cache = set(Layer.objects.filter(is_valid=True).values_list('id', flat=True))
-        deleted_layers_cache = set(Layer.objects.filter(is_valid=False).values_list('id', flat=True))
-        cache.set('layers', layers_cache)
-        cache.set('deleted_layers', deleted_layers_cache)
+        from hypermap.aggregator.enums import INDEX_DELETE
+        from hypermap.aggregator.indexing import enqueue_layers, iter_layer_ids
+        batch_size = settings.REGISTRY_SEARCH_BATCH_SIZE
+        for layer_ids in iter_layer_ids(Layer.objects.filter(is_valid=True), batch_size):
+            enqueue_layers(layer_ids)
+        for layer_ids in iter_layer_ids(Layer.objects.filter(is_valid=False), batch_size):
+            enqueue_layers(layer_ids, INDEX_DELETE)
     else:
         for layer in Layer.objects.all():
             index_layer(layer.id)
 
 
+@shared_task(bind=True)
+def reindex_all_layers(self, chunk_size=None, window=None):
+    """
+    Stream all the valid layers to the search engine, without buffering their ids in the index queue.
+    """
+    from hypermap.aggregator.indexing import reindex_layers
+
+    stats = reindex_layers(chunk_size=chunk_size, window=window)
+    LOGGER.info('Reindex completed: %s layers indexed, %s failed' % (stats['layers'], stats['failed_layers']))
+    return stats
+
+
 @shared_task(bind=True)
 def update_last_wm_layers(self, service_id, num_layers=10):
     """
     Update and index the last added and deleted layers (num_layers) in WorldMap service.
+    After a complete harvest of the service, all the layers added since are updated instead,
+    with an incremental harvest.
     """
+    from hypermap.aggregator.harvesting import chunks
     from hypermap.aggregator.models import Service
 
     LOGGER.debug(
@@ -378,7 +370,10 @@ def update_last_wm_layers(self, service_id, num_layers=10):
     if service.type == 'Hypermap:WorldMap':
         from hypermap.aggregator.models import update_layers_geonode_wm as update_layers_wm
 
-    update_layers_wm(service, num_layers)
+    if service.harvest_last_date:
+        updated = update_layers_wm(service, incremental=True)
+    else:
+        updated = update_layers_wm(service, num_layers)
 
     # Remove in search engine last num_layers that were deleted
     LOGGER.debug('Removing the index for the last %s deleted layers' % num_layers)
@@ -389,14 +384,18 @@ def update_last_wm_layers(self, service_id, num_layers=10):
         else:
             unindex_layer(layer.id)
 
-    # Add/Update in search engine last num_layers that were added
-    LOGGER.debug('Adding/Updating the index for the last %s added layers' % num_layers)
-    layer_to_index = service.layer_set.filter(was_deleted=False).order_by('-last_updated')[0:num_layers]
-    for layer in layer_to_index:
+    # Add/Update in search engine the layers that were added
+    LOGGER.debug('Adding/Updating the index for the last %s added layers' % len(updated))
+    deleted = set()
+    for chunk in chunks(updated, 500):
+        deleted.update(service.layer_set.filter(id__in=chunk, was_deleted=True).values_list('id', flat=True))
+    for layer_id in updated:
+        if layer_id in deleted:
+            continue
         if not settings.REGISTRY_SKIP_CELERY:
-            index_layer(layer.id, use_cache=True)
+            index_layer(layer_id, use_cache=True)
         else:
-            index_layer(layer.id)
+            index_layer(layer_id)
 
 
 @shared_task(bind=True)
@@ -424,13 +423,12 @@ def update_endpoint(self, endpoint_id, greedy_opt=False):
 @shared_task(bind=True)
 def update_endpoints(self, endpoint_list_id):
     from hypermap.aggregator.models import EndpointList
+    from hypermap.aggregator.endpoints import process_endpoints
+    from hypermap.aggregator.governor import REGISTRY_HOST_COOLDOWN
     endpoint_list_to_process = EndpointList.objects.get(id=endpoint_list_id)
-    # for now we process the enpoint even if they were already processed
-    endpoint_to_process = endpoint_list_to_process.endpoint_set.filter(processed=False)
-    if not settings.REGISTRY_SKIP_CELERY:
-        for endpoint in endpoint_to_process:
-            update_endpoint.delay(endpoint.id)
-    else:
-        for endpoint in endpoint_to_process:
-            update_endpoint(endpoint.id)
+    # the endpoints are probed by a pool of threads, with a limit of concurrent probes per host
+    postponed = process_endpoints(endpoint_list_to_process)
+    if postponed and not settings.REGISTRY_SKIP_CELERY:
+        # the endpoints of suspended hosts are processed once their circuit is closed again
+        update_endpoints.apply_async(args=[endpoint_list_id], countdown=REGISTRY_HOST_COOLDOWN)
     return True
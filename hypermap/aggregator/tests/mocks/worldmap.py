@@ -5,7 +5,9 @@ Mocks for testing a WorldMap service type.
 """
 
 from httmock import response, urlmatch
+import json
 import os
+import urlparse
 
 
 NETLOC = r'(.*\.)?worldmap\.harvard\.edu$'
@@ -40,4 +42,19 @@ def resource_get(url, request):
         # catch any environment errors (i.e. file does not exist) and return a
         # 404.
         return response(404, {}, HEADERS, None, 5, request)
+    params = dict(urlparse.parse_qsl(url.query))
+    if 'offset' in params or 'limit' in params:
+        content = get_page(content, int(params.get('offset', 0)), int(params.get('limit', 20)))
     return response(200, content, HEADERS, None, 5, request)
+
+
+def get_page(content, offset, limit, max_limit=None):
+    """ The page of the rows of a WorldMap api response, as tastypie returns it.
+    :param max_limit: the maximum number of rows of a page allowed by the server.
+    """
+    data = json.loads(content)
+    if max_limit:
+        limit = min(limit, max_limit)
+    data['objects'] = data['objects'][offset:offset + limit]
+    data['meta'].update(offset=offset, limit=limit)
+    return json.dumps(data)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capabilities cache.
+"""
+
+from django.test import TestCase
+from httmock import HTTMock, urlmatch
+import mocks.wms
+
+from hypermap.aggregator.capabilities import get_ows, invalidate_ows, ows_cache
+from hypermap.aggregator.lrucache import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def test_lru_cache(self):
+        cache = LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # b is the least recently used
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+        cache = LRUCache(2, -1)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class TestCapabilitiesCache(TestCase):
+
+    def setUp(self):
+        ows_cache.clear()
+        self.requests = []
+
+        @urlmatch(netloc=mocks.wms.NETLOC)
+        def resource_get(url, request):
+            self.requests.append(request.url)
+            return mocks.wms.resource_get(url, request)
+
+        self.resource_get = resource_get
+
+    def tearDown(self):
+        ows_cache.clear()
+
+    def test_get_ows(self):
+        url = 'http://wms.example.com/ows130?'
+        with HTTMock(self.resource_get):
+            ows = get_ows(url, 'OGC:WMS')
+            self.assertEqual(ows.version, '1.3.0')
+            # the negotiated and the versioned documents are downloaded and parsed once
+            self.assertIs(get_ows(url, 'OGC:WMS'), ows)
+            self.assertIs(get_ows(url, 'OGC:WMS', '1.3.0'), ows)
+            self.assertEqual(len(self.requests), 1)
+
+            self.assertIsNot(get_ows(url, 'OGC:WMS', max_age=-1), ows)
+            self.assertEqual(len(self.requests), 2)
+
+            invalidate_ows(url)
+            get_ows(url, 'OGC:WMS')
+            self.assertEqual(len(self.requests), 3)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the streaming parser of the capabilities documents.
+"""
+
+from io import BytesIO
+
+from django.test import TestCase
+from httmock import with_httmock
+from owslib.wms import WebMapService
+import mocks.wms
+
+from hypermap.aggregator.capabilities_parser import iter_wms_layers, iter_wmts_layers
+from hypermap.aggregator.models import Service, Catalog, update_layers_wms
+
+
+WMTS_CAPABILITIES = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0">
+  <ows:ServiceIdentification><ows:Title>Tiles</ows:Title></ows:ServiceIdentification>
+  <Contents>
+    <Layer>
+      <ows:Title>Blue Marble</ows:Title>
+      <ows:Abstract>Imagery</ows:Abstract>
+      <ows:Keywords><ows:Keyword>earth</ows:Keyword><ows:Keyword>imagery</ows:Keyword></ows:Keywords>
+      <ows:WGS84BoundingBox>
+        <ows:LowerCorner>-180 -90</ows:LowerCorner>
+        <ows:UpperCorner>180 90</ows:UpperCorner>
+      </ows:WGS84BoundingBox>
+      <ows:Identifier>blue_marble</ows:Identifier>
+    </Layer>
+    <Layer>
+      <ows:Title>Coastlines</ows:Title>
+      <ows:Identifier>coastlines</ows:Identifier>
+    </Layer>
+    <TileMatrixSet><ows:Identifier>EPSG4326</ows:Identifier></TileMatrixSet>
+  </Contents>
+</Capabilities>
+'''
+
+
+def get_layers_values(service):
+    return dict(
+        (layer.name, (layer.title, layer.abstract, sorted(layer.keywords.names()),
+                      layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1))
+        for layer in service.layer_set.all()
+    )
+
+
+class TestCapabilitiesParser(TestCase):
+
+    def test_iter_wms_layers(self):
+        for name, version in (('ows111', '1.1.1'), ('ows130', '1.3.0')):
+            path = '%s/wms.example.com/%s' % (mocks.wms.API_PATH, name)
+            with open(path, 'rb') as f:
+                wms = WebMapService('http://wms.example.com/%s' % name, xml=f.read(), version=version)
+            records = list(iter_wms_layers(path))
+            # nested layers are yielded before their parent layer
+            self.assertEqual(sorted(record.name for record in records), sorted(wms.contents))
+            for record in records:
+                ows_layer = wms.contents[record.name]
+                self.assertEqual(record.title, ows_layer.title)
+                self.assertEqual(record.abstract, ows_layer.abstract)
+                self.assertEqual(record.keywords, ows_layer.keywords)
+                self.assertEqual(record.boundingBoxWGS84, ows_layer.boundingBoxWGS84)
+                self.assertEqual(sorted(record.crsOptions), sorted(ows_layer.crsOptions))
+
+    def test_iter_wmts_layers(self):
+        records = list(iter_wmts_layers(BytesIO(WMTS_CAPABILITIES)))
+        self.assertEqual([record.name for record in records], ['blue_marble', 'coastlines'])
+        self.assertEqual(records[0].title, 'Blue Marble')
+        self.assertEqual(records[0].abstract, 'Imagery')
+        self.assertEqual(records[0].keywords, ['earth', 'imagery'])
+        self.assertEqual(records[0].boundingBoxWGS84, (-180.0, -90.0, 180.0, 90.0))
+        self.assertIsNone(records[1].boundingBoxWGS84)
+
+        # a WMS document is not a WMTS one
+        with self.assertRaises(ValueError):
+            list(iter_wmts_layers('%s/wms.example.com/ows130' % mocks.wms.API_PATH))
+
+    @with_httmock(mocks.wms.resource_get)
+    def test_streaming_harvest(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        service = Service(
+            type='OGC:WMS',
+            url='http://wms.example.com/ows111?',
+            catalog=catalog
+        )
+        service.save()
+        expected = get_layers_values(service)
+        self.assertEqual(len(expected), 9)
+
+        # harvest the layers again, with the streaming parser
+        service.layer_set.all().delete()
+        service.capabilities_hash = None
+        service.capabilities_etag = None
+        service.capabilities_last_modified = None
+        update_layers_wms(service, streaming=True)
+        self.assertEqual(get_layers_values(service), expected)
+        self.assertIsNotNone(service.capabilities_hash)
+        self.assertFalse(service.check_set.filter(success=False).exists())
+
+        # the capabilities document did not change
+        service.layer_set.all().delete()
+        update_layers_wms(service, streaming=True)
+        self.assertEqual(service.layer_set.count(), 0)
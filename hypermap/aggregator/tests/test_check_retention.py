@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the retention of the checks.
+"""
+
+import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+
+from hypermap.aggregator.check_retention import prune_checks, get_check_history, percentile
+from hypermap.aggregator.enums import ROLLUP_HOUR, ROLLUP_DAY
+from hypermap.aggregator.models import Service, Catalog, Check, CheckRollup
+
+
+class TestCheckRetention(TestCase):
+
+    def setUp(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service(
+            type='OGC:WMS',
+            url='http://wms.example.com/ows130?',
+            catalog=catalog,
+            is_monitored=False
+        )
+        self.service.save()
+
+    def add_check(self, checked_datetime, success, response_time):
+        check = Check(content_object=self.service, success=success, response_time=response_time)
+        check.save()
+        # checked_datetime is set on save
+        Check.objects.filter(id=check.id).update(checked_datetime=checked_datetime)
+        return check
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 50), None)
+        self.assertEqual(percentile([1.0], 95), 1.0)
+        self.assertEqual(percentile([1.0, 2.0, 3.0, 4.0], 50), 2.0)
+        self.assertEqual(percentile(range(1, 101), 95), 95)
+
+    def test_prune_checks(self):
+        old_day = (timezone.now() - datetime.timedelta(days=40)).replace(hour=10, minute=0, second=0, microsecond=0)
+        # the first check is referenced by the statistics of the service, and kept
+        first_check = self.add_check(old_day.replace(hour=9), True, 100)
+        for minute, success, response_time in ((5, True, 1000), (10, False, 0), (15, True, 3000)):
+            self.add_check(old_day.replace(minute=minute), success, response_time)
+        self.add_check(old_day.replace(hour=11), True, 2.0)
+        self.add_check(timezone.now() - datetime.timedelta(days=1), True, 0.5)
+        checks_count = self.service.checks_count
+
+        self.assertEqual(prune_checks(retention_days=30, hourly_retention_days=90), 4)
+
+        self.assertEqual(self.service.check_set.count(), 2)
+        self.assertEqual(Service.objects.get(id=self.service.id).first_check, first_check)
+        rollups = self.service.check_rollup_set
+        hour = rollups.get(period=ROLLUP_HOUR, period_start=old_day)
+        self.assertEqual((hour.checks_count, hour.success_count), (3, 2))
+        self.assertEqual((hour.response_time_p50, hour.response_time_p95), (1000, 3000))
+        self.assertEqual(rollups.filter(period=ROLLUP_HOUR).count(), 2)
+        day = rollups.get(period=ROLLUP_DAY)
+        self.assertEqual(day.period_start, old_day.replace(hour=0))
+        self.assertEqual((day.checks_count, day.success_count), (4, 3))
+        # the statistics still count the pruned checks
+        self.assertEqual(Service.objects.get(id=self.service.id).checks_count, checks_count)
+
+        # the hourly rollups expire
+        prune_checks(retention_days=30, hourly_retention_days=35)
+        self.assertEqual(rollups.filter(period=ROLLUP_HOUR).count(), 0)
+        self.assertEqual(CheckRollup.objects.filter(period=ROLLUP_DAY).count(), 1)
+
+        # long ranges read the rollups
+        history = get_check_history(self.service, 365)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history[1][0], old_day.replace(hour=9))
+        self.assertEqual(history[2][0], old_day.replace(hour=0))
+        self.assertFalse(history[2][2])
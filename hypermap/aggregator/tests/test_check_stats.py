@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the statistics of the checks of services and layers.
+"""
+
+from django.db.models import Avg, Min, Max
+from django.test import TestCase
+from httmock import with_httmock
+import mocks.wms
+
+from hypermap.aggregator.check_stats import create_checks, update_check_stats
+from hypermap.aggregator.models import Service, Catalog, Layer, Check
+
+
+class TestCheckStats(TestCase):
+
+    @with_httmock(mocks.wms.resource_get)
+    def setUp(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service(
+            type='OGC:WMS',
+            url='http://wms.example.com/ows130?',
+            catalog=catalog
+        )
+        self.service.save()
+
+    def assertStatsEqualChecks(self, resource):
+        resource = type(resource).objects.get(id=resource.id)
+        checks = resource.check_set.all()
+        self.assertEqual(resource.checks_count, checks.count())
+        self.assertEqual(
+            resource.reliability, checks.filter(success=True).count() / float(checks.count()) * 100
+        )
+        self.assertAlmostEqual(resource.average_response_time, checks.aggregate(Avg('response_time')).values()[0])
+        self.assertEqual(resource.min_response_time, checks.aggregate(Min('response_time')).values()[0])
+        self.assertEqual(resource.max_response_time, checks.aggregate(Max('response_time')).values()[0])
+        self.assertEqual(resource.last_check, checks.order_by('-checked_datetime', '-id').first())
+        self.assertEqual(resource.first_check, checks.order_by('checked_datetime', 'id').first())
+        self.assertEqual(resource.last_status, resource.last_check.success)
+        recent_checks = checks.order_by('-checked_datetime', '-id')[0:2]
+        self.assertEqual(resource.recent_reliability, sum(check.success for check in recent_checks) / 2.0 * 100)
+
+    def test_check_stats(self):
+        for success, response_time in ((False, 0), (True, 500), (True, 2250)):
+            Check(content_object=self.service, success=success, response_time=response_time).save()
+        self.assertStatsEqualChecks(self.service)
+
+    def test_bulk_check_stats(self):
+        layers = list(self.service.layer_set.all())
+        checks = []
+        for layer in layers:
+            checks.append(Check(content_object=layer, success=False, response_time=1500))
+            checks.append(Check(content_object=layer, success=True, response_time=750))
+        create_checks(checks)
+        update_check_stats(checks)
+        for layer in layers:
+            self.assertStatsEqualChecks(layer)
+
+    def test_create_checks(self):
+        layer = self.service.layer_set.all()[0]
+        first = Check(content_object=layer, success=True, response_time=100)
+        last = Check(content_object=layer, success=False, response_time=200)
+        create_checks([first])
+        # a check of another checker saved in the meanwhile
+        Check(content_object=layer, success=True, response_time=300).save()
+        create_checks([last])
+        self.assertEqual(Check.objects.get(pk=first.pk).response_time, 100)
+        self.assertEqual(Check.objects.get(pk=last.pk).response_time, 200)
+        update_check_stats([first, last])
+        self.assertEqual(type(layer).objects.get(id=layer.id).last_check, last)
+        self.assertStatsEqualChecks(layer)
+
+    def test_no_checks(self):
+        layer = Layer(service=self.service, catalog=self.service.catalog, name='unchecked')
+        self.assertEqual(layer.checks_count, 0)
+        self.assertIsNone(layer.reliability)
+        self.assertIsNone(layer.last_status)
+        self.assertIsNone(layer.last_check)
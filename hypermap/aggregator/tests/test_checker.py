@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the checks of the layers of a service in a pool of threads.
+"""
+
+from django.test import TestCase
+from httmock import HTTMock, response, urlmatch
+import mocks.wms
+
+from hypermap.aggregator.capabilities import ows_cache
+from hypermap.aggregator.checker import check_layers
+from hypermap.aggregator.models import Service, Catalog, Check
+
+
+capabilities_requests = []
+
+
+@urlmatch(netloc=mocks.wms.NETLOC)
+def capabilities_get(url, request):
+    capabilities_requests.append(url)
+    return mocks.wms.resource_get(url, request)
+
+
+@urlmatch(query=r'.*request=GetMap.*')
+def getmap_get(url, request):
+    return response(200, 'PNG', {'content-type': 'image/png'}, None, 5, request)
+
+
+class TestCheckLayers(TestCase):
+
+    def test_check_layers(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+
+        with HTTMock(getmap_get, capabilities_get):
+            service = Service(
+                type='OGC:WMS',
+                url='http://wms.example.com/ows130?',
+                catalog=catalog
+            )
+            service.save()
+            layers = service.layer_set.select_related('service', 'catalog')
+            checks_count = Check.objects.count()
+            # forget the document downloaded by the check of the service
+            ows_cache.clear()
+            del capabilities_requests[:]
+
+            checks = check_layers(layers, threads=2, host_concurrency=1)
+
+        # the capabilities document is requested once for all the layers
+        self.assertEqual(len(capabilities_requests), 1)
+        self.assertEqual(len(checks), 3)
+        self.assertEqual(Check.objects.count(), checks_count + 3)
+        for layer, check in checks:
+            self.assertEqual(layer.check_set.all().count(), 2)
+            self.assertEqual(layer.checks_count, 2)
+            self.assertTrue(check.success, check.message)
+            self.assertTrue(layer.thumbnail.name)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the harvest of CSW endpoints.
+"""
+
+from django.test import TestCase
+from httmock import HTTMock, response, urlmatch
+from lxml import etree
+import mocks.wms
+
+from hypermap.aggregator.csw_harvest import harvest_csw
+from hypermap.aggregator.models import Catalog, CSWHarvestJob, Service
+
+
+CSW_URL = 'http://csw.example.com/csw'
+
+# the records of the catalogue, with the services they reference
+REFERENCES = [
+    'http://wms.example.com/ows111?',
+    'http://wms.example.com/ows130?',
+    'http://wms.example.com/ows111?',
+    None,
+    'http://wms.example.com/ows130?',
+]
+
+RECORD = '''<csw:Record>
+  <dc:identifier>record-%s</dc:identifier>
+  <dc:title>Record %s</dc:title>
+  %s
+</csw:Record>'''
+
+RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:dct="http://purl.org/dc/terms/" version="2.0.2">
+  <csw:SearchStatus timestamp="2016-01-01T00:00:00Z"/>
+  <csw:SearchResults numberOfRecordsMatched="%s" numberOfRecordsReturned="%s" nextRecord="%s" elementSet="full">
+    %s
+  </csw:SearchResults>
+</csw:GetRecordsResponse>'''
+
+
+def get_records_response(start, count):
+    records = []
+    for i in range(start, min(start + count, len(REFERENCES) + 1)):
+        reference = REFERENCES[i - 1]
+        references = '<dct:references scheme="OGC:WMS">%s</dct:references>' % reference if reference else ''
+        records.append(RECORD % (i, i, references))
+    next_record = start + len(records) if start + len(records) <= len(REFERENCES) else 0
+    return RESPONSE % (len(REFERENCES), len(records), next_record, '\n'.join(records))
+
+
+class TestCSWHarvest(TestCase):
+
+    def setUp(self):
+        self.catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.pages = []
+        self.failing_page = None
+
+        @urlmatch(netloc=r'csw\.example\.com$')
+        def csw_post(url, request):
+            query = etree.fromstring(request.body)
+            if query.get('resultType') == 'hits':
+                return response(200, get_records_response(1, 0), {'content-type': 'application/xml'})
+            start = int(query.get('startPosition'))
+            if start == self.failing_page:
+                return response(500, 'Error', {'content-type': 'text/plain'})
+            self.pages.append(start)
+            content = get_records_response(start, int(query.get('maxRecords')))
+            return response(200, content, {'content-type': 'application/xml'})
+
+        self.csw_post = csw_post
+
+    def test_harvest_csw(self):
+        self.failing_page = 3
+        with HTTMock(self.csw_post, mocks.wms.resource_get):
+            with self.assertRaises(RuntimeError):
+                harvest_csw(CSW_URL, self.catalog, pagesize=2, threads=1)
+        job = CSWHarvestJob.objects.get(url=CSW_URL, catalog=self.catalog)
+        self.assertEqual(job.matches, 5)
+        self.assertEqual(job.next_record, 3)
+        self.assertIsNone(job.finished_datetime)
+        self.assertEqual(Service.objects.filter(catalog=self.catalog).count(), 2)
+
+        # the harvest resumes from the page which failed, the services are created once
+        self.failing_page = None
+        with HTTMock(self.csw_post, mocks.wms.resource_get):
+            self.assertEqual(harvest_csw(CSW_URL, self.catalog, pagesize=2, threads=1), 2)
+        self.assertEqual(self.pages, [1, 3, 5])
+        job = CSWHarvestJob.objects.get(id=job.id)
+        self.assertEqual(job.next_record, 7)
+        self.assertIsNotNone(job.finished_datetime)
+        self.assertEqual(job.progress(), '5/5')
+        self.assertEqual(Service.objects.filter(catalog=self.catalog).count(), 2)
+
+        # a finished harvest starts over
+        with HTTMock(self.csw_post, mocks.wms.resource_get):
+            self.assertEqual(harvest_csw(CSW_URL, self.catalog, pagesize=5, threads=1), 0)
+        self.assertEqual(self.pages, [1, 3, 5, 1])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the detection of the type of the services of endpoints.
+"""
+
+from django.core.cache import cache
+from django.test import TestCase
+from httmock import HTTMock, urlmatch
+import mocks.wms
+
+from hypermap.aggregator.capabilities import get_wms_capabilities, store_detected_capabilities
+from hypermap.aggregator.detection import (detect_service, fetch_and_sniff, get_capabilities_url, sniff_identification,
+                                           sniff_root)
+from hypermap.aggregator.models import Service
+
+
+class TestDetection(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.requests = []
+
+        @urlmatch(netloc=mocks.wms.NETLOC)
+        def resource_get(url, request):
+            self.requests.append(request.url)
+            return mocks.wms.resource_get(url, request)
+
+        self.resource_get = resource_get
+
+    def test_sniff_root(self):
+        chunks = ['<?xml version="1.0"?>\n<WMS_Capabilities version="1.3.0" ', 'xmlns="http://www.opengis.net/wms">']
+        self.assertEqual(
+            sniff_root(chunks), ('http://www.opengis.net/wms', 'WMS_Capabilities', {'version': '1.3.0'})
+        )
+        self.assertIsNone(sniff_root(['{"services": []}']))
+
+    def test_sniff_identification(self):
+        chunks = [
+            '<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms"><Service><Name>WMS</Name>',
+            '<Title> Ocean WMS </Title><Abstract>Oceans</Abstract></Service><Capability><Layer><Title>Layer',
+        ]
+        self.assertEqual(sniff_identification(chunks), ('Ocean WMS', 'Oceans'))
+        # the titles of the layers are not read
+        chunks = ['<WMT_MS_Capabilities><Service><Title>WMS</Title></Service><Capability><Layer><Abstract>']
+        self.assertEqual(sniff_identification(chunks), ('WMS', None))
+
+    def test_get_capabilities_url(self):
+        self.assertEqual(
+            get_capabilities_url('http://example.com/ows?map=x&SERVICE=WMS', {'service': 'CSW'}),
+            'http://example.com/ows?map=x&service=CSW'
+        )
+
+    def test_detect_service(self):
+        with HTTMock(self.resource_get):
+            detection = detect_service('http://wms.example.com/ows130?')
+            self.assertEqual((detection.service_type, detection.version), ('OGC:WMS', '1.3.0'))
+            # the endpoint is a capabilities document: it is downloaded once
+            self.assertEqual(len(self.requests), 1)
+            self.assertEqual(detection.title, 'IEM WMS Service')
+            ows = detection.get_ows('http://wms.example.com/ows130?')
+            self.assertEqual(ows.identification.title, 'IEM WMS Service')
+
+            detection = detect_service('http://wms.example.com/ows111')
+            self.assertEqual((detection.service_type, detection.version), ('OGC:WMS', '1.1.1'))
+
+            self.assertIsNone(detect_service('http://wms.example.com/not-found'))
+
+    def test_detected_capabilities(self):
+        with HTTMock(self.resource_get):
+            detection = detect_service('http://wms.example.com/ows130?')
+        store_detected_capabilities('http://wms.example.com/ows130?', detection)
+        service = Service(type='OGC:WMS', url='http://wms.example.com/ows130?')
+        del self.requests[:]
+        # the first harvest does not download the document again
+        with HTTMock(self.resource_get):
+            capabilities = get_wms_capabilities(service)
+        self.assertEqual(self.requests, [])
+        self.assertEqual(len(capabilities.ows.contents), 3)
+
+    def test_detected_capabilities_max_size(self):
+        with HTTMock(self.resource_get):
+            detection = fetch_and_sniff('http://wms.example.com/ows130?', max_size=1000)
+        # the document is too large to be kept, but its title is read
+        self.assertIsNone(detection.content)
+        self.assertEqual((detection.service_type, detection.title), ('OGC:WMS', 'IEM WMS Service'))
+        store_detected_capabilities('http://wms.example.com/ows130?', detection)
+        service = Service(type='OGC:WMS', url='http://wms.example.com/ows130?')
+        del self.requests[:]
+        with HTTMock(self.resource_get):
+            get_wms_capabilities(service)
+        self.assertEqual(len(self.requests), 1)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the import of endpoint lists.
+"""
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import signals
+from django.test import TestCase
+
+from hypermap.aggregator.endpoints import import_endpoint_list, process_endpoints
+from hypermap.aggregator.governor import governor
+from hypermap.aggregator.models import Catalog, Endpoint, EndpointList, endpointlist_post_save
+
+
+class TestEndpointList(TestCase):
+
+    def setUp(self):
+        # the endpoint list is imported by the tests
+        signals.post_save.disconnect(endpointlist_post_save, sender=EndpointList)
+        cache.clear()
+        self.catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+
+    def tearDown(self):
+        signals.post_save.connect(endpointlist_post_save, sender=EndpointList)
+
+    def test_import_endpoint_list(self):
+        # the urls of the endpoints of older uploads were not stripped
+        Endpoint.objects.create(url='http://localhost:1/existing\n', catalog=self.catalog)
+        lines = [
+            'http://localhost:1/wms',
+            '',
+            'http://localhost:1/existing',
+            'http://localhost:1/wms',
+            'http://localhost:1/%s' % ('x' * 255),
+            'http://localhost:1/esri  ',
+        ]
+        endpoint_list = EndpointList(
+            upload=SimpleUploadedFile('endpoints.txt', '\n'.join(lines)),
+            catalog=self.catalog
+        )
+        endpoint_list.save()
+
+        # blank, duplicated and too long urls are skipped
+        self.assertEqual(import_endpoint_list(endpoint_list, batch_size=1), 2)
+        self.assertEqual(
+            sorted(endpoint_list.endpoint_set.values_list('url', flat=True)),
+            ['http://localhost:1/esri', 'http://localhost:1/wms']
+        )
+        self.assertEqual(import_endpoint_list(endpoint_list), 0)
+
+        # nothing listens on port 1: the endpoints are processed but not imported
+        process_endpoints(endpoint_list, threads=1)
+        endpoint_list = EndpointList.objects.get(id=endpoint_list.id)
+        self.assertEqual(endpoint_list.endpoints_count, 2)
+        self.assertEqual(endpoint_list.processed_count, 2)
+        self.assertEqual(endpoint_list.imported_count, 0)
+        self.assertIsNotNone(endpoint_list.processed_datetime)
+        self.assertFalse(endpoint_list.endpoint_set.filter(processed=False).exists())
+
+    def test_process_endpoints_circuit_open(self):
+        endpoint_list = EndpointList(
+            upload=SimpleUploadedFile('endpoints.txt', 'http://localhost:1/wms\nhttp://localhost:1/esri\n'),
+            catalog=self.catalog
+        )
+        endpoint_list.save()
+        import_endpoint_list(endpoint_list)
+        for i in range(governor.failure_threshold):
+            governor.record_failure('localhost:1')
+
+        # the endpoints of a suspended host are left for a later run
+        self.assertEqual(process_endpoints(endpoint_list, threads=1), 2)
+        endpoint_list = EndpointList.objects.get(id=endpoint_list.id)
+        self.assertEqual(endpoint_list.processed_count, 0)
+        self.assertIsNone(endpoint_list.processed_datetime)
+        self.assertEqual(endpoint_list.endpoint_set.filter(processed=False).count(), 2)
+
+        cache.clear()
+        self.assertEqual(process_endpoints(endpoint_list, threads=1), 0)
+        endpoint_list = EndpointList.objects.get(id=endpoint_list.id)
+        self.assertEqual(endpoint_list.processed_count, 2)
+        self.assertIsNotNone(endpoint_list.processed_datetime)
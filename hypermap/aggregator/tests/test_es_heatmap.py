@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the heatmaps of the Elasticsearch search.
+"""
+
+from django.test import TestCase
+
+from hypermap.search_api.utils import (ES_HEATMAP_MAX_CELLS, es_heatmap_facet, geohash_cell_size,
+                                       geohash_to_lat_lon, heatmap_grid, request_heatmap_facet_es)
+
+
+class TestESHeatmap(TestCase):
+
+    def test_geohash(self):
+        self.assertEqual(geohash_cell_size(1), (45.0, 45.0))
+        self.assertEqual(geohash_cell_size(2), (11.25, 5.625))
+        lat, lon = geohash_to_lat_lon('u4pruydqqvj')
+        self.assertAlmostEqual(lat, 57.64911, places=4)
+        self.assertAlmostEqual(lon, 10.40744, places=4)
+
+    def test_heatmap_grid(self):
+        grid = heatmap_grid('[-90,-180 TO 90,180]', 1)
+        self.assertEqual((grid['columns'], grid['rows']), (8, 4))
+        # the grid is aligned on the geohash cells
+        grid = heatmap_grid('[10,-100 TO 20,-80]', 2)
+        self.assertEqual((grid['minX'], grid['maxX'], grid['minY'], grid['maxY']), (-101.25, -78.75, 5.625, 22.5))
+        self.assertEqual((grid['columns'], grid['rows']), (2, 3))
+
+    def test_request_heatmap_facet_es(self):
+        aggregation, grid_level = request_heatmap_facet_es('layer_centroid', None, None, 100)
+        self.assertEqual(grid_level, 1)
+        self.assertEqual(aggregation['aggs']['cells']['geohash_grid']['size'], 32)
+        aggregation, grid_level = request_heatmap_facet_es('layer_centroid', '[10,-100 TO 20,-80]', None, 100)
+        self.assertEqual(grid_level, 2)
+        self.assertEqual(
+            aggregation['filter']['geo_bounding_box']['layer_centroid'],
+            {'top_left': {'lat': 20, 'lon': -100}, 'bottom_right': {'lat': 10, 'lon': -80}}
+        )
+        # the grid level ignores the limit
+        aggregation, grid_level = request_heatmap_facet_es('layer_centroid', '[10,-100 TO 20,-80]', 4, 100)
+        self.assertEqual(grid_level, 4)
+        # but it is lowered until the region has at most ES_HEATMAP_MAX_CELLS cells
+        for hm_filter in (None, '[10,-100 TO 20,-80]'):
+            aggregation, grid_level = request_heatmap_facet_es('layer_centroid', hm_filter, 20, 100)
+            grid = heatmap_grid(hm_filter or '[-90,-180 TO 90,180]', grid_level)
+            self.assertLessEqual(grid['columns'] * grid['rows'], ES_HEATMAP_MAX_CELLS)
+            finer_grid = heatmap_grid(hm_filter or '[-90,-180 TO 90,180]', grid_level + 1)
+            self.assertGreater(finer_grid['columns'] * finer_grid['rows'], ES_HEATMAP_MAX_CELLS)
+            self.assertEqual(aggregation['aggs']['cells']['geohash_grid']['size'], grid['columns'] * grid['rows'])
+        # and so is the level computed from a larger limit
+        aggregation, grid_level = request_heatmap_facet_es('layer_centroid', None, None, 10 ** 9)
+        self.assertEqual(grid_level, 2)
+
+    def test_es_heatmap_facet(self):
+        aggregation = {'doc_count': 5, 'cells': {'buckets': [
+            {'key': 'u', 'doc_count': 3},
+            {'key': 's', 'doc_count': 2},
+        ]}}
+        hm = es_heatmap_facet(aggregation, None, 1)
+        self.assertEqual(
+            (hm['gridLevel'], hm['columns'], hm['rows'], hm['minX'], hm['maxX'], hm['minY'], hm['maxY']),
+            (1, 8, 4, -180, 180, -90, 90)
+        )
+        # the rows go from north to south, and are null without counts
+        self.assertEqual(hm['counts_ints2D'], [
+            [0, 0, 0, 0, 3, 0, 0, 0],
+            [0, 0, 0, 0, 2, 0, 0, 0],
+            None,
+            None,
+        ])
+        self.assertIsNone(es_heatmap_facet({'cells': {'buckets': []}}, None, 1)['counts_ints2D'])
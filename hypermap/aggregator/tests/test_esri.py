@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the crawl of ArcGIS REST endpoints.
+"""
+
+import json
+
+from django.core.cache import cache
+from django.test import TestCase
+from httmock import HTTMock, response, urlmatch
+
+from hypermap.aggregator.esri import crawl_esri, get_resource_url
+from hypermap.aggregator.governor import CircuitOpenError, governor
+from hypermap.aggregator.models import Catalog, Service
+
+
+ENDPOINT = 'http://esri.example.com/arcgis/rest/services'
+
+EXTENT = {'xmin': -10, 'ymin': -10, 'xmax': 10, 'ymax': 10, 'spatialReference': {'wkid': 4326}}
+ERROR = {'error': {'code': 400, 'message': 'Invalid URL', 'details': []}}
+
+# the JSON of the resources of the server by path
+RESOURCES = {
+    '/arcgis/rest/services/': {
+        'folders': ['Folder'],
+        'services': [
+            {'name': 'World', 'type': 'MapServer'},
+            {'name': 'Elevation', 'type': 'ImageServer'},
+            {'name': 'Geocoder', 'type': 'GeocodeServer'},
+        ],
+    },
+    '/arcgis/rest/services/Folder/': {
+        'folders': [],
+        'services': [
+            {'name': 'Folder/Cities', 'type': 'MapServer'},
+            {'name': 'Folder/Empty', 'type': 'MapServer'},
+        ],
+    },
+    '/arcgis/rest/services/World/MapServer/': {
+        'mapName': 'World', 'serviceDescription': 'The world', 'spatialReference': {'wkid': 4326},
+        'layers': [{'id': 0, 'name': 'Countries'}, {'id': 1, 'name': 'Rivers'}],
+    },
+    '/arcgis/rest/services/World/MapServer/layers': {
+        'layers': [
+            {'id': 0, 'name': 'Countries', 'extent': EXTENT},
+            {'id': 1, 'name': 'Rivers', 'extent': EXTENT},
+        ],
+    },
+    # an ArcGIS Server before 10, without the layers resource
+    '/arcgis/rest/services/Folder/Cities/MapServer/': {
+        'mapName': 'Cities', 'spatialReference': {'wkid': 4326},
+        'layers': [{'id': 0, 'name': 'Cities'}, {'id': 1, 'name': 'Broken'}],
+    },
+    '/arcgis/rest/services/Folder/Cities/MapServer/layers': ERROR,
+    '/arcgis/rest/services/Folder/Cities/MapServer/0/': {'id': 0, 'name': 'Cities', 'extent': EXTENT},
+    '/arcgis/rest/services/Folder/Cities/MapServer/1/': ERROR,
+    '/arcgis/rest/services/Folder/Empty/MapServer/': {
+        'mapName': 'Empty', 'spatialReference': {'wkid': 4326}, 'layers': [],
+    },
+    '/arcgis/rest/services/Elevation/ImageServer/': {
+        'name': 'Elevation', 'serviceDescription': 'Elevation', 'extent': EXTENT, 'spatialReference': {'wkid': 4326},
+    },
+}
+
+
+class TestESRICrawler(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.requests = []
+
+        @urlmatch(netloc=r'esri\.example\.com$')
+        def resource_get(url, request):
+            self.requests.append(url.path)
+            if url.path not in RESOURCES:
+                return response(404, '', {}, None, 5, request)
+            return response(200, json.dumps(RESOURCES[url.path]), {'content-type': 'application/json'}, None, 5,
+                            request)
+
+        self.resource_get = resource_get
+
+    def test_get_resource_url(self):
+        self.assertEqual(
+            get_resource_url('http://esri.example.com/arcgis/rest/services/World/MapServer/?f=pjson', 'layers'),
+            'http://esri.example.com/arcgis/rest/services/World/MapServer/layers?f=json'
+        )
+        self.assertEqual(
+            get_resource_url('http://esri.example.com/arcgis/rest/services?token=abc'),
+            'http://esri.example.com/arcgis/rest/services/?token=abc&f=json'
+        )
+
+    def test_crawl_esri(self):
+        with HTTMock(self.resource_get):
+            created = crawl_esri(ENDPOINT, self.catalog, threads=2)
+
+        # the empty MapServer and the GeocodeServer are not imported
+        self.assertEqual(
+            sorted(service.url for service in created),
+            [
+                'http://esri.example.com/arcgis/rest/services/Elevation/ImageServer/?f=json',
+                'http://esri.example.com/arcgis/rest/services/Folder/Cities/MapServer/?f=json',
+                'http://esri.example.com/arcgis/rest/services/World/MapServer/?f=json',
+            ]
+        )
+        world = Service.objects.get(url='http://esri.example.com/arcgis/rest/services/World/MapServer/?f=json')
+        self.assertEqual(world.title, 'World')
+        self.assertEqual(
+            sorted(world.layer_set.values_list('name', 'title')), [('0', 'Countries'), ('1', 'Rivers')]
+        )
+        cities = Service.objects.get(url='http://esri.example.com/arcgis/rest/services/Folder/Cities/MapServer/?f=json')
+        self.assertEqual(list(cities.layer_set.values_list('title', flat=True)), ['Cities'])
+        elevation = Service.objects.get(type='ESRI:ArcGIS:ImageServer')
+        self.assertEqual(list(elevation.layer_set.values_list('title', flat=True)), ['Elevation'])
+
+        # the harvests use the JSON of the crawl, and the layers of World with a single request
+        self.assertEqual(self.requests.count('/arcgis/rest/services/World/MapServer/'), 1)
+        self.assertEqual(self.requests.count('/arcgis/rest/services/World/MapServer/layers'), 1)
+        self.assertNotIn('/arcgis/rest/services/World/MapServer/0/', self.requests)
+        self.assertIn('/arcgis/rest/services/Folder/Cities/MapServer/0/', self.requests)
+
+    def test_crawl_esri_circuit_open(self):
+        for i in range(governor.failure_threshold):
+            governor.record_failure('esri.example.com')
+        # the folders are requested through the governor of the host
+        with HTTMock(self.resource_get):
+            self.assertRaises(CircuitOpenError, crawl_esri, ENDPOINT, self.catalog, threads=2)
+        self.assertEqual(self.requests, [])
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the outbound requests governor.
+"""
+
+import socket
+import unittest
+
+from django.core.cache import cache
+
+from hypermap.aggregator.governor import HostGovernor, CircuitOpenError
+
+
+class TestHostGovernor(unittest.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.governor = HostGovernor(rate_limit=0, failure_threshold=2, cooldown=60)
+
+    def fail(self, url):
+        with self.governor.governed(url):
+            raise socket.error('Connection refused')
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        url = 'http://down.example.com/wms?'
+        self.assertRaises(socket.error, self.fail, url)
+        self.assertFalse(self.governor.is_open('down.example.com'))
+        self.assertRaises(socket.error, self.fail, url)
+        self.assertTrue(self.governor.is_open('down.example.com'))
+        # requests to the host are short-circuited, other hosts are not affected
+        self.assertRaises(CircuitOpenError, self.fail, url)
+        with self.governor.governed('http://up.example.com/wms?'):
+            pass
+
+    def test_success_resets_failures(self):
+        url = 'http://flaky.example.com/wms?'
+        self.assertRaises(socket.error, self.fail, url)
+        with self.governor.governed(url):
+            pass
+        self.assertRaises(socket.error, self.fail, url)
+        self.assertFalse(self.governor.is_open('flaky.example.com'))
+
+    def test_nested_blocks(self):
+        url = 'http://nested.example.com/wms?'
+        with self.governor.governed(url):
+            # a nested block of the same host is part of the outer request
+            with self.governor.governed(url):
+                pass
+            self.assertRaises(socket.error, self.fail, url)
+        self.assertFalse(self.governor.is_open('nested.example.com'))
+
+    def test_content_errors_are_not_host_failures(self):
+        def parse_error():
+            with self.governor.governed('http://bad.example.com/wms?'):
+                raise ValueError('Invalid capabilities')
+        for i in range(3):
+            self.assertRaises(ValueError, parse_error)
+        self.assertFalse(self.governor.is_open('bad.example.com'))
+
+    def test_rate_limit(self):
+        governor = HostGovernor(rate_limit=2, failure_threshold=0)
+        host = 'busy.example.com'
+        # window is fixed by patching time, so that the test does not depend on the clock
+        import hypermap.aggregator.governor as governor_module
+        real_time, real_sleep = governor_module.time.time, governor_module.time.sleep
+        clock = [1000.5]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+        governor_module.time.time = lambda: clock[0]
+        governor_module.time.sleep = sleep
+        try:
+            for i in range(3):
+                governor.acquire(host)
+        finally:
+            governor_module.time.time, governor_module.time.sleep = real_time, real_sleep
+        # the third request waited for the next second
+        self.assertEqual(sleeps, [0.5])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the bulk writes of the harvested layers.
+"""
+
+import uuid
+
+from django.db.models import signals
+from django.test import TestCase
+from httmock import with_httmock
+import mocks.wms
+
+from hypermap.aggregator.harvesting import HarvestedLayer, bulk_upsert_layers
+from hypermap.aggregator.models import Service, Catalog, Layer, LayerDate
+
+
+def update_layer(layer, data):
+    layer.title = data['title']
+    layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1 = data['bbox']
+
+
+class TestBulkUpsertLayers(TestCase):
+
+    @with_httmock(mocks.wms.resource_get)
+    def setUp(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service(
+            type='OGC:WMS',
+            url='http://wms.example.com/ows130?',
+            catalog=catalog
+        )
+        self.service.save()
+
+    def test_bulk_upsert_layers(self):
+        layers_count = Layer.objects.count()
+        harvested = [
+            HarvestedLayer(
+                {'name': 'rivers'}, {'title': 'Rivers', 'bbox': (-10, -10, 10, 10)},
+                harvest_hash='1', keywords=['Rivers', 'rivers', 'Water'], dates=['2010-05-01']
+            ),
+            HarvestedLayer(
+                {'name': 'lakes'}, {'title': 'Lakes', 'bbox': (-1, -1, 1, 1)},
+                harvest_hash='1', keywords=['Water']
+            ),
+        ]
+        updated = bulk_upsert_layers(self.service, harvested, update_layer)
+
+        self.assertEqual(len(updated), 2)
+        self.assertEqual(Layer.objects.count(), layers_count + 2)
+        rivers = self.service.layer_set.get(name='rivers')
+        self.assertEqual(rivers.title, 'Rivers')
+        self.assertTrue(rivers.is_valid)
+        # keywords are matched ignoring the case
+        self.assertEqual(sorted(rivers.keywords.names()), ['Rivers', 'Water'])
+        self.assertTrue(LayerDate.objects.filter(layer=rivers, date='2010-05-01', type=1).exists())
+        lakes = self.service.layer_set.get(name='lakes')
+        # the extent is within (-2, -2, +2, +2)
+        self.assertFalse(lakes.is_valid)
+
+        # unchanged layers are not written again
+        self.assertEqual(bulk_upsert_layers(self.service, harvested, update_layer), [])
+
+        # changed layers are updated in place
+        harvested = [
+            HarvestedLayer(
+                {'name': 'rivers'}, {'title': 'Main rivers', 'bbox': (-10, -10, 10, 10)},
+                harvest_hash='2', keywords=['water']
+            ),
+        ]
+        updated = bulk_upsert_layers(self.service, harvested, update_layer, replace_keywords=True)
+        self.assertEqual([layer.id for layer in updated], [rivers.id])
+        self.assertEqual(Layer.objects.count(), layers_count + 2)
+        rivers = self.service.layer_set.get(name='rivers')
+        self.assertEqual(rivers.title, 'Main rivers')
+        self.assertEqual(list(rivers.keywords.names()), ['Water'])
+        self.assertEqual(LayerDate.objects.filter(layer=rivers, date='2010-05-01').count(), 1)
+
+    def test_bulk_upsert_layers_reads_batch(self):
+        # a service with many layers, looked up by name and uuid as the WorldMap layers
+        Layer.objects.bulk_create([
+            Layer(service=self.service, catalog=self.service.catalog, name='layer%s' % i, uuid=uuid.UUID(int=i))
+            for i in range(200)
+        ])
+        read = []
+
+        def layer_post_init(sender, instance, **kwargs):
+            if instance.id is not None:
+                read.append(instance.name)
+
+        harvested = [
+            HarvestedLayer(
+                {'name': 'layer1', 'uuid': str(uuid.UUID(int=1))}, {'title': 'Layer 1', 'bbox': (-10, -10, 10, 10)}
+            ),
+            # the name of a layer with another uuid
+            HarvestedLayer(
+                {'name': 'layer2', 'uuid': str(uuid.uuid4())}, {'title': 'Layer 2', 'bbox': (-10, -10, 10, 10)}
+            ),
+        ]
+        signals.post_init.connect(layer_post_init, sender=Layer)
+        try:
+            updated = bulk_upsert_layers(self.service, harvested, update_layer)
+        finally:
+            signals.post_init.disconnect(layer_post_init, sender=Layer)
+
+        # only the layers of the batch are read, before and after the new one is created
+        self.assertEqual(sorted(set(read)), ['layer1', 'layer2'])
+        self.assertEqual(len(updated), 2)
+        self.assertEqual(self.service.layer_set.filter(name='layer2').count(), 2)
+        self.assertEqual(self.service.layer_set.get(uuid=uuid.UUID(int=1)).title, 'Layer 1')
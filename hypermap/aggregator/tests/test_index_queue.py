@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the index queue.
+"""
+
+from django.test import TestCase
+from django.db import transaction
+
+from hypermap.aggregator.enums import INDEX_UPSERT, INDEX_DELETE
+from hypermap.aggregator.models import LayerIndexQueue
+from hypermap.aggregator.indexing import enqueue_layers, claim_queued_layers
+
+
+class TestIndexQueue(TestCase):
+
+    def test_enqueue_layers(self):
+        enqueue_layers([1, 2, 3])
+        enqueue_layers([2, 3, 3, 4])
+        # layers are queued once
+        self.assertEqual(LayerIndexQueue.objects.count(), 4)
+        self.assertEqual(LayerIndexQueue.objects.filter(operation=INDEX_UPSERT).count(), 4)
+
+        # queueing a layer again updates its operation
+        enqueue_layers([4, 5], INDEX_DELETE)
+        self.assertEqual(LayerIndexQueue.objects.count(), 5)
+        self.assertEqual(
+            sorted(LayerIndexQueue.objects.filter(operation=INDEX_DELETE).values_list('layer_id', flat=True)),
+            [4, 5]
+        )
+
+    def test_claim_queued_layers(self):
+        enqueue_layers([1, 2, 3])
+        enqueue_layers([4], INDEX_DELETE)
+        with transaction.atomic():
+            entries = claim_queued_layers(INDEX_UPSERT, 2)
+            self.assertEqual(len(entries), 2)
+            self.assertTrue(all(entry.operation == INDEX_UPSERT for entry in entries))
+        with transaction.atomic():
+            entries = claim_queued_layers(INDEX_DELETE, 10)
+            self.assertEqual([entry.layer_id for entry in entries], [4])
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the streaming reindex of the layers.
+"""
+
+import json
+import threading
+
+from django.core.management import call_command
+from django.db.models import signals
+from django.test import TestCase
+from httmock import HTTMock, response, urlmatch
+
+from hypermap.aggregator.indexing import iter_layer_ids, reindex_layers
+from hypermap.aggregator.models import Catalog, Layer, Service, layer_post_save, service_post_save
+
+
+class TestReindex(TestCase):
+
+    def setUp(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        catalog, created = Catalog.objects.get_or_create(name="hypermap", slug="hypermap")
+        service = Service.objects.create(type='OGC:WMS', url='http://wms.example.com/ows?', catalog=catalog)
+        self.layers = [
+            Layer.objects.create(
+                name='layer%s' % i, title='Layer %s' % i, service=service, catalog=catalog, type='OGC:WMS',
+                bbox_x0=-10, bbox_y0=-5, bbox_x1=10, bbox_y1=5, is_valid=True
+            )
+            for i in range(7)
+        ]
+        # neither invalid nor deleted layers are reindexed
+        Layer.objects.filter(id=self.layers[2].id).update(is_valid=False)
+        Layer.objects.filter(id=self.layers[5].id).update(was_deleted=True)
+        self.indexed_ids = [layer.id for i, layer in enumerate(self.layers) if i not in (2, 5)]
+
+        self.lock = threading.Lock()
+        self.updates = []
+        self.deletes = []
+
+        @urlmatch(netloc=r'localhost:8983$')
+        def solr_post(url, request):
+            with self.lock:
+                if url.path.endswith('/update/json/docs'):
+                    self.updates.append([int(doc['layer_id']) for doc in json.loads(request.body)])
+                else:
+                    self.deletes.append(request.body)
+            return response(200, '{"responseHeader": {"status": 0}}', {'content-type': 'application/json'})
+
+        self.solr_post = solr_post
+
+    def tearDown(self):
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+
+    def test_iter_layer_ids(self):
+        chunks = list(iter_layer_ids(Layer.objects.filter(is_valid=True, was_deleted=False), 2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(sum(chunks, []), self.indexed_ids)
+
+    def test_reindex_layers(self):
+        with HTTMock(self.solr_post):
+            stats = reindex_layers(chunk_size=2, window=2)
+        self.assertEqual(stats, {'chunks': 3, 'layers': 5, 'failed_chunks': 0, 'failed_layers': 0})
+        # each chunk is sent once, and every layer is pushed exactly once
+        self.assertEqual(sorted(len(update) for update in self.updates), [1, 2, 2])
+        self.assertEqual(sorted(sum(self.updates, [])), self.indexed_ids)
+        self.assertEqual(self.deletes, [])
+
+    def test_reindex_layers_command(self):
+        with HTTMock(self.solr_post):
+            call_command('reindex_layers', chunk_size='3', window='1', clear=True)
+        # the index is cleared before the layers are sent
+        self.assertEqual(len(self.deletes), 1)
+        self.assertIn('*:*', self.deletes[0])
+        self.assertEqual(self.updates, [self.indexed_ids[:3], self.indexed_ids[3:]])
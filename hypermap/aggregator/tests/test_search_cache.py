@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the cache of the search responses.
+"""
+
+import json
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from httmock import HTTMock, response, urlmatch
+
+from hypermap.aggregator.models import Catalog
+from hypermap.aggregator.search_cache import (PENDING_KEY, bump_index_generation, get_cached_search,
+                                              get_index_generation, get_search_key, search_cache,
+                                              set_cached_search, stats_cache)
+from hypermap.search_api.serializers import SearchSerializer
+from hypermap.search_api.utils import asterisk_to_min_max
+
+
+class TestSearchCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        search_cache.clear()
+        stats_cache.clear()
+        # a catalog without url is searched locally
+        self.catalog, created = Catalog.objects.get_or_create(name="hypermap", slug="hypermap")
+
+    def test_get_search_key(self):
+        params = {'q_text': 'title:"ocean"', 'd_docs_limit': 10}
+        self.assertEqual(
+            get_search_key('hypermap', params, 1),
+            get_search_key('hypermap', {'d_docs_limit': 10, 'q_text': 'title:"ocean"'}, 1)
+        )
+        self.assertNotEqual(get_search_key('hypermap', params, 1), get_search_key('other', params, 1))
+        self.assertNotEqual(get_search_key('hypermap', params, 1), get_search_key('hypermap', params, 2))
+
+    def test_generation(self):
+        params = {'q_text': 'ocean'}
+        generation = get_index_generation()
+        key, data = get_cached_search('hypermap', params)
+        self.assertIsNone(data)
+        set_cached_search(key, {'a.matchDocs': 1})
+        self.assertEqual(get_cached_search('hypermap', params), (key, {'a.matchDocs': 1}))
+
+        # a write to the search backend invalidates the responses
+        self.assertEqual(bump_index_generation(), generation + 1)
+        key, data = get_cached_search('hypermap', params)
+        self.assertIsNone(data)
+
+        # the generation starts over if it is evicted
+        cache.clear()
+        self.assertEqual(bump_index_generation(), 1)
+
+    def test_search_view(self):
+        params = {'q_text': 'ocean', 'search_engine': 'elasticsearch'}
+        serializer = SearchSerializer(data=params)
+        self.assertTrue(serializer.is_valid())
+        key, data = get_cached_search(self.catalog.slug, serializer.validated_data)
+        set_cached_search(key, {'a.matchDocs': 3, 'd.docs': []})
+
+        # the search backend is not requested for a cached response
+        response = self.client.get(reverse('search_api', args=[self.catalog.slug]), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'a.matchDocs': 3, 'd.docs': []})
+
+    def test_pending_writes(self):
+        url = reverse('search_api', args=[self.catalog.slug])
+        params = {'search_engine': 'solr', 'search_engine_endpoint': 'http://search.example.com/solr/hypermap/select'}
+        # the number of documents the core returns, which is 1 once the write is committed
+        committed = [0]
+
+        @urlmatch(netloc=r'search\.example\.com$')
+        def solr_get(url, request):
+            content = {
+                'responseHeader': {'QTime': 1},
+                'response': {'numFound': committed[0], 'docs': []},
+                'debug': {'timing': {'time': 1.0}},
+            }
+            return response(200, json.dumps(content), {'content-type': 'application/json'})
+
+        with HTTMock(solr_get):
+            # a layer is written, and searched before Solr commits it
+            bump_index_generation()
+            self.assertEqual(self.client.get(url, params).data['a.matchDocs'], 0)
+            # the write is committed, and the delay expires
+            committed[0] = 1
+            cache.delete(PENDING_KEY)
+            self.assertEqual(self.client.get(url, params).data['a.matchDocs'], 1)
+            # the response is cached once the write is visible
+            committed[0] = 2
+            self.assertEqual(self.client.get(url, params).data['a.matchDocs'], 1)
+
+    def test_search_errors(self):
+        url = reverse('search_api', args=[self.catalog.slug])
+        # the original responses of the backend are returned as they are, errors included
+        params = {'search_engine': 'solr', 'search_engine_endpoint': 'http://search.example.com/solr/hypermap/select',
+                  'original_response': 1}
+        # the core fails once, then recovers
+        failed = [True]
+
+        @urlmatch(netloc=r'search\.example\.com$')
+        def solr_get(url, request):
+            if failed[0]:
+                content = {'responseHeader': {'QTime': 1}, 'error': {'msg': 'no servers hosting shard', 'code': 503}}
+            else:
+                content = {
+                    'responseHeader': {'QTime': 1},
+                    'response': {'numFound': 1, 'docs': []},
+                    'debug': {'timing': {'time': 1.0}},
+                }
+            return response(200, json.dumps(content), {'content-type': 'application/json'})
+
+        with HTTMock(solr_get):
+            self.assertIn('error', self.client.get(url, params).data)
+            # the error is not served from the cache
+            failed[0] = False
+            self.assertEqual(self.client.get(url, params).data['response']['numFound'], 1)
+
+    def test_asterisk_to_min_max(self):
+        requests = []
+
+        @urlmatch(netloc=r'search\.example\.com$')
+        def stats_get(url, request):
+            requests.append(url.path)
+            if url.path.endswith('/select'):
+                content = {'stats': {'stats_fields': {'layer_date': {
+                    'min': '1900-01-01T00:00:00Z', 'max': '2000-01-01T00:00:00Z'
+                }}}}
+            else:
+                content = {'aggregations': {
+                    'date_min': {'value': -2208988800000}, 'date_max': {'value': 946684800000}
+                }}
+            return response(200, json.dumps(content), {'content-type': 'application/json'})
+
+        solr_endpoint = 'http://search.example.com/solr/hypermap/select'
+        es_endpoint = 'http://search.example.com/hypermap/_search'
+        with HTTMock(stats_get):
+            self.assertEqual(
+                asterisk_to_min_max('layer_date', '[* TO 1950-01-01T00:00:00Z]', solr_endpoint),
+                '[1900-01-01T00:00:00Z TO 1950-01-01T00:00:00Z]'
+            )
+            self.assertEqual(
+                asterisk_to_min_max('layer_date', '[* TO *]', solr_endpoint),
+                '[1900-01-01T00:00:00Z TO 2000-01-01T00:00:00Z]'
+            )
+            self.assertEqual(
+                asterisk_to_min_max('layer_date', '[* TO *]', es_endpoint, search_engine='elasticsearch'),
+                '[1900-01-01T00:00:00Z TO 2000-01-01T00:00:00Z]'
+            )
+            self.assertEqual(requests, ['/solr/hypermap/select', '/hypermap/_search'])
+
+            # the dates are requested again once the index changes, until the write is visible
+            bump_index_generation()
+            asterisk_to_min_max('layer_date', '[1950-01-01T00:00:00Z TO *]', solr_endpoint)
+            asterisk_to_min_max('layer_date', '[1950-01-01T00:00:00Z TO *]', solr_endpoint)
+            self.assertEqual(len(requests), 4)
+            cache.delete(PENDING_KEY)
+            asterisk_to_min_max('layer_date', '[1950-01-01T00:00:00Z TO *]', solr_endpoint)
+            asterisk_to_min_max('layer_date', '[1950-01-01T00:00:00Z TO *]', solr_endpoint)
+            self.assertEqual(len(requests), 5)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the cursor paging and the export of the Search API.
+"""
+
+import csv
+import json
+import urlparse
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from httmock import HTTMock, response, urlmatch
+
+from hypermap.aggregator.models import Catalog
+from hypermap.aggregator.search_cache import search_cache
+from hypermap.aggregator.search_client import ESCapabilities, get_es_capabilities
+from hypermap.search_api.serializers import SearchSerializer
+from hypermap.search_api.utils import decode_cursor, encode_cursor
+
+
+SOLR_ENDPOINT = 'http://solr.example.com/solr/hypermap/select'
+SEARCH_URL = settings.SEARCH_URL
+
+# the mappings of layer_id of an index created by Hypermap, and of an older index mapped dynamically
+LONG_MAPPING = {'hypermap': {'mappings': {'layer': {
+    'layer_id': {'full_name': 'layer_id', 'mapping': {'layer_id': {'type': 'long'}}},
+}}}}
+TEXT_MAPPING = {'hypermap': {'mappings': {'layer': {
+    'layer_id': {'full_name': 'layer_id', 'mapping': {'layer_id': {
+        'type': 'text', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}
+    }}},
+    'layer_id.keyword': {'full_name': 'layer_id.keyword', 'mapping': {'keyword': {
+        'type': 'keyword', 'ignore_above': 256
+    }}},
+}}}}
+
+# the ids of the documents of the core
+IDS = ['1', '2', '3', '4', '5']
+
+
+def get_doc(layer_id):
+    return {
+        'id': layer_id, 'title': u'Layer \xe9 %s' % layer_id, 'keywords': ['a', 'b'],
+        'min_x': -10.0, 'min_y': -5.0, 'max_x': 10.0, 'max_y': 5.0, 'bbox': 'ENVELOPE(-10,10,5,-5)',
+    }
+
+
+class TestSearchCursor(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        search_cache.clear()
+        self.catalog, created = Catalog.objects.get_or_create(name="hypermap", slug="hypermap")
+        self.requests = []
+
+        @urlmatch(netloc=r'solr\.example\.com$')
+        def solr_get(url, request):
+            params = dict(urlparse.parse_qsl(url.query))
+            self.requests.append(params)
+            # the cursor mark of this mock is the id of the last returned document
+            cursor_mark = params['cursorMark']
+            start = 0 if cursor_mark == '*' else IDS.index(cursor_mark) + 1
+            ids = IDS[start:start + int(params['rows'])]
+            content = {
+                'responseHeader': {'QTime': 1},
+                'response': {'numFound': len(IDS), 'docs': [get_doc(layer_id) for layer_id in ids]},
+                'debug': {'timing': {'time': 1.0}},
+                'nextCursorMark': ids[-1] if ids else cursor_mark,
+            }
+            return response(200, json.dumps(content), {'content-type': 'application/json'})
+
+        self.solr_get = solr_get
+
+    def test_cursor_validation(self):
+        self.assertIsNone(decode_cursor('*'))
+        self.assertEqual(decode_cursor(encode_cursor([1.5, '12'])), [1.5, '12'])
+        self.assertTrue(SearchSerializer(data={'d_docs_cursor': encode_cursor('AoE/')}).is_valid())
+        self.assertFalse(SearchSerializer(data={'d_docs_cursor': 'not a cursor'}).is_valid())
+
+    def es_mock(self, mapping):
+        # the search url of the tests is localhost:8983
+        @urlmatch(netloc=r'(es\.example\.com|localhost:8983)$')
+        def es_request(url, request):
+            self.requests.append((url.path, json.loads(request.body) if request.body else None))
+            if url.path == '/':
+                content = {'version': {'number': '5.6.0'}}
+            elif '/_mapping/field/' in url.path:
+                content = mapping
+            else:
+                doc = dict(get_doc('1'), abstract='')
+                content = {'hits': {'total': 1, 'hits': [{'_source': doc, 'sort': ['1']}]}}
+            return response(200, json.dumps(content), {'content-type': 'application/json'})
+        return es_request
+
+    def test_es_sort_field(self):
+        capabilities = ESCapabilities('http://es.example.com')
+        with HTTMock(self.es_mock(LONG_MAPPING)):
+            self.assertEqual(capabilities.sort_field('hypermap', 'layer_id'), 'layer_id')
+        capabilities.invalidate('hypermap')
+        with HTTMock(self.es_mock(TEXT_MAPPING)):
+            self.assertEqual(capabilities.sort_field('hypermap', 'layer_id'), 'layer_id.keyword')
+            # the mapping is checked once
+            capabilities.sort_field('hypermap', 'layer_id')
+        self.assertEqual(len(self.requests), 2)
+        capabilities.invalidate('hypermap')
+        with HTTMock(self.es_mock({'hypermap': {'mappings': {}}})):
+            self.assertIsNone(capabilities.sort_field('hypermap', 'layer_id'))
+
+    def test_es_cursor_old_index(self):
+        url = reverse('search_api', args=[self.catalog.slug])
+        get_es_capabilities(SEARCH_URL).invalidate()
+        try:
+            with HTTMock(self.es_mock(TEXT_MAPPING)):
+                data = self.client.get(url, {'search_engine': 'elasticsearch', 'd.docs.cursor': '*'}).data
+        finally:
+            get_es_capabilities(SEARCH_URL).invalidate()
+        # the text layer_id of an index created before its mapping cannot be sorted on, its keyword can
+        path, body = self.requests[-1]
+        self.assertEqual(path, '/hypermap/_search')
+        self.assertEqual(body['sort'][-1], {'layer_id.keyword': {'order': 'asc'}})
+        self.assertEqual(decode_cursor(data['d.docs.cursor']), ['1'])
+
+    def test_solr_cursor(self):
+        url = reverse('search_api', args=[self.catalog.slug])
+        params = {
+            'search_engine': 'solr', 'search_engine_endpoint': SOLR_ENDPOINT,
+            'd.docs.limit': 2, 'd.docs.sort': 'time', 'd.docs.cursor': '*',
+        }
+        ids = []
+        with HTTMock(self.solr_get):
+            while True:
+                data = self.client.get(url, params).data
+                ids.extend(doc['id'] for doc in data.get('d.docs', []))
+                if data['d.docs.cursor'] == params['d.docs.cursor']:
+                    break
+                params['d.docs.cursor'] = data['d.docs.cursor']
+
+        self.assertEqual(ids, IDS)
+        self.assertEqual(len(self.requests), 4)
+        # the pages are not requested with an offset, and are sorted by the uniqueKey last
+        self.assertEqual([request['cursorMark'] for request in self.requests], ['*', '2', '4', '5'])
+        self.assertNotIn('start', self.requests[0])
+        self.assertEqual(self.requests[0]['sort'], 'layer_date desc, id asc')
+
+    def test_export(self):
+        url = reverse('search_api_export', args=[self.catalog.slug])
+        params = {'search_engine': 'solr', 'search_engine_endpoint': SOLR_ENDPOINT, 'd.docs.limit': 2}
+        with HTTMock(self.solr_get):
+            response = self.client.get(url, params)
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            lines = ''.join(response.streaming_content).splitlines()
+            self.assertEqual([json.loads(line)['id'] for line in lines], IDS)
+            # the pages are requested with a cursor, until an empty page
+            self.assertEqual([request['cursorMark'] for request in self.requests], ['*', '2', '4', '5'])
+
+            response = self.client.get(url, dict(params, **{'export.format': 'csv'}))
+            rows = list(csv.reader(''.join(response.streaming_content).splitlines()))
+            self.assertEqual(rows[0][:4], ['id', 'layer_id', 'name', 'title'])
+            self.assertEqual([row[0] for row in rows[1:]], IDS)
+            self.assertEqual(rows[1][3].decode('utf-8'), u'Layer \xe9 1')
+
+            response = self.client.get(url, dict(params, **{'export.format': 'geojson'}))
+            self.assertEqual(response['Content-Disposition'], 'attachment; filename="hypermap.geojson"')
+            collection = json.loads(''.join(response.streaming_content))
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        self.assertEqual([feature['id'] for feature in collection['features']], IDS)
+        feature = collection['features'][0]
+        self.assertEqual(
+            feature['geometry']['coordinates'], [[[-10, -5], [10, -5], [10, 5], [-10, 5], [-10, -5]]]
+        )
+        self.assertNotIn('bbox', feature['properties'])
+        self.assertEqual(feature['properties']['keywords'], ['a', 'b'])
+
+    def test_export_errors(self):
+        url = reverse('search_api_export', args=[self.catalog.slug])
+        self.assertEqual(self.client.get(url, {'export.format': 'xml'}).status_code, 400)
+
+        @urlmatch(netloc=r'solr\.example\.com$')
+        def solr_error(url, request):
+            content = {'error': {'msg': 'undefined field', 'code': 400}}
+            return response(400, json.dumps(content), {'content-type': 'application/json'})
+
+        with HTTMock(solr_error):
+            export = self.client.get(url, {'search_engine': 'solr', 'search_engine_endpoint': SOLR_ENDPOINT})
+        self.assertEqual(export.status_code, 400)
+        self.assertEqual(export.data['error']['msg'], 'undefined field')
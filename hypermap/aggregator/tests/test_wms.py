@@ -9,7 +9,7 @@ import unittest
 from httmock import with_httmock
 import mocks.wms
 
-from hypermap.aggregator.models import Service, Catalog
+from hypermap.aggregator.models import Service, Catalog, update_layers_wms
 
 
 class TestWMS1_1_1(unittest.TestCase):
@@ -82,6 +82,17 @@ class TestWMS1_3_0(unittest.TestCase):
         self.assertEqual(layer_0.check_set.all().count(), 1)
         # TODO test layer_0.layerdate_set
 
+        # the layers are not harvested again while the capabilities document does not change
+        service = Service.objects.get(id=service.id)
+        self.assertTrue(service.capabilities_hash)
+        service.layer_set.filter(id=layer_0.id).update(title='Renamed')
+        update_layers_wms(service)
+        self.assertEqual(service.layer_set.get(id=layer_0.id).title, 'Renamed')
+        # nor the layers which did not change in a changed document
+        service.capabilities_hash = None
+        update_layers_wms(service)
+        self.assertEqual(service.layer_set.get(id=layer_0.id).title, 'Renamed')
+
         # test that if creating the service and is already exiting it is not being duplicated
         # create the service
         def create_duplicated_service():
@@ -5,12 +5,21 @@ Tests for the WorldMap Service Type.
 """
 
 import unittest
+import urlparse
 
-from httmock import with_httmock
+from django.db.models import signals
+from django.test import TestCase
+from httmock import HTTMock, response, with_httmock, urlmatch
 import mocks.worldmap
 
-from hypermap.aggregator.models import Service, Catalog
+from hypermap.aggregator.models import Service, Catalog, service_post_save
 from hypermap.aggregator.enums import DATE_DETECTED, DATE_FROM_METADATA
+from hypermap.aggregator.worldmap import harvest_worldmap
+from hypermap.aggregator.models import parse_wm_legacy_row, update_worldmap_layer, update_layers_wm_legacy
+
+
+# the rows of the layer api of the WorldMap mock
+LAYERS_PATH = '%s/worldmap.harvard.edu/api/1.5/layer' % mocks.worldmap.API_PATH
 
 
 class TestWorldMap(unittest.TestCase):
@@ -129,5 +138,91 @@ class TestWorldMap(unittest.TestCase):
         self.assertRaises(Exception, create_duplicated_service)
 
 
+class TestWorldMapHarvest(TestCase):
+
+    def setUp(self):
+        # the layers are harvested by the tests
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service.objects.create(
+            type='Hypermap:WorldMapLegacy',
+            url='http://worldmap.harvard.edu/',
+            catalog=catalog
+        )
+        self.requests = []
+
+        @urlmatch(netloc=mocks.worldmap.NETLOC)
+        def resource_get(url, request):
+            self.requests.append(dict(urlparse.parse_qsl(url.query)))
+            return mocks.worldmap.resource_get(url, request)
+
+        self.resource_get = resource_get
+
+    def tearDown(self):
+        signals.post_save.connect(service_post_save, sender=Service)
+
+    def harvest(self, page_size):
+        with HTTMock(self.resource_get):
+            return harvest_worldmap(
+                self.service, 'http://worldmap.harvard.edu/api/1.5/layer/', 'created_dttm', parse_wm_legacy_row,
+                update_worldmap_layer, page_size=page_size, threads=2
+            )
+
+    def test_harvest_worldmap(self):
+        updated = self.harvest(4)
+        # every row is harvested exactly once
+        self.assertEqual(len(updated), 10)
+        self.assertEqual(len(set(updated)), 10)
+        self.assertEqual(self.service.layer_set.count(), 10)
+        self.assertEqual(sorted(params['offset'] for params in self.requests), ['0', '4', '8'])
+        self.assertEqual(Service.objects.get(id=self.service.id).harvest_last_date, '2016-11-10T18:03:30.061912')
+
+    def test_harvest_worldmap_limited_pages(self):
+        # the server returns 3 rows per page at most
+        def resource_get(url, request):
+            self.requests.append(dict(urlparse.parse_qsl(url.query)))
+            content = mocks.worldmap.Resource(LAYERS_PATH).get()
+            params = dict(urlparse.parse_qsl(url.query))
+            return response(200, mocks.worldmap.get_page(
+                content, int(params['offset']), int(params['limit']), max_limit=3
+            ), mocks.worldmap.HEADERS)
+
+        self.resource_get = urlmatch(netloc=mocks.worldmap.NETLOC)(resource_get)
+        updated = self.harvest(4)
+        self.assertEqual(len(set(updated)), 10)
+        self.assertEqual(sorted(params['offset'] for params in self.requests), ['0', '3', '6', '9'])
+        self.assertIsNotNone(Service.objects.get(id=self.service.id).harvest_last_date)
+
+    def test_harvest_worldmap_short_page(self):
+        # a row is deleted after the first page is requested
+        def resource_get(url, request):
+            self.requests.append(dict(urlparse.parse_qsl(url.query)))
+            content = mocks.worldmap.Resource(LAYERS_PATH).get()
+            params = dict(urlparse.parse_qsl(url.query))
+            offset = int(params['offset']) + (1 if params['offset'] != '0' else 0)
+            return response(200, mocks.worldmap.get_page(content, offset, int(params['limit'])),
+                            mocks.worldmap.HEADERS)
+
+        self.resource_get = urlmatch(netloc=mocks.worldmap.NETLOC)(resource_get)
+        self.harvest(4)
+        # the harvest is incomplete: the next incremental harvest requests all the rows again
+        self.assertIsNone(Service.objects.get(id=self.service.id).harvest_last_date)
+
+    def test_incremental_harvest(self):
+        with HTTMock(self.resource_get):
+            update_layers_wm_legacy(self.service, num_layers=5)
+            # the older layers are not harvested yet
+            self.assertIsNone(Service.objects.get(id=self.service.id).harvest_last_date)
+            update_layers_wm_legacy(self.service)
+            self.assertEqual(self.service.layer_set.filter(was_deleted=True).count(), 2)
+            self.requests = []
+            update_layers_wm_legacy(self.service, incremental=True)
+        self.assertEqual(self.requests[0]['created_dttm__gt'], '2016-11-10T18:03:30.061912')
+        self.assertEqual(self.requests[0]['order_by'], '-created_dttm')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,4 @@
 import arcrest
-import urllib2
 import logging
 import requests
 import re
@@ -10,15 +9,14 @@ import datetime
 from urlparse import urlparse
 
 from django.utils.html import strip_tags
-from django.conf import settings
 
 from lxml import etree
-from owslib.csw import CatalogueServiceWeb, CswRecord
-from owslib.wms import WebMapService
-from owslib.tms import TileMapService
-from owslib.wmts import WebMapTileService
+from owslib.csw import CswRecord
 
-from hypermap.aggregator.enums import SERVICE_TYPES
+from hypermap.aggregator.detection import detect_service
+from hypermap.aggregator.capabilities import store_detected_capabilities, get_ows
+from hypermap.aggregator.csw_harvest import harvest_csw
+from hypermap.aggregator.esri import crawl_esri
 from lxml.etree import XMLSyntaxError
 from shapely.geometry import box
 
@@ -59,15 +57,17 @@ def create_layer_from_metadata_xml(resourcetype, xml, monitor=False, service=Non
     return layer, md.subjects
 
 
-def create_service_from_endpoint(endpoint, service_type, title=None, abstract=None, catalog=None):
+def create_service_from_endpoint(endpoint, service_type, title=None, abstract=None, catalog=None,
+                                 check_endpoint=True):
     """
     Create a service from an endpoint if it does not already exists.
+    :param check_endpoint: request the endpoint to check that it is valid.
     """
     from models import Service
     if Service.objects.filter(url=endpoint, catalog=catalog).count() == 0:
         # check if endpoint is valid
-        request = requests.get(endpoint)
-        if request.status_code == 200:
+        status_code = requests.get(endpoint).status_code if check_endpoint else 200
+        if status_code == 200:
             LOGGER.debug('Creating a %s service for endpoint=%s catalog=%s' % (service_type, endpoint, catalog))
             service = Service(
                         type=service_type, url=endpoint, title=title, abstract=abstract,
@@ -76,7 +76,7 @@ def create_service_from_endpoint(endpoint, service_type, title=None, abstract=No
             service.save()
             return service
         else:
-            LOGGER.warning('This endpoint is invalid, status code is %s' % request.status_code)
+            LOGGER.warning('This endpoint is invalid, status code is %s' % status_code)
     else:
         LOGGER.warning('A service for this endpoint %s in catalog %s already exists' % (endpoint, catalog))
         return None
@@ -96,16 +96,6 @@ def create_services_from_endpoint(url, catalog, greedy_opt=True):
 
     num_created = 0
     endpoint = get_sanitized_endpoint(url)
-    try:
-        urllib2.urlopen(endpoint, timeout=10)
-    except Exception as e:
-        message = traceback.format_exception(*sys.exc_info())
-        LOGGER.error('Cannot open this endpoint: %s' % endpoint)
-        LOGGER.error('ERROR MESSAGE: %s' % message)
-        LOGGER.error(e, exc_info=True)
-
-        return False, message
-
     detected = False
 
     # handle specific service types for some domains (WorldMap, Wrapper...)
@@ -127,149 +117,45 @@ def create_services_from_endpoint(url, catalog, greedy_opt=True):
         abstract = 'Warper at %s' % domain
         detected = True
 
-    # test if it is CSW, WMS, TMS, WMTS or Esri
-    # CSW
+    # the endpoint is downloaded once, and its type is detected from the root element of the document,
+    # requesting the GetCapabilities of the OGC services only if the endpoint is not a capabilities document
     try:
-        csw = CatalogueServiceWeb(endpoint)
-        service_type = 'OGC:CSW'
-        service_links = {}
-        detected = True
-
-        typenames = 'csw:Record'
-        outputschema = 'http://www.opengis.net/cat/csw/2.0.2'
-
-        if 'csw_harvest_pagesize' in settings.REGISTRY_PYCSW['manager']:
-            pagesize = int(settings.REGISTRY_PYCSW['manager']['csw_harvest_pagesize'])
-        else:
-            pagesize = 10
-
-        LOGGER.debug('Harvesting CSW %s' % endpoint)
-        # now get all records
-        # get total number of records to loop against
-        try:
-            csw.getrecords2(typenames=typenames, resulttype='hits',
-                            outputschema=outputschema)
-            matches = csw.results['matches']
-        except:  # this is a CSW, but server rejects query
-            raise RuntimeError(csw.response)
-
-        if pagesize > matches:
-            pagesize = matches
-
-        LOGGER.info('Harvesting %d CSW records' % matches)
-
-        # loop over all catalogue records incrementally
-        for r in range(1, matches+1, pagesize):
-            LOGGER.info('Parsing %s from %s' % (r, matches))
-            try:
-                csw.getrecords2(typenames=typenames, startposition=r,
-                                maxrecords=pagesize, outputschema=outputschema, esn='full')
-            except Exception as err:  # this is a CSW, but server rejects query
-                raise RuntimeError(csw.response)
-            for k, v in csw.records.items():
-                # try to parse metadata
-                try:
-                    LOGGER.info('Looking for service links')
-
-                    LOGGER.debug('Looking for service links via dct:references')
-                    if v.references:
-                        for ref in v.references:
-                            scheme = None
-
-                            if ref['scheme'] in [st[0] for st in SERVICE_TYPES]:
-                                if ref['url'] not in service_links:
-                                    scheme = ref['scheme']
-                                    service_links[ref['url']] = scheme
-                            else:  # loose detection
-                                scheme = detect_metadata_url_scheme(ref['url'])
-                                if scheme is not None:
-                                    if ref['url'] not in service_links:
-                                        service_links[ref['url']] = scheme
-
-                            if scheme is None:
-                                continue
-                            try:
-                                service = create_service_from_endpoint(ref['url'], scheme, catalog=catalog)
-
-                                if service is not None:
-                                    num_created = num_created + 1
-                                    LOGGER.info('Found %s services on endpoint' % num_created)
-                            except Exception, e:
-                                LOGGER.error('Could not create service for %s : %s' % (scheme, ref['url']))
-                                LOGGER.error(e, exc_info=True)
-                    LOGGER.debug('Looking for service links via the GeoNetwork-ish dc:URI')
-                    if v.uris:
-                        for u in v.uris:  # loose detection
-                            scheme = detect_metadata_url_scheme(u['url'])
-                            if scheme is not None:
-                                if u['url'] not in service_links:
-                                    service_links[u['url']] = scheme
-                            else:
-                                continue
-
-                            try:
-                                service = create_service_from_endpoint(u['url'], scheme, catalog=catalog)
-
-                                if service is not None:
-                                    num_created = num_created + 1
-                                    LOGGER.info('Found %s services on endpoint' % num_created)
-                            except Exception, e:
-                                LOGGER.error('Could not create service for %s : %s' % (scheme, u['url']))
-                                LOGGER.error(e, exc_info=True)
-
-                except Exception as err:  # parsing failed for some reason
-                    LOGGER.warning('Metadata parsing failed %s', err)
-                    LOGGER.error(err, exc_info=True)
-
-    except XMLSyntaxError as e:
-        # This is not XML, so likely not a CSW. Moving on.
-        pass
+        detection = detect_service(endpoint, timeout=10, capabilities_requests=not detected)
     except Exception as e:
+        message = traceback.format_exception(*sys.exc_info())
+        LOGGER.error('Cannot open this endpoint: %s' % endpoint)
+        LOGGER.error('ERROR MESSAGE: %s' % message)
         LOGGER.error(e, exc_info=True)
-        messages.append(str(e))
 
-    # WMS
-    if not detected:
-        try:
-            service = get_wms_version_negotiate(endpoint, timeout=10)
-            service_type = 'OGC:WMS'
-            title = service.identification.title,
-            abstract = service.identification.abstract
-            detected = True
-        except XMLSyntaxError as e:
-            # This is not XML, so likely not a WMS. Moving on.
-            pass
-        except Exception as e:
-            LOGGER.error(e, exc_info=True)
-            messages.append(str(e))
+        return False, message
+    if detected:
+        detection = None
 
-    # TMS
-    if not detected:
+    # test if it is CSW, WMS, TMS, WMTS or Esri
+    # CSW
+    if detection is not None and detection.service_type == 'OGC:CSW':
         try:
-            service = TileMapService(endpoint, timeout=10)
-            service_type = 'OSGeo:TMS'
-            title = service.identification.title,
-            abstract = service.identification.abstract
+            service_type = 'OGC:CSW'
             detected = True
+            # the records are paged concurrently, and the harvest resumes where it stopped
+            num_created = num_created + harvest_csw(endpoint, catalog)
         except XMLSyntaxError as e:
-            # This is not XML, so likely not a TsMS. Moving on.
+            # This is not XML, so likely not a CSW. Moving on.
             pass
         except Exception as e:
             LOGGER.error(e, exc_info=True)
             messages.append(str(e))
 
-    # WMTS
-    if not detected:
+    # WMS, TMS, WMTS
+    if not detected and detection is not None:
         try:
-            # @tomkralidis timeout is not implemented for WebMapTileService?
-            service = WebMapTileService(endpoint)
-            service_type = 'OGC:WMTS'
-            title = service.identification.title,
-            abstract = service.identification.abstract
+            service_type = detection.service_type
+            # read from the document while it was downloaded, without parsing it with OWSLib
+            title = detection.title
+            abstract = detection.abstract
             detected = True
-        except XMLSyntaxError as e:
-            # This is not XML, so likely not a WMTS. Moving on.
-            pass
+            # the document is handed to the first harvest of the service
+            store_detected_capabilities(endpoint, detection)
         except Exception as e:
             LOGGER.error(e, exc_info=True)
             messages.append(str(e))
@@ -282,7 +168,8 @@ def create_services_from_endpoint(url, catalog, greedy_opt=True):
                 service_type,
                 title,
                 abstract=abstract,
-                catalog=catalog
+                catalog=catalog,
+                check_endpoint=detection is None
             )
             if service is not None:
                 num_created = num_created + 1
@@ -303,23 +190,18 @@ def create_services_from_endpoint(url, catalog, greedy_opt=True):
     if '/rest/services' in endpoint:
         if not detected:
             try:
-                esri = arcrest.Folder(endpoint)
-                service_type = 'ESRI'
-                detected = True
-
-                service_to_process, folder_to_process = esri.services, esri.folders
-                if not greedy_opt:
-                    folder_to_process = []
+                if greedy_opt:
+                    # the whole folder tree, crawled with a pool of threads
+                    processed_services = crawl_esri(endpoint, catalog)
+                else:
+                    esri = arcrest.Folder(endpoint)
                     sections = service_url_parse(url)
                     service_to_process = get_single_service(esri, sections)
-
-                processed_services = process_esri_services(service_to_process, catalog)
+                    processed_services = process_esri_services(service_to_process, catalog)
+                service_type = 'ESRI'
+                detected = True
                 num_created = num_created + len(processed_services)
 
-                for folder in folder_to_process:
-                    folder_services = process_esri_services(folder.services, catalog)
-                    num_created = num_created + len(folder_services)
-
             except Exception as e:
                 LOGGER.error(e, exc_info=True)
                 messages.append(str(e))
@@ -412,18 +294,12 @@ def inverse_mercator(xy):
     return (lon, lat)
 
 
-def get_wms_version_negotiate(url, timeout=10):
+def get_wms_version_negotiate(url, timeout=10, max_age=None):
     """
-    OWSLib wrapper function to perform version negotiation against owslib.wms.WebMapService
+    OWSLib wrapper function to perform version negotiation against owslib.wms.WebMapService,
+    through the capabilities cache (see hypermap.aggregator.capabilities.get_ows).
     """
-
-    try:
-        LOGGER.debug('Trying a WMS 1.3.0 GetCapabilities request')
-        return WebMapService(url, version='1.3.0', timeout=timeout)
-    except Exception as err:
-        LOGGER.warning('WMS 1.3.0 support not found: %s', err)
-        LOGGER.debug('Trying a WMS 1.1.1 GetCapabilities request instead')
-        return WebMapService(url, version='1.1.1', timeout=timeout)
+    return get_ows(url, 'OGC:WMS', timeout=timeout, max_age=max_age)
 
 
 def mercator_to_llbbox(bbox):
@@ -567,9 +443,52 @@ def get_domain(url):
     return hostname
 
 
-def layer2dict(layer):
+def get_layers_for_indexing(layer_ids):
+    """
+    Return a queryset of layers with every relation used by the search serializers
+    already fetched, so a batch of layers is serialized in a fixed number of queries.
+    layer_ids can be a list or a values_list queryset of layer ids.
+    """
+    from models import Layer
+
+    return Layer.objects.filter(id__in=layer_ids).select_related(
+        'service', 'catalog', 'layerwm'
+    ).prefetch_related(
+        'keywords', 'layerdate_set', 'service__srs'
+    )
+
+
+def get_layers_check_stats(layer_ids):
+    """
+    Return the check statistics indexed in the search backend for a batch of layers,
+    read from their CheckStats with a single query.
+    :return: dict keyed by layer id with reliability, recent_reliability and last_status.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from models import CheckStats, Layer
+
+    layer_ids = list(layer_ids)
+    rows = CheckStats.objects.filter(
+        content_type=ContentType.objects.get_for_model(Layer),
+        object_id__in=layer_ids
+    )
+    rows = dict((row.object_id, row) for row in rows)
+
+    stats = {}
+    for layer_id in layer_ids:
+        check_stats = rows.get(layer_id, CheckStats())
+        stats[layer_id] = {
+            'reliability': check_stats.reliability,
+            'recent_reliability': check_stats.recent_reliability,
+            'last_status': check_stats.last_status,
+        }
+    return stats
+
+
+def layer2dict(layer, check_stats=None):
     """
     Return a json representation for a layer.
+    check_stats can be given (see get_layers_check_stats) to avoid computing them for each layer.
     """
 
     category = None
@@ -614,6 +533,13 @@ def layer2dict(layer):
     else:
         originator = domain
 
+    if check_stats is None:
+        check_stats = {
+            'reliability': layer.reliability,
+            'recent_reliability': layer.recent_reliability,
+            'last_status': layer.last_status,
+        }
+
     layer_dict = {
                     'id': layer.id,
                     'uuid': str(layer.uuid),
@@ -628,9 +554,9 @@ def layer2dict(layer):
                     'layer_username': username,
                     'url': layer.url,
                     'keywords': [kw.name for kw in layer.keywords.all()],
-                    'reliability': layer.reliability,
-                    'recent_reliability': layer.recent_reliability,
-                    'last_status': layer.last_status,
+                    'reliability': check_stats['reliability'],
+                    'recent_reliability': check_stats['recent_reliability'],
+                    'last_status': check_stats['last_status'],
                     'is_public': layer.is_public,
                     'is_valid': layer.is_valid,
                     'availability': 'Online',
@@ -652,7 +578,7 @@ def layer2dict(layer):
         layer_dict['bbox'] = wkt
         layer_dict['centroid_x'] = rectangle.centroid.x
         layer_dict['centroid_y'] = rectangle.centroid.y
-        srs_list = [srs.encode('utf-8') for srs in layer.service.srs.values_list('code', flat=True)]
+        srs_list = [srs.code.encode('utf-8') for srs in layer.service.srs.all()]
         layer_dict['srs'] = srs_list
     if layer.get_tile_url():
         layer_dict['tile_url'] = layer.get_tile_url()
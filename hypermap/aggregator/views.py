@@ -6,19 +6,19 @@ from django.http import HttpResponse
 from django.template import RequestContext, loader
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
-from django.db.models import Count
+from django.db.models import Count, Max
 from django.contrib.auth.decorators import login_required
-from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
 from djmp.views import get_mapproxy
 
 
-from models import Service, Layer, Catalog
+from models import Service, Layer, Catalog, LayerIndexQueue
 from tasks import (check_all_services, check_service, check_layer, remove_service_checks, unindex_layers_with_issues,
                    index_service, index_all_layers, index_layer, index_cached_layers, clear_index,
                    SEARCH_TYPE, SEARCH_URL)
-from enums import SERVICE_TYPES
+from enums import SERVICE_TYPES, INDEX_UPSERT, INDEX_DELETE
+from check_retention import get_check_history
 
 
 LOGGER = logging.getLogger(__name__)
@@ -42,22 +42,39 @@ class BootstrapPaginator(Paginator):
                      min(self.page.number + self.wing_pages + 1, self.num_pages + 1))
 
 
-def serialize_checks(check_set):
+def serialize_checks(resource, days=None):
     """
-    Serialize a check_set for raphael
+    Serialize the checks of a resource for raphael: the last 25 checks, or the checks and rollups
+    of the last days.
     """
+    if days:
+        history = get_check_history(resource, days)
+    else:
+        history = [
+            (check.checked_datetime, check.response_time, check.success) for check in resource.check_set.all()[:25]
+        ]
     check_set_list = []
-    for check in check_set.all()[:25]:
+    for checked_datetime, response_time, success in history:
         check_set_list.append(
             {
-                'datetime': check.checked_datetime.isoformat(),
-                'value': check.response_time,
-                'success': 1 if check.success else 0
+                'datetime': checked_datetime.isoformat(),
+                'value': response_time,
+                'success': 1 if success else 0
             }
         )
     return check_set_list
 
 
+def get_days(request):
+    """
+    Return the range of days requested for the checks history, if any.
+    """
+    try:
+        return max(int(request.GET.get('days')), 1)
+    except (TypeError, ValueError):
+        return None
+
+
 @login_required
 def domains(request):
     """
@@ -89,13 +106,13 @@ def index(request, catalog_slug=None):
     filter_by = request.GET.get('filter_by', None)
     query = request.GET.get('q', None)
 
-    services = Service.objects.prefetch_related('check_set').all()
+    services = Service.objects.prefetch_related('check_stats_set__last_check').all()
     if catalog_slug:
-        services = Service.objects.filter(catalog__slug=catalog_slug)
+        services = services.filter(catalog__slug=catalog_slug)
 
     # order_by
     if 'total_checks' in order_by:
-        services = services.annotate(total_checks=Count('resource_ptr__check')).order_by(order_by)
+        services = services.annotate(total_checks=Max('check_stats_set__checks_count')).order_by(order_by)
     elif 'layers_count' in order_by:
         services = services.annotate(layers_count=Count('layer')).order_by(order_by)
     else:
@@ -167,7 +184,9 @@ def service_detail(request, catalog_slug, service_uuid=None, service_id=None):
                 index_service.delay(service.id)
 
     page = request.GET.get('page', 1)
-    layers = service.layer_set.select_related('catalog').prefetch_related('check_set').all()
+    layers = service.layer_set.select_related('catalog').prefetch_related(
+        'check_stats_set__last_check'
+    ).all()
     paginator = BootstrapPaginator(layers, settings.PAGINATION_DEFAULT_PAGINATION)
 
     try:
@@ -186,7 +205,7 @@ def service_detail(request, catalog_slug, service_uuid=None, service_id=None):
 
 def service_checks(request, catalog_slug, service_uuid):
     service = get_object_or_404(Service, uuid=service_uuid)
-    resource = serialize_checks(service.check_set)
+    resource = serialize_checks(service, get_days(request))
 
     page = request.GET.get('page', 1)
     checks = service.check_set.all()
@@ -218,6 +237,8 @@ def layer_detail(request, catalog_slug, layer_uuid=None, layer_id=None):
                 check_layer.delay(layer.id)
         if 'remove' in request.POST:
             layer.check_set.all().delete()
+            layer.check_stats_set.all().delete()
+            layer.check_rollup_set.all().delete()
         if 'index' in request.POST:
             if settings.REGISTRY_SKIP_CELERY:
                 index_layer(layer.id)
@@ -232,7 +253,7 @@ def layer_detail(request, catalog_slug, layer_uuid=None, layer_id=None):
 
 def layer_checks(request, catalog_slug, layer_uuid):
     layer = get_object_or_404(Layer, uuid=layer_uuid)
-    resource = serialize_checks(layer.check_set)
+    resource = serialize_checks(layer, get_days(request))
 
     page = request.GET.get('page', 1)
     checks = layer.check_set.all()
@@ -257,15 +278,8 @@ def tasks_runner(request):
     """
 
     # server info
-    cached_layers_number = 0
-    cached_layers = cache.get('layers')
-    if cached_layers:
-        cached_layers_number = len(cached_layers)
-
-    cached_deleted_layers_number = 0
-    cached_deleted_layers = cache.get('deleted_layers')
-    if cached_deleted_layers:
-        cached_deleted_layers_number = len(cached_deleted_layers)
+    cached_layers_number = LayerIndexQueue.objects.filter(operation=INDEX_UPSERT).count()
+    cached_deleted_layers_number = LayerIndexQueue.objects.filter(operation=INDEX_DELETE).count()
 
     # task actions
     if request.method == 'POST':
@@ -285,8 +299,7 @@ def tasks_runner(request):
             else:
                 index_cached_layers.delay()
         if 'drop_cached' in request.POST:
-            cache.set('layers', None)
-            cache.set('deleted_layers', None)
+            LayerIndexQueue.objects.all().delete()
         if 'clear_index' in request.POST:
             if settings.REGISTRY_SKIP_CELERY:
                 clear_index()
@@ -0,0 +1,44 @@
+import functools
+from multiprocessing.pool import ThreadPool
+
+from django.db import connection
+
+
+def run_in_thread(function, *args):
+    """
+    Call function in a worker thread, closing the database connection Django opened for the thread.
+    """
+    try:
+        return function(*args)
+    finally:
+        connection.close()
+
+
+class WorkerPool(object):
+    """
+    A pool of threads mapping functions over items, shared by the checks and the harvests.
+    With a single thread the functions are called by the calling thread, without a pool.
+    Use it as a context manager, which closes the pool and waits for its threads:
+
+        with WorkerPool(threads) as pool:
+            results = pool.map(function, items)
+    """
+
+    def __init__(self, threads):
+        self.pool = ThreadPool(threads) if threads > 1 else None
+
+    def map(self, function, items):
+        if self.pool is None:
+            return [function(item) for item in items]
+        return self.pool.map(functools.partial(run_in_thread, function), items)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
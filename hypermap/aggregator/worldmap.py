@@ -0,0 +1,140 @@
+import json
+import logging
+
+import requests
+
+from django.conf import settings
+from django.utils import timezone
+
+from hypermap.aggregator.governor import governed
+from hypermap.aggregator.harvesting import chunks, bulk_upsert_layers
+from hypermap.aggregator.workers import WorkerPool
+
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_WM_PAGE_SIZE = getattr(settings, 'REGISTRY_WM_PAGE_SIZE', 100)
+REGISTRY_WM_THREADS = getattr(settings, 'REGISTRY_WM_THREADS', 4)
+
+
+def fetch_page(api_url, params, offset, limit, timeout=60):
+    """
+    Request a page of rows of a WorldMap api, through the governor of its host.
+    :return: the decoded JSON.
+    """
+    page_params = dict(params, offset=offset, limit=limit)
+    LOGGER.debug('Fetching %s %s' % (api_url, page_params))
+    with governed(api_url):
+        response = requests.get(api_url, params=page_params, timeout=timeout)
+        response.raise_for_status()
+    return json.loads(response.content)
+
+
+def harvest_worldmap(service, api_url, date_field, parse_row, update_layer, num_layers=None, incremental=False,
+                     page_size=None, threads=None):
+    """
+    Harvest the layers of a WorldMap api, newest first, threads pages of page_size rows at a time.
+    The rows of each batch of pages are written with bulk_upsert_layers.
+    Once all the pages are harvested the date of the newest row is stored in the service:
+    an incremental harvest only requests the rows newer than it. A page with fewer rows than requested,
+    as the rows changed during the harvest, leaves the harvest incomplete.
+    :param date_field: the date of the rows, used to sort and filter them.
+    :param parse_row: function(row) returning the HarvestedLayer of a row.
+    :param update_layer: function(layer, data) passed to bulk_upsert_layers.
+    :param num_layers: harvest at most this number of layers, the newest ones.
+        The date of the newest row is not stored if older rows are skipped.
+    :param incremental: only harvest the rows newer than the last complete harvest.
+    :return: the list of the ids of the updated layers.
+    """
+    from hypermap.aggregator.models import Service
+
+    page_size = page_size or REGISTRY_WM_PAGE_SIZE
+    threads = threads or REGISTRY_WM_THREADS
+    params = {'format': 'json', 'order_by': '-%s' % date_field}
+    if incremental and service.harvest_last_date:
+        params['%s__gt' % date_field] = service.harvest_last_date
+        LOGGER.debug('Harvesting the layers newer than %s' % service.harvest_last_date)
+
+    # the first page gives the number of rows
+    first_page = fetch_page(api_url, params, 0, page_size)
+    total = first_page['meta']['total_count']
+    truncated = bool(num_layers) and num_layers < total
+    if truncated:
+        total = num_layers
+    # the server may return fewer rows than requested per page: the offsets follow the limit it applied
+    limit = first_page['meta'].get('limit')
+    if limit and limit < page_size:
+        LOGGER.debug('The pages of %s are limited to %s rows' % (api_url, limit))
+        page_size = limit
+    LOGGER.debug('Harvesting %s layers of service id %s' % (total, service.id))
+
+    last_date = None
+    if first_page['objects']:
+        last_date = first_page['objects'][0].get(date_field)
+    updated = []
+
+    def fetch(offset):
+        try:
+            return fetch_page(api_url, params, offset, page_size)
+        except Exception as err:
+            LOGGER.error('Error fetching the layers from %s of %s: %s' % (offset, api_url, err))
+            return None
+
+    def harvest_rows(rows):
+        harvested = []
+        for row in rows:
+            try:
+                harvested.append(parse_row(row))
+            except Exception as err:
+                LOGGER.error('Error parsing the row of layer %s: %s' % (row.get('typename'), err))
+        # only the ids are kept, the layers of a page are released once written
+        updated.extend(layer.id for layer in bulk_upsert_layers(service, harvested, update_layer,
+                                                                replace_keywords=True))
+
+    def is_complete(offset, rows):
+        if len(rows) < min(page_size, total - offset):
+            LOGGER.warning('The page from %s of %s has %s rows only' % (offset, api_url, len(rows)))
+            return False
+        return True
+
+    rows = first_page['objects'][:total]
+    complete = is_complete(0, rows)
+    harvest_rows(rows)
+    with WorkerPool(threads) as pool:
+        for window in chunks(range(page_size, total, page_size), threads):
+            pages = pool.map(fetch, window)
+            for offset, page in zip(window, pages):
+                if page is None:
+                    complete = False
+                    continue
+                rows = page['objects'][:total - offset]
+                complete = is_complete(offset, rows) and complete
+                harvest_rows(rows)
+            LOGGER.debug('Updated layer n. %s/%s' % (len(updated), total))
+
+    # the skipped rows must be harvested by the next incremental harvest
+    if complete and last_date and not truncated:
+        service.harvest_last_date = last_date
+        # update does not send the service signals
+        Service.objects.filter(id=service.id).update(harvest_last_date=last_date)
+    return updated
+
+
+def mark_deleted_layers(service, url):
+    """
+    Mark as deleted the layers listed by the actionlayerdelete api of a WorldMap.
+    :return: number of layers marked as deleted.
+    """
+    from hypermap.aggregator.models import Layer
+
+    LOGGER.debug('Fetching %s for detecting deleted layers' % url)
+    response = requests.get(url, timeout=60)
+    data = json.loads(response.content)
+    uuids = [deleted_layer['args'] for deleted_layer in data['objects']]
+    deleted = 0
+    for chunk in chunks(uuids, 500):
+        deleted += Layer.objects.filter(service=service, uuid__in=chunk, was_deleted=False).update(
+            was_deleted=True, last_updated=timezone.now()
+        )
+    LOGGER.debug('%s layers marked as deleted' % deleted)
+    return deleted
@@ -0,0 +1,96 @@
+import csv
+import json
+
+
+# the columns of the CSV export, the fields of the documents of both search backends
+CSV_FIELDS = [
+    "id", "layer_id", "name", "title", "abstract", "layer_originator", "layer_date", "layer_datetype",
+    "service_type", "url", "tile_url", "min_x", "min_y", "max_x", "max_y",
+]
+
+# the fields of the documents left out of the properties of the GeoJSON features, as the geometry replaces them
+GEOMETRY_FIELDS = ["bbox", "layer_geoshape", "layer_centroid"]
+
+# content type and file extension of the export formats
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "geojson": ("application/geo+json", "geojson"),
+}
+
+
+class Echo(object):
+    """
+    A file whose write returns what is written, for the csv writer to format a row at a time.
+    """
+
+    def write(self, value):
+        return value
+
+
+def doc_to_polygon(doc):
+    """
+    The bounding box of a document as a GeoJSON polygon, or None if it has no bounding box.
+    """
+    try:
+        min_x, min_y, max_x, max_y = [float(doc[field]) for field in ("min_x", "min_y", "max_x", "max_y")]
+    except (KeyError, TypeError, ValueError):
+        return None
+    return {
+        "type": "Polygon",
+        "coordinates": [[[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y]]]
+    }
+
+
+def doc_to_feature(doc):
+    return {
+        "type": "Feature",
+        "id": doc.get("id"),
+        "geometry": doc_to_polygon(doc),
+        "properties": dict((key, value) for key, value in doc.items() if key not in GEOMETRY_FIELDS),
+    }
+
+
+def encode_csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        value = ";".join(unicode(item) for item in value)
+    return unicode(value).encode("utf-8")
+
+
+def iter_ndjson(pages):
+    for docs in pages:
+        yield "".join(json.dumps(doc) + "\n" for doc in docs)
+
+
+def iter_csv(pages):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_FIELDS)
+    for docs in pages:
+        yield "".join(writer.writerow([encode_csv_value(doc.get(field)) for field in CSV_FIELDS]) for doc in docs)
+
+
+def iter_geojson(pages):
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ""
+    for docs in pages:
+        chunk = []
+        for doc in docs:
+            chunk.append(separator + json.dumps(doc_to_feature(doc)))
+            separator = ","
+        yield "".join(chunk)
+    yield "]}"
+
+
+def iter_export(pages, export_format):
+    """
+    Format the documents of a search, one chunk per page.
+    :param pages: iterable of lists of documents.
+    :param export_format: ndjson, csv or geojson.
+    """
+    if export_format == "csv":
+        return iter_csv(pages)
+    elif export_format == "geojson":
+        return iter_geojson(pages)
+    return iter_ndjson(pages)
@@ -47,6 +47,12 @@ class SearchSerializer(serializers.Serializer):
         help_text="When documents to return are more than d_docs_limit they can be paginated by this value.",
         default=1
     )
+    d_docs_cursor = serializers.CharField(
+        required=False,
+        help_text="Cursor paging, to walk all the documents at a constant cost per page: '*' for the first page, "
+                  "then the d.docs.cursor of the previous response. The last page is reached when the returned "
+                  "cursor is the given one. Ignores d_docs_page."
+    )
     d_docs_sort = serializers.ChoiceField(
         required=False,
         help_text="How to order the documents before returning the top X. 'score' is keyword search relevancy. "
@@ -155,6 +161,18 @@ class SearchSerializer(serializers.Serializer):
 
         return value
 
+    def validate_d_docs_cursor(self, value):
+        """
+        Would be for example: * or the d.docs.cursor of a previous response.
+        """
+        if value:
+            try:
+                utils.decode_cursor(value)
+            except ValueError as e:
+                raise serializers.ValidationError(e.message)
+
+        return value
+
     def validate_d_docs_page(self, value):
         """
         paginations cant be zero or negative.
@@ -166,6 +184,17 @@ class SearchSerializer(serializers.Serializer):
         return value
 
 
+class ExportSerializer(SearchSerializer):
+
+    export_format = serializers.ChoiceField(
+        required=False,
+        help_text="Format of the exported documents: one JSON document per line, CSV, or a GeoJSON "
+                  "FeatureCollection of the bounding boxes.",
+        default="ndjson",
+        choices=["ndjson", "csv", "geojson"]
+    )
+
+
 class CatalogSerializer(serializers.HyperlinkedModelSerializer):
     search_url = serializers.CharField(source="get_search_url",
                                        read_only=True)
@@ -12,4 +12,5 @@ urlpatterns = [
     url(r'^api/', include(router.urls)),
     url(r'^api/docs/$', TemplateView.as_view(template_name='search_api/swagger/index.html')),
     url(r'^(?P<catalog_slug>[-\w]+)/api/$', views.Search.as_view(), name="search_api"),
+    url(r'^(?P<catalog_slug>[-\w]+)/api/export/$', views.Export.as_view(), name="search_api_export"),
 ]
@@ -1,13 +1,17 @@
 import re
+import json
+import base64
 
 import datetime
 import isodate
 import math
 
-import requests
 from dateutil.parser import parse
 from shapely.geometry import box
 
+from hypermap.aggregator.search_cache import get_index_stats
+from hypermap.aggregator.search_client import get_session
+
 
 def is_range_common_era(start, end):
     """
@@ -315,17 +319,231 @@ def request_heatmap_facet(field, hm_filter, hm_grid_level, hm_limit):
     return params
 
 
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+# the geohash_grid aggregation supports precisions from 1 to 12
+GEOHASH_MAX_PRECISION = 12
+# maximum number of cells of a heatmap, the default limit of buckets of Elasticsearch
+ES_HEATMAP_MAX_CELLS = 10000
+
+
+def geohash_cell_size(precision):
+    """
+    Width and height in degrees of the geohash cells of a precision, whose 5 bits per character alternate
+    between longitude and latitude.
+    """
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 360.0 / 2 ** lon_bits, 180.0 / 2 ** lat_bits
+
+
+def geohash_to_lat_lon(geohash):
+    """
+    The center of a geohash cell.
+    :return: (lat, lon)
+    """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    is_lon = True
+    for char in geohash:
+        bits = GEOHASH_BASE32.index(char)
+        for mask in (16, 8, 4, 2, 1):
+            value_range = lon_range if is_lon else lat_range
+            middle = (value_range[0] + value_range[1]) / 2
+            if bits & mask:
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            is_lon = not is_lon
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+def heatmap_grid(hm_filter, precision):
+    """
+    The grid of the geohash cells of a precision covering a region.
+    :param hm_filter: region, as [-90,-180 TO 90,180]
+    :return: dict with minX, maxX, minY, maxY, columns, rows, and the cell width and height.
+    """
+    from_point_str, to_point_str = parse_solr_geo_range_as_pair(hm_filter)
+    min_lat, min_lon = parse_lat_lon(from_point_str)
+    max_lat, max_lon = parse_lat_lon(to_point_str)
+    width, height = geohash_cell_size(precision)
+    # geohash cells are aligned on the -180, -90 corner
+    min_x = -180 + math.floor((max(min_lon, -180) + 180) / width) * width
+    max_x = -180 + math.ceil((min(max_lon, 180) + 180) / width) * width
+    min_y = -90 + math.floor((max(min_lat, -90) + 90) / height) * height
+    max_y = -90 + math.ceil((min(max_lat, 90) + 90) / height) * height
+    return {
+        "minX": min_x,
+        "maxX": max_x,
+        "minY": min_y,
+        "maxY": max_y,
+        "columns": max(int(round((max_x - min_x) / width)), 1),
+        "rows": max(int(round((max_y - min_y) / height)), 1),
+        "width": width,
+        "height": height,
+    }
+
+
+def request_heatmap_facet_es(field, hm_filter, hm_grid_level, hm_limit):
+    """
+    heatmap aggregation builder for Elasticsearch, the counterpart of request_heatmap_facet:
+    a geohash_grid aggregation of a geo_point field, inside the region.
+    :param field: geo_point field, the centroid of the layers.
+    :param hm_filter: From what region to plot the heatmap. Defaults to the world.
+    :param hm_grid_level: geohash precision, from 1 to 12. Ignores a.hm.limit.
+    :param hm_limit: soft maximum on the number of cells: the finest precision with at most this number of cells
+    in the region is used.
+    Either way the precision is lowered until the region has at most ES_HEATMAP_MAX_CELLS cells.
+    :return: (aggregation, grid level)
+    """
+
+    if not hm_filter:
+        hm_filter = '[-90,-180 TO 90,180]'
+
+    if hm_grid_level:
+        grid_level = min(max(int(hm_grid_level), 1), GEOHASH_MAX_PRECISION)
+        max_cells = ES_HEATMAP_MAX_CELLS
+    else:
+        grid_level = GEOHASH_MAX_PRECISION
+        max_cells = min(hm_limit, ES_HEATMAP_MAX_CELLS)
+
+    # the finest precision with at most max_cells cells, a precision of 1 has 32 cells at most
+    grid = heatmap_grid(hm_filter, grid_level)
+    while grid_level > 1 and grid["columns"] * grid["rows"] > max_cells:
+        grid_level -= 1
+        grid = heatmap_grid(hm_filter, grid_level)
+    from_point_str, to_point_str = parse_solr_geo_range_as_pair(hm_filter)
+    min_lat, min_lon = parse_lat_lon(from_point_str)
+    max_lat, max_lon = parse_lat_lon(to_point_str)
+    aggregation = {
+        "filter": {
+            "geo_bounding_box": {
+                field: {
+                    "top_left": {"lat": max_lat, "lon": min_lon},
+                    "bottom_right": {"lat": min_lat, "lon": max_lon}
+                }
+            }
+        },
+        "aggs": {
+            "cells": {
+                "geohash_grid": {
+                    "field": field,
+                    "precision": grid_level,
+                    "size": grid["columns"] * grid["rows"]
+                }
+            }
+        }
+    }
+    return aggregation, grid_level
+
+
+def es_heatmap_facet(aggregation, hm_filter, grid_level):
+    """
+    Convert the response of a request_heatmap_facet_es aggregation to the a.hm structure of the Solr heatmaps:
+    a grid of counts from the north west corner, whose rows are null when all their counts are 0.
+    """
+
+    if not hm_filter:
+        hm_filter = '[-90,-180 TO 90,180]'
+
+    grid = heatmap_grid(hm_filter, grid_level)
+    # only the rows with buckets are built
+    counts = {}
+    for bucket in aggregation["cells"]["buckets"]:
+        lat, lon = geohash_to_lat_lon(bucket["key"])
+        column = int((lon - grid["minX"]) / grid["width"])
+        row = int((grid["maxY"] - lat) / grid["height"])
+        if 0 <= row < grid["rows"] and 0 <= column < grid["columns"] and bucket["doc_count"]:
+            if row not in counts:
+                counts[row] = [0] * grid["columns"]
+            counts[row][column] += bucket["doc_count"]
+    counts_ints2D = None
+    if counts:
+        counts_ints2D = [counts.get(row) for row in range(grid["rows"])]
+
+    return {
+        'gridLevel': grid_level,
+        'columns': grid["columns"],
+        'rows': grid["rows"],
+        'minX': grid["minX"],
+        'maxX': grid["maxX"],
+        'minY': grid["minY"],
+        'maxY': grid["maxY"],
+        'counts_ints2D': counts_ints2D,
+        'projection': 'EPSG:4326'
+    }
+
+
 def request_field_facet(field, limit, ex_filter=True):
     pass
 
 
-def asterisk_to_min_max(field, time_filter, search_engine_endpoint, actual_params=None):
+def solr_date_min_max(field, search_engine_endpoint):
+    """
+    The min and max dates of a field of a Solr core, with the stats component.
+    :return: (min, max), or None if the request failed.
+    """
+    params_stats = {
+        "q": "*:*",
+        "rows": 0,
+        "stats.field": field,
+        "stats": "true",
+        "wt": "json"
+    }
+    res_stats = get_session().get(search_engine_endpoint, params=params_stats)
+    if not res_stats.ok:
+        return None
+    stats_date_field = res_stats.json()["stats"]["stats_fields"][field]
+    return stats_date_field["min"], stats_date_field["max"]
+
+
+def es_date_min_max(field, search_engine_endpoint):
+    """
+    The min and max dates of a field of an Elasticsearch index, with min and max aggregations.
+    :return: (min, max), or None if the request failed or the index is empty.
+    """
+    query = {
+        "size": 0,
+        "aggs": {
+            "date_min": {"min": {"field": field}},
+            "date_max": {"max": {"field": field}}
+        }
+    }
+    res_stats = get_session().post(search_engine_endpoint, data=json.dumps(query))
+    if not res_stats.ok:
+        return None
+    aggs = res_stats.json()["aggregations"]
+    if aggs["date_min"]["value"] is None:
+        return None
+    epoch = datetime.datetime(1970, 1, 1)
+    return tuple(
+        (epoch + datetime.timedelta(milliseconds=aggs[name]["value"])).strftime("%Y-%m-%dT%H:%M:%SZ")
+        for name in ("date_min", "date_max")
+    )
+
+
+def get_date_min_max(field, search_engine_endpoint, search_engine="solr"):
+    """
+    The min and max indexed dates of a field, computed once until the index changes.
+    :return: (min, max), or None.
+    """
+    if search_engine == "solr":
+        compute = solr_date_min_max
+    else:
+        compute = es_date_min_max
+    return get_index_stats(
+        "date_min_max:{0}:{1}".format(search_engine_endpoint, field),
+        lambda: compute(field, search_engine_endpoint)
+    )
+
+
+def asterisk_to_min_max(field, time_filter, search_engine_endpoint, actual_params=None, search_engine="solr"):
     """
     traduce [* TO *] to something like [MIN-INDEXED-DATE TO MAX-INDEXED-DATE]
     :param field: map the stats to this field.
     :param time_filter: this is the value to be translated. think in "[* TO 2000]"
-    :param search_engine_endpoint: solr core
+    :param search_engine_endpoint: solr core or elasticsearch index search url
     :param actual_params: (not implemented) to merge with other params.
+    :param search_engine: solr or elasticsearch
     :return: translated time filter
     """
 
@@ -334,20 +552,11 @@ def asterisk_to_min_max(field, time_filter, search_engine_endpoint, actual_param
 
     start, end = parse_solr_time_range_as_pair(time_filter)
     if start == '*' or end == '*':
-        params_stats = {
-            "q": "*:*",
-            "rows": 0,
-            "stats.field": field,
-            "stats": "true",
-            "wt": "json"
-        }
-        res_stats = requests.get(search_engine_endpoint, params=params_stats)
+        min_max = get_date_min_max(field, search_engine_endpoint, search_engine)
 
-        if res_stats.ok:
+        if min_max:
 
-            stats_date_field = res_stats.json()["stats"]["stats_fields"][field]
-            date_min = stats_date_field["min"]
-            date_max = stats_date_field["max"]
+            date_min, date_max = min_max
 
             if start != '*':
                 date_min = start
@@ -357,3 +566,24 @@ def asterisk_to_min_max(field, time_filter, search_engine_endpoint, actual_param
             time_filter = "[{0} TO {1}]".format(date_min, date_max)
 
     return time_filter
+
+
+def encode_cursor(value):
+    """
+    Opaque d.docs.cursor token of the position of a page: the search_after values of Elasticsearch,
+    or the cursorMark of Solr.
+    """
+    return base64.urlsafe_b64encode(json.dumps(value))
+
+
+def decode_cursor(cursor):
+    """
+    The value of a d.docs.cursor token, or None for the '*' cursor of the first page.
+    :raise ValueError: if the token is not valid.
+    """
+    if cursor == "*":
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("d.docs.cursor {0} is not valid".format(cursor))
@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
-import requests
+from django.http import StreamingHttpResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
 from hypermap.aggregator.models import Catalog
+from hypermap.aggregator.search_client import get_session, get_es_capabilities, is_index_missing_error
+from hypermap.aggregator.search_cache import get_cached_search, set_cached_search
 from django.conf import settings
 from .utils import parse_geo_box, request_time_facet, \
-                request_heatmap_facet, gap_to_elastic, \
-                asterisk_to_min_max
-from .serializers import SearchSerializer, CatalogSerializer
+                request_heatmap_facet, request_heatmap_facet_es, es_heatmap_facet, gap_to_elastic, \
+                asterisk_to_min_max, parse_solr_time_range_as_pair, encode_cursor, decode_cursor
+from .serializers import SearchSerializer, ExportSerializer, CatalogSerializer
+from .export import EXPORT_FORMATS, iter_export
 import json
+import logging
+
+LOGGER = logging.getLogger(__name__)
 
 # - OPEN API specs
 # https://github.com/OAI/OpenAPI-Specification/blob/master/versions/1.2.md#parameterObject
@@ -18,12 +24,14 @@ import json
 TIME_FILTER_FIELD = "layer_date"
 GEO_FILTER_FIELD = "bbox"
 GEO_HEATMAP_FIELD = "bbox"
+GEO_HEATMAP_ES_FIELD = "layer_centroid"
 USER_FIELD = "layer_originator"
 TEXT_FIELD = "title"
 TIME_SORT_FIELD = "layer_date"
 GEO_SORT_FIELD = "bbox"
 
 REGISTRY_SEARCH_URL = getattr(settings, "REGISTRY_SEARCH_URL", "elasticsearch+http://localhost:9200")
+REGISTRY_SEARCH_EXPORT_PAGE_SIZE = getattr(settings, "REGISTRY_SEARCH_EXPORT_PAGE_SIZE", 1000)
 
 SEARCH_TYPE = REGISTRY_SEARCH_URL.split('+')[0]
 SEARCH_URL = REGISTRY_SEARCH_URL.split('+')[1]
@@ -45,10 +53,14 @@ def elasticsearch(serializer, catalog):
     d_docs_sort = serializer.validated_data.get("d_docs_sort")
     d_docs_limit = int(serializer.validated_data.get("d_docs_limit"))
     d_docs_page = int(serializer.validated_data.get("d_docs_page"))
+    d_docs_cursor = serializer.validated_data.get("d_docs_cursor")
     a_text_limit = serializer.validated_data.get("a_text_limit")
     a_user_limit = serializer.validated_data.get("a_user_limit")
     a_time_gap = serializer.validated_data.get("a_time_gap")
     a_time_limit = serializer.validated_data.get("a_time_limit")
+    a_hm_limit = serializer.validated_data.get("a_hm_limit")
+    a_hm_gridlevel = serializer.validated_data.get("a_hm_gridlevel")
+    a_hm_filter = serializer.validated_data.get("a_hm_filter")
     original_response = serializer.validated_data.get("original_response")
 
     # Dict for search on Elastic engine
@@ -58,14 +70,8 @@ def elasticsearch(serializer, catalog):
 
     # get ES version to make the query builder to be backward compatible with
     # diffs versions.
-    # TODO: move this to a proper place. maybe ES client?.
-    # TODO: cache it to avoid overwhelm ES with this call.
     # TODO: ask for ES_VERSION when building queries with an elegant way.
-    ES_VERSION = 2
-    response = requests.get(SEARCH_URL)
-    if response.ok:
-        # looks ugly but will work on normal ES response for "/".
-        ES_VERSION = int(response.json()["version"]["number"][0])
+    ES_VERSION = get_es_capabilities(SEARCH_URL).version()
 
     # String searching
     if q_text:
@@ -172,7 +178,7 @@ def elasticsearch(serializer, catalog):
     if d_docs_limit:
         dic_query["size"] = d_docs_limit
 
-    if d_docs_page:
+    if d_docs_page and not d_docs_cursor:
         dic_query["from"] = d_docs_limit * d_docs_page - d_docs_limit
 
     if d_docs_sort == "score":
@@ -197,6 +203,21 @@ def elasticsearch(serializer, catalog):
             msg = "q_qeo MUST BE NO ZERO if you wanna sort by distance"
             return {"error": {"msg": msg}}
 
+    if d_docs_cursor:
+        # search_after the sort values of the last document of the previous page, layer_id breaks the ties
+        if ES_VERSION < 5:
+            msg = "d_docs_cursor needs search_after, available since ElasticSearch 5"
+            return {"error": {"msg": msg}}
+        # layer_id is a long in the indices created by Hypermap, a text with a keyword sub-field in the older ones
+        tiebreaker = get_es_capabilities(SEARCH_URL).sort_field(catalog.slug, "layer_id")
+        if tiebreaker is None:
+            tiebreaker = "_uid" if ES_VERSION < 7 else "_id"
+        sort = [dic_query["sort"]] if "sort" in dic_query else []
+        dic_query["sort"] = sort + [{tiebreaker: {"order": "asc"}}]
+        search_after = decode_cursor(d_docs_cursor)
+        if search_after is not None:
+            dic_query["search_after"] = search_after
+
     if a_text_limit:
         # getting most frequently occurring users.
         text_limit = {
@@ -220,9 +241,14 @@ def elasticsearch(serializer, catalog):
 
     if a_time_limit:
         # TODO: Work in progress, a_time_limit is incomplete.
-        # TODO: when times are * it does not work. also a a_time_gap is not required.
+        # TODO: a_time_gap is not required.
         if q_time:
             if not a_time_gap:
+                # traduce * to actual min/max dates.
+                gte, lte = parse_solr_time_range_as_pair(
+                    asterisk_to_min_max(TIME_FILTER_FIELD, q_time, search_engine_endpoint,
+                                        search_engine="elasticsearch")
+                )
                 # getting time limit histogram.
                 time_limt = {
                     "date_range": {
@@ -252,11 +278,18 @@ def elasticsearch(serializer, catalog):
         }
         aggs_dic['articles_over_time'] = time_gap
 
+    if a_hm_limit > 0:
+        # counts of the layer centroids by geohash cell
+        hm_aggregation, hm_grid_level = request_heatmap_facet_es(
+            GEO_HEATMAP_ES_FIELD, a_hm_filter, a_hm_gridlevel, a_hm_limit
+        )
+        aggs_dic['heatmap'] = hm_aggregation
+
     # adding aggreations on body query
     if aggs_dic:
         dic_query['aggs'] = aggs_dic
     try:
-        res = requests.post(search_engine_endpoint, data=json.dumps(dic_query))
+        res = get_session().post(search_engine_endpoint, data=json.dumps(dic_query))
     except Exception as e:
         return 500, {"error": {"msg": str(e)}}
 
@@ -268,6 +301,9 @@ def elasticsearch(serializer, catalog):
     data = {}
 
     if 'error' in es_response:
+        if is_index_missing_error(es_response["error"]):
+            # let the indexing create the catalog index again
+            get_es_capabilities(SEARCH_URL).invalidate(catalog.slug)
         data["error"] = es_response["error"]
         return 400, data
 
@@ -325,6 +361,9 @@ def elasticsearch(serializer, catalog):
             a_gap['counts'] = gap_count
             data['a.time'] = a_gap
 
+        if 'heatmap' in aggs:
+            data["a.hm"] = es_heatmap_facet(aggs["heatmap"], a_hm_filter, hm_grid_level)
+
         if 'range' in aggs:
             # Work in progress
             # Pay attention in the following code lines: Make it better!!!!
@@ -358,6 +397,11 @@ def elasticsearch(serializer, catalog):
 
     data["d.docs"] = docs
 
+    if d_docs_cursor:
+        hits = es_response['hits']['hits']
+        # the cursor does not change after the last page
+        data["d.docs.cursor"] = encode_cursor(hits[-1]['sort']) if hits else d_docs_cursor
+
     return data
 
 
@@ -375,6 +419,7 @@ def solr(serializer):
     d_docs_limit = serializer.validated_data.get("d_docs_limit")
     d_docs_page = serializer.validated_data.get("d_docs_page")
     d_docs_sort = serializer.validated_data.get("d_docs_sort")
+    d_docs_cursor = serializer.validated_data.get("d_docs_cursor")
     a_time_limit = serializer.validated_data.get("a_time_limit")
     a_time_gap = serializer.validated_data.get("a_time_gap")
     a_time_filter = serializer.validated_data.get("a_time_filter")
@@ -398,7 +443,7 @@ def solr(serializer):
     if q_text:
         params["q"] = q_text
 
-    if d_docs_limit >= 0:
+    if d_docs_limit >= 0 and not d_docs_cursor:
         d_docs_page -= 1
         d_docs_page = d_docs_limit * d_docs_page
         params["start"] = d_docs_page
@@ -431,13 +476,19 @@ def solr(serializer):
         params["sfield"] = GEO_SORT_FIELD
         params["pt"] = '{0},{1}'.format(rectangle.centroid.x, rectangle.centroid.y)
 
+    if d_docs_cursor:
+        # the sort of a cursorMark must include the uniqueKey
+        params["sort"] = ", ".join([sort for sort in [params.get("sort"), "id asc"] if sort])
+        params["cursorMark"] = decode_cursor(d_docs_cursor) or "*"
+
     # query params for facets
     if a_time_limit > 0:
         params["facet"] = 'on'
         time_filter = a_time_filter or q_time or None
 
         # traduce * to actual min/max dates.
-        time_filter = asterisk_to_min_max(TIME_FILTER_FIELD, time_filter, search_engine_endpoint)
+        time_filter = asterisk_to_min_max(TIME_FILTER_FIELD, time_filter, search_engine_endpoint,
+                                          search_engine="solr")
 
         # create the range faceting params.
         facet_parms = request_time_facet(TIME_FILTER_FIELD, time_filter, a_time_gap, a_time_limit)
@@ -459,14 +510,12 @@ def solr(serializer):
         params["f.{}.facet.limit".format(USER_FIELD)] = a_user_limit
 
     try:
-        res = requests.get(
+        res = get_session().get(
             search_engine_endpoint, params=params
         )
     except Exception as e:
         return 500, {"error": {"msg": str(e)}}
 
-    print '>', res.url
-
     solr_response = res.json()
     solr_response["solr_request"] = res.url
 
@@ -486,6 +535,14 @@ def solr(serializer):
     if response.get("docs"):
         data["d.docs"] = response.get("docs")
 
+    if d_docs_cursor:
+        next_cursor_mark = solr_response.get("nextCursorMark")
+        # the cursor does not change after the last page
+        if next_cursor_mark == params["cursorMark"]:
+            data["d.docs.cursor"] = d_docs_cursor
+        else:
+            data["d.docs.cursor"] = encode_cursor(next_cursor_mark)
+
     if a_time_limit > 0:
         date_facet = solr_response["facet_counts"]["facet_ranges"][TIME_FILTER_FIELD]
         counts = []
@@ -615,7 +672,7 @@ class Search(APIView):
             # check if data source is remote
             # if catalog.is_remote and request.META['SERVER_PORT'] == "8000":
             if catalog.is_remote:
-                response = requests.get(catalog.url, params=request.query_params)
+                response = get_session().get(catalog.url, params=request.query_params)
                 if response.status_code in [200, 400]:
                     return Response(response.json(),
                                     status=response.status_code)
@@ -623,6 +680,11 @@ class Search(APIView):
                     return Response(response.text,
                                     status=response.status_code)
 
+            # the responses are cached until the next write to the search backend
+            cache_key, data = get_cached_search(catalog.slug, serializer.validated_data)
+            if data is not None:
+                return Response(data)
+
             search_engine = serializer.validated_data.get("search_engine", "elasticsearch")
             if search_engine == 'solr':
                 data = solr(serializer)
@@ -633,10 +695,105 @@ class Search(APIView):
             if type(data) is tuple:
                 status = data[0]
                 data = data[1]
+            elif "error" not in data:
+                # the errors of the backend, as a missing index, are not cached
+                set_cached_search(cache_key, data)
 
             return Response(data, status=status)
 
 
+class CursorPage(object):
+    """
+    The parameters of a page of an export, for solr and elasticsearch: the search without its facets,
+    at a cursor.
+    """
+
+    def __init__(self, validated_data, cursor):
+        self.validated_data = dict(
+            validated_data,
+            d_docs_cursor=cursor,
+            a_time_limit=0,
+            a_time_gap=None,
+            a_hm_limit=0,
+            a_text_limit=0,
+            a_user_limit=0,
+            original_response=0,
+        )
+
+
+def search_page(validated_data, catalog, cursor):
+    """
+    Request a page of documents with cursor paging.
+    :return: the Search API response, or a (status, error) tuple.
+    """
+    page = CursorPage(validated_data, cursor)
+    if validated_data.get("search_engine", "elasticsearch") == 'solr':
+        data = solr(page)
+    else:
+        data = elasticsearch(page, catalog)
+    if type(data) is not tuple and "error" in data:
+        return 400, data
+    return data
+
+
+def iter_search_pages(validated_data, catalog, first_page):
+    """
+    Walk the documents of a search from its first page, one page at a time, until a page is empty.
+    An error stops the export, as the response has already started.
+    """
+    data = first_page
+    cursor = "*"
+    while data.get("d.docs"):
+        yield data["d.docs"]
+        if data.get("d.docs.cursor") in (None, cursor):
+            return
+        cursor = data["d.docs.cursor"]
+        data = search_page(validated_data, catalog, cursor)
+        if type(data) is tuple:
+            LOGGER.error('Export of %s stopped: %s' % (catalog.slug, data[1]))
+            return
+
+
+class Export(APIView):
+    """
+    Stream all the documents matching the q.* filters of the Search API, walking the search backend with
+    a cursor, as NDJSON, CSV or GeoJSON. d.docs.limit is the number of documents requested at a time.
+    """
+
+    def get(self, request, catalog_slug):
+
+        request.GET = parse_get_params(request)
+        serializer = ExportSerializer(data=request.GET)
+        if serializer.is_valid(raise_exception=True):
+
+            try:
+                catalog = Catalog.objects.get(slug=catalog_slug)
+            except Catalog.DoesNotExist:
+                return Response({"error": "catalog '{}' not found".format(catalog_slug)},
+                                status=404)
+
+            if catalog.is_remote:
+                return Response({"error": "catalog '{}' is remote and cannot be exported".format(catalog_slug)},
+                                status=400)
+
+            validated_data = dict(serializer.validated_data)
+            validated_data["d_docs_limit"] = validated_data.get("d_docs_limit") or REGISTRY_SEARCH_EXPORT_PAGE_SIZE
+            export_format = validated_data.pop("export_format", "ndjson")
+
+            # the first page is requested before the response starts, to return its errors
+            data = search_page(validated_data, catalog, "*")
+            if type(data) is tuple:
+                return Response(data[1], status=data[0])
+
+            content_type, extension = EXPORT_FORMATS[export_format]
+            response = StreamingHttpResponse(
+                iter_export(iter_search_pages(validated_data, catalog, data), export_format),
+                content_type=content_type
+            )
+            response["Content-Disposition"] = 'attachment; filename="{0}.{1}"'.format(catalog.slug, extension)
+            return response
+
+
 class CatalogViewSet(ModelViewSet):
     queryset = Catalog.objects.all()
     serializer_class = CatalogSerializer
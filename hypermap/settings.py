@@ -204,7 +204,7 @@ REGISTRY_PYCSW = {
         # authentication/authorization is handled by Django
         'transactions': 'false',
         'allowed_ips': '*',
-        # 'csw_harvest_pagesize': '10',
+        # 'csw_harvest_pagesize': '100',
     },
     'repository': {
         'source': 'hypermap.search.pycsw_plugin.HHypermapRepository',
@@ -257,12 +257,90 @@ REGISTRY_MAPPING_PRECISION = os.getenv("REGISTRY_MAPPING_PRECISION", "500m")
 MAPPROXY_CACHE_DIR = os.getenv('MAPPROXY_CACHE_DIR', '/tmp/mapproxy/')
 MAPPROXY_CONFIG = os.path.join(MEDIA_ROOT, 'mapproxy_config')
 
+# Check all the layers of a service in the check_service task, with a pool of threads
+# and at most REGISTRY_CHECK_HOST_CONCURRENCY requests at a time to the same host
+REGISTRY_CHECK_LAYERS_BY_SERVICE = strtobool(os.getenv('REGISTRY_CHECK_LAYERS_BY_SERVICE', 'False'))
+REGISTRY_CHECK_THREADS = int(os.getenv('REGISTRY_CHECK_THREADS', 8))
+REGISTRY_CHECK_HOST_CONCURRENCY = int(os.getenv('REGISTRY_CHECK_HOST_CONCURRENCY', 4))
+
+# Endpoint lists are imported REGISTRY_ENDPOINT_BATCH_SIZE endpoints at a time, and their endpoints are probed
+# with a pool of REGISTRY_ENDPOINT_THREADS threads, at most REGISTRY_ENDPOINT_HOST_CONCURRENCY at a time per host
+REGISTRY_ENDPOINT_BATCH_SIZE = int(os.getenv('REGISTRY_ENDPOINT_BATCH_SIZE', 500))
+REGISTRY_ENDPOINT_THREADS = int(os.getenv('REGISTRY_ENDPOINT_THREADS', 8))
+REGISTRY_ENDPOINT_HOST_CONCURRENCY = int(os.getenv('REGISTRY_ENDPOINT_HOST_CONCURRENCY', 2))
+
+# CSW endpoints are harvested REGISTRY_CSW_HARVEST_THREADS pages of records at a time
+# (see csw_harvest_pagesize in REGISTRY_PYCSW, 100 records by default)
+REGISTRY_CSW_HARVEST_THREADS = int(os.getenv('REGISTRY_CSW_HARVEST_THREADS', 4))
+
+# ArcGIS REST folders, services and layers are requested with a pool of REGISTRY_ESRI_THREADS threads
+REGISTRY_ESRI_THREADS = int(os.getenv('REGISTRY_ESRI_THREADS', 8))
+
+# WorldMap layers are requested REGISTRY_WM_PAGE_SIZE at a time, REGISTRY_WM_THREADS pages at a time
+REGISTRY_WM_PAGE_SIZE = int(os.getenv('REGISTRY_WM_PAGE_SIZE', 100))
+REGISTRY_WM_THREADS = int(os.getenv('REGISTRY_WM_THREADS', 4))
+
+# Outbound requests to remote services, per host: maximum requests per second, and number of consecutive
+# failures after which the host is not requested for REGISTRY_HOST_COOLDOWN seconds (0 disables them)
+REGISTRY_HOST_RATE_LIMIT = int(os.getenv('REGISTRY_HOST_RATE_LIMIT', 10))
+REGISTRY_HOST_FAILURE_THRESHOLD = int(os.getenv('REGISTRY_HOST_FAILURE_THRESHOLD', 5))
+REGISTRY_HOST_COOLDOWN = int(os.getenv('REGISTRY_HOST_COOLDOWN', 300))
+
+# Seconds the capabilities document downloaded to detect the type of a new service is kept for its first harvest
+REGISTRY_DETECTED_CAPABILITIES_TIMEOUT = int(os.getenv('REGISTRY_DETECTED_CAPABILITIES_TIMEOUT', 600))
+# Bytes of the largest detected capabilities document kept for the first harvest, below the 1 MB limit of memcached
+REGISTRY_DETECTED_CAPABILITIES_MAX_SIZE = int(os.getenv('REGISTRY_DETECTED_CAPABILITIES_MAX_SIZE', 900000))
+
+# WMS, WMTS and TMS capabilities are shared by the checks of a service and of its layers: each process keeps
+# REGISTRY_CAPABILITIES_CACHE_SIZE documents for REGISTRY_CAPABILITIES_CACHE_TTL seconds, and they are also kept in
+# the REGISTRY_CAPABILITIES_CACHE cache of CACHES if set. A service check uses a document downloaded at most
+# REGISTRY_CAPABILITIES_CHECK_MAX_AGE seconds before.
+REGISTRY_CAPABILITIES_CACHE_TTL = int(os.getenv('REGISTRY_CAPABILITIES_CACHE_TTL', 300))
+REGISTRY_CAPABILITIES_CACHE_SIZE = int(os.getenv('REGISTRY_CAPABILITIES_CACHE_SIZE', 32))
+REGISTRY_CAPABILITIES_CACHE = os.getenv('REGISTRY_CAPABILITIES_CACHE', None)
+REGISTRY_CAPABILITIES_CHECK_MAX_AGE = int(os.getenv('REGISTRY_CAPABILITIES_CHECK_MAX_AGE', 60))
+
+# Harvest WMS and WMTS capabilities documents with a streaming parser instead of OWSLib, writing
+# REGISTRY_HARVEST_BATCH_SIZE layers at a time: memory does not depend on the number of layers.
+REGISTRY_HARVEST_STREAMING = strtobool(os.getenv('REGISTRY_HARVEST_STREAMING', 'False'))
+REGISTRY_HARVEST_BATCH_SIZE = int(os.getenv('REGISTRY_HARVEST_BATCH_SIZE', 500))
+
+# Checks are kept for REGISTRY_CHECK_RETENTION_DAYS, then the prune_checks task rolls them up in hourly rollups,
+# kept for REGISTRY_CHECK_HOURLY_RETENTION_DAYS, and daily rollups, processing
+# REGISTRY_CHECK_PRUNE_BATCH_SIZE resources per transaction
+REGISTRY_CHECK_RETENTION_DAYS = int(os.getenv('REGISTRY_CHECK_RETENTION_DAYS', 30))
+REGISTRY_CHECK_HOURLY_RETENTION_DAYS = int(os.getenv('REGISTRY_CHECK_HOURLY_RETENTION_DAYS', 90))
+REGISTRY_CHECK_PRUNE_BATCH_SIZE = int(os.getenv('REGISTRY_CHECK_PRUNE_BATCH_SIZE', 200))
+
 # REGISTRY_SEARCH_URL Examples:
 # solr+http://127.0.0.1:8983/solr/search
 # elasticsearch+http://localhost:9200/
 # elasticsearch+https://user:pass/domain:port/
 REGISTRY_SEARCH_URL = os.getenv('REGISTRY_SEARCH_URL', 'solr+http://solr:8983')
 REGISTRY_SEARCH_BATCH_SIZE = int(os.getenv('REGISTRY_SEARCH_BATCH_SIZE', 50))
+# Maximum number of batches sent concurrently to the search backend when reindexing
+REGISTRY_SEARCH_INDEX_WINDOW = int(os.getenv('REGISTRY_SEARCH_INDEX_WINDOW', 4))
+# Connections kept alive per search backend host, retries (with exponential backoff) and timeout in seconds
+REGISTRY_SEARCH_POOL_SIZE = int(os.getenv('REGISTRY_SEARCH_POOL_SIZE', 10))
+REGISTRY_SEARCH_RETRIES = int(os.getenv('REGISTRY_SEARCH_RETRIES', 3))
+REGISTRY_SEARCH_BACKOFF = float(os.getenv('REGISTRY_SEARCH_BACKOFF', 0.3))
+REGISTRY_SEARCH_TIMEOUT = float(os.getenv('REGISTRY_SEARCH_TIMEOUT', 30))
+# Seconds before the Elasticsearch version and existing indices are discovered again
+REGISTRY_SEARCH_CAPABILITIES_TTL = int(os.getenv('REGISTRY_SEARCH_CAPABILITIES_TTL', 300))
+# Search API responses are cached until the next write to the search backend: each process keeps
+# REGISTRY_SEARCH_CACHE_SIZE responses for REGISTRY_SEARCH_CACHE_TTL seconds, and they are also kept in
+# the REGISTRY_SEARCH_CACHE cache of CACHES if set.
+REGISTRY_SEARCH_CACHE_TTL = int(os.getenv('REGISTRY_SEARCH_CACHE_TTL', 60))
+REGISTRY_SEARCH_CACHE_SIZE = int(os.getenv('REGISTRY_SEARCH_CACHE_SIZE', 256))
+REGISTRY_SEARCH_CACHE = os.getenv('REGISTRY_SEARCH_CACHE', None)
+# Seconds after a write to the search backend during which the search responses are not cached, as the
+# written documents may not be visible yet (Solr commitWithin, Elasticsearch refresh interval)
+REGISTRY_SEARCH_VISIBILITY_DELAY = int(os.getenv('REGISTRY_SEARCH_VISIBILITY_DELAY', 3))
+# The min and max indexed dates, used for the time facets of open ended ranges, are requested once per write to
+# the search backend once it is visible, and kept at most REGISTRY_SEARCH_STATS_TTL seconds.
+REGISTRY_SEARCH_STATS_TTL = int(os.getenv('REGISTRY_SEARCH_STATS_TTL', 600))
+# Number of documents requested at a time by the export of the Search API, unless d.docs.limit is given
+REGISTRY_SEARCH_EXPORT_PAGE_SIZE = int(os.getenv('REGISTRY_SEARCH_EXPORT_PAGE_SIZE', 1000))
 SEARCH_TYPE = REGISTRY_SEARCH_URL.split('+')[0]
 SEARCH_URL = REGISTRY_SEARCH_URL.split('+')[1]
 